@@ -3,6 +3,10 @@ import requests
 import json
 import os
 import sys
+import time
+import sqlite3
+import asyncio
+import queue
 
 # 获取当前文件的目录
 CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -10,40 +14,48 @@ CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
 ROOT_DIR = os.path.dirname(CURRENT_DIR)
 sys.path.append(ROOT_DIR)
 
-from langchain_openai import ChatOpenAI
 from langchain.memory import ConversationBufferMemory
 from langchain.chains import ConversationChain
 from langchain.prompts import PromptTemplate
 from database.database import ChatDatabase
-from langchain.callbacks.base import BaseCallbackHandler
+from database.async_database import AsyncChatDatabase
 from typing import Any, Dict, List
 from langchain_core.outputs import LLMResult
-from langchain_core.messages import HumanMessage, AIMessage
-from langchain_core.runnables.history import RunnableWithMessageHistory
+from langchain_core.messages import HumanMessage, AIMessage, SystemMessage
 from langchain_core.chat_history import BaseChatMessageHistory
 from langchain_community.chat_message_histories import ChatMessageHistory
-from config.settings import DATABASE_PATH, DEFAULT_MODEL
+from config.settings import (
+    DATABASE_PATH, DEFAULT_MODEL, MODEL_CONTEXT_LENGTHS, DEFAULT_CONTEXT_LENGTH,
+    CONTEXT_RESERVED_OUTPUT_TOKENS, CONTEXT_HISTORY_TOKEN_LIMIT, SUMMARY_MEMORY_ENABLED,
+    HISTORY_CACHE_MAX_BYTES, RESPONSE_CACHE_ENABLED, RESPONSE_CACHE_REPLAY_CHUNK_CHARS,
+    RESPONSE_CACHE_REPLAY_DELAY, SEMANTIC_CACHE_ENABLED, SEMANTIC_CACHE_MIN_CHARS,
+    SCHEDULER_OUTPUT_TOKEN_ESTIMATE, METRICS_ENABLED, METRICS_RETENTION_DAYS, METRICS_STATS_DAYS
+)
+from utils.tokenizer import count_tokens, count_message_tokens
+from utils.history_cache import HistoryCache, select_window
+from utils.llm_pool import LLMClientPool
+from utils.http_client import warm_up
+from utils.response_cache import ResponseCache
+from utils.semantic_cache import SemanticCache
+from utils.scheduler import RequestScheduler
+from utils.resilience import ResilientStreamer
+from utils.metrics import TurnMetrics, summarize
+from utils.async_runtime import get_async_runtime
+from summary_memory import SummaryMemory
 
+# stream_chat 中表示生成结束
+_STREAM_END = object()
 
-class StreamCallbackHandler(BaseCallbackHandler):
-    """自定义回调处理器，用于流式输出"""
-    def __init__(self, on_new_token_callback=None):
-        self.on_new_token_callback = on_new_token_callback
-        self.full_response = ""
-    
-    def on_llm_new_token(self, token: str, **kwargs) -> None:
-        """当模型生成新token时调用"""
-        self.full_response += token
-        if self.on_new_token_callback:
-            self.on_new_token_callback(token)
 
 class ChatCore:
-    def __init__(self, api_key, api_url):
+    def __init__(self, api_key, api_url, db_path=None):
         self.api_key = api_key
         self.api_url = api_url
-        # 初始化数据库管理器
+        # 初始化数据库管理器，db_path 为空时使用默认数据库（压测等场景使用独立的数据库）
 
-        self.db_manager = ChatDatabase(DATABASE_PATH)
+        self.db_manager = ChatDatabase(db_path or DATABASE_PATH)
+        # 异步接口使用的数据库包装，数据库操作在线程池中执行
+        self.adb = AsyncChatDatabase(self.db_manager)
         # 当前模型
         self.current_model = DEFAULT_MODEL
         # 当前对话ID
@@ -55,13 +67,40 @@ class ChatCore:
         else:
             self.api_url = api_url
         
-        # 初始化 langchain 的聊天模型
-        self.llm = ChatOpenAI(
-            model=self.current_model,
-            openai_api_key=api_key,
-            openai_api_base=self.api_url.replace("/chat/completions", ""),  # 调整 base URL
-            temperature=0.7
-        )
+        # 大模型客户端池，客户端按模型等参数懒创建并在各轮对话间复用
+        self.llm_pool = LLMClientPool(api_key, self.api_url.replace("/chat/completions", ""))  # 调整 base URL
+        # 所有模型请求先经过调度器排队，按模型限制请求速率和并发数
+        self.scheduler = RequestScheduler()
+        # 首 token 之前失败的请求自动重试，可选地向等价模型发送对冲请求
+        self.resilience = ResilientStreamer()
+        # 提示模板 | 模型，按 (模型, 是否流式) 缓存
+        self._runnables = {}
+        
+        # 对话历史缓存，ChatCore 写入的消息直接追加，构建上下文时无需每次查询数据库
+        self.history_cache = HistoryCache(HISTORY_CACHE_MAX_BYTES)
+        
+        # 回答缓存（默认关闭），完全相同的提示词直接回放缓存的回答
+        self.response_cache = ResponseCache(self.db_manager) if RESPONSE_CACHE_ENABLED else None
+        # 语义缓存（默认关闭），对话的第一个问题与缓存的问题相似时直接回放缓存的回答
+        self.semantic_cache = None
+        if SEMANTIC_CACHE_ENABLED:
+            try:
+                self.semantic_cache = SemanticCache(self.db_manager)
+            except RuntimeError as e:
+                self.db_manager.logger.log_error(f"语义缓存未启用: {str(e)}")
+        
+        # 长对话的滚动摘要，超出 token 预算的早期消息在后台合并进摘要
+        self.summary_memory = None
+        if SUMMARY_MEMORY_ENABLED:
+            self.summary_memory = SummaryMemory(
+                self.db_manager, self.llm_pool, scheduler=self.scheduler, resilience=self.resilience)
+        
+        # 删除过期的延迟统计
+        if METRICS_ENABLED:
+            try:
+                self.db_manager.prune_turn_metrics(time.time() - METRICS_RETENTION_DAYS * 86400)
+            except sqlite3.Error as e:
+                self.db_manager.logger.log_exception(f"清理延迟统计时出错: {str(e)}")
         
         # 创建提示模板
         self.prompt = PromptTemplate.from_template("""
@@ -73,24 +112,43 @@ class ChatCore:
         用户提问: {input}
         AI回答:""")
         
-        # 创建对话链
-        self.conversation_chain = RunnableWithMessageHistory(
-            self.prompt | self.llm,
-            self.get_session_history,
-            input_messages_key="input",
-            history_messages_key="history"
-        )
+    def get_session_history(self, session_id: str, model_name=None) -> BaseChatMessageHistory:
+        """获取会话历史，model_name 决定 token 预算，默认为当前模型"""
+        # 获取授权码作为用户标识
+        auth_code = os.environ.get('AUTH_CODE', 'default_user')
+        chat_history, _ = self._build_history(auth_code, int(session_id), model_name)
+        return chat_history
+    
+    def _build_history(self, auth_code, conversation_id, model_name=None):
+        """构建发送给模型的历史记录，返回 (ChatMessageHistory, 窗口中的消息条数)
         
-    def get_session_history(self, session_id: str) -> BaseChatMessageHistory:
-        """获取会话历史"""
+        每轮对话只构建一次，缓存查询和模型请求共用；不安排摘要，回答保存后由 _schedule_summary 安排。
+        """
         # 创建一个新的ChatMessageHistory实例
         chat_history = ChatMessageHistory()
         
-        # 获取授权码作为用户标识
-        auth_code = os.environ.get('AUTH_CODE', 'default_user')
+        full_budget = self.get_history_token_budget(model_name)
+        budget = full_budget
+        
+        # 已合并进摘要的消息不再发送，摘要作为第一条历史消息
+        summary = self.summary_memory.get_summary(conversation_id) if self.summary_memory else None
+        watermark = None
+        if summary:
+            watermark = summary['watermark_id']
+            summary_text = f"此前对话的摘要：{summary['summary']}"
+            budget = max(budget - count_message_tokens(count_tokens(summary_text)), 0)
+            chat_history.add_message(SystemMessage(content=summary_text))
         
-        # 从数据库获取当前对话的历史记录
-        history = self.db_manager.get_conversation_history(auth_code, int(session_id))
+        # 优先从缓存中选取不超过 token 预算的最近历史记录，未命中时从数据库加载整个预算的消息
+        key = (auth_code, conversation_id)
+        history = self.history_cache.select(key, budget, after_id=watermark)
+        if history is None:
+            # 加载期间写入的新消息会让版本号变化，此时不写入缓存，避免覆盖追加的消息
+            version = self.history_cache.version(key)
+            loaded = self.db_manager.get_conversation_context(
+                auth_code, conversation_id, max_tokens=full_budget, after_id=watermark)
+            self.history_cache.put(key, loaded, full_budget, version)
+            history = select_window(loaded, budget, after_id=watermark)
         
         # 将历史记录加载到ChatMessageHistory中
         for entry in history:
@@ -99,119 +157,442 @@ class ChatCore:
             else:
                 chat_history.add_ai_message(entry['message'])
         
-        return chat_history
+        return chat_history, len(history)
+    
+    def _schedule_summary(self, auth_code, conversation_id, window_size):
+        """回答保存后安排后台摘要：本轮发送的窗口和新回答之外更早的消息合并进摘要"""
+        if self.summary_memory and window_size:
+            self.summary_memory.schedule(auth_code, conversation_id, window_size + 1)
 
+    def get_history_token_budget(self, model_name=None):
+        """历史消息可用的 token 数：模型上下文长度减去预留的回答长度和提示模板长度"""
+        model_name = model_name or self.current_model
+        context_length = MODEL_CONTEXT_LENGTHS.get(model_name, DEFAULT_CONTEXT_LENGTH)
+        budget = context_length - CONTEXT_RESERVED_OUTPUT_TOKENS - count_tokens(self.prompt.template)
+        if CONTEXT_HISTORY_TOKEN_LIMIT is not None:
+            budget = min(budget, CONTEXT_HISTORY_TOKEN_LIMIT)
+        return max(budget, 0)
+
+    def save_message(self, auth_code, conversation_id, message, is_user, truncated=False):
+        """保存对话消息，并追加到对话历史缓存；truncated 标记生成中途被取消的部分回答"""
+        self.db_manager.save_message_to_conversation(
+            auth_code, conversation_id, message, is_user=is_user, truncated=truncated)
+        self.history_cache.append((auth_code, conversation_id), {
+            'id': None,
+            'message': message,
+            'is_user': is_user,
+            'timestamp': None,
+            'token_count': count_tokens(message),
+        })
+    
+    def rename_conversation(self, auth_code, conversation_id, new_title):
+        """重命名对话"""
+        self.db_manager.update_conversation_title(auth_code, conversation_id, new_title)
+        self.history_cache.invalidate((auth_code, conversation_id))
+    
+    def delete_conversation(self, auth_code, conversation_id):
+        """删除对话，同时清除缓存的历史记录"""
+        self.db_manager.delete_conversation(auth_code, conversation_id)
+        self.history_cache.invalidate((auth_code, conversation_id))
+    
+    def clear_user_history(self, auth_code):
+        """清除用户的所有历史消息，同时清除缓存的历史记录"""
+        self.db_manager.clear_user_history(auth_code)
+        self.history_cache.invalidate_user(auth_code)
+    
+    def get_history_cache_stats(self):
+        """对话历史缓存的命中统计"""
+        return self.history_cache.stats()
+    
+    def get_response_cache_stats(self):
+        """回答缓存的命中统计，未启用时返回 None"""
+        return self.response_cache.stats() if self.response_cache else None
+    
+    def get_semantic_cache_stats(self):
+        """语义缓存的命中统计，未启用时返回 None"""
+        return self.semantic_cache.stats() if self.semantic_cache else None
+    
+    def get_scheduler_stats(self):
+        """请求调度器各模型的排队和等待统计"""
+        return self.scheduler.stats()
+    
+    def record_turn_metrics(self, metrics):
+        """保存一轮对话的延迟统计，未启用或本轮没有结束状态时忽略"""
+        if not METRICS_ENABLED or metrics.status is None:
+            return
+        try:
+            self.db_manager.save_turn_metrics(metrics.as_row())
+        except sqlite3.Error as e:
+            self.db_manager.logger.log_exception(f"保存延迟统计时出错: {str(e)}")
+    
+    def get_latency_stats(self, days=None):
+        """最近 days 天（默认 METRICS_STATS_DAYS）各模型各阶段耗时的 p50 / p95 / p99
+        
+        只统计未命中缓存且正常结束的轮次，其余轮次的数量见 get_turn_outcomes。
+        """
+        days = METRICS_STATS_DAYS if days is None else days
+        rows = self.db_manager.get_turn_metrics(since=time.time() - days * 86400, cached=False, status="ok")
+        return summarize(rows)
+    
+    def get_turn_outcomes(self, days=None):
+        """最近 days 天正常结束、命中缓存、被取消和出错的轮次数"""
+        days = METRICS_STATS_DAYS if days is None else days
+        return self.db_manager.count_turn_outcomes(since=time.time() - days * 86400)
+    
+    def get_resilience_stats(self):
+        """重试和对冲统计：各路径胜出次数、重试次数、对冲次数"""
+        return self.resilience.stats()
+    
+    @staticmethod
+    def estimate_request_tokens(messages, question):
+        """预估一次请求消耗的 token 数：历史消息 + 问题 + 预留的回答长度，用于调度器的 TPM 限制"""
+        tokens = sum(count_message_tokens(count_tokens(message.content)) for message in messages)
+        return tokens + count_message_tokens(count_tokens(question)) + SCHEDULER_OUTPUT_TOKEN_ESTIMATE
+    
+    def _lookup_cached_response(self, auth_code, question, messages, model_name, temperature=0.7):
+        """依次查询回答缓存和语义缓存，返回 (命中的回答或 None, 回答缓存键, 是否为独立问题)
+        
+        messages 为本轮构建好的历史记录。回答缓存按用户、模型和渲染后的完整提示词（含历史记录）匹配；
+        语义缓存只用于对话中的第一个问题，后续问题往往依赖上下文。
+        """
+        if not self.response_cache and not self.semantic_cache:
+            return None, None, False
+        # 历史记录中只有刚保存的这个问题
+        standalone = len(messages) <= 1 and len(question) >= SEMANTIC_CACHE_MIN_CHARS
+        
+        cache_key = None
+        if self.response_cache:
+            prompt = self.prompt.format(history=messages, input=question)
+            cache_key = ResponseCache.make_key(auth_code, model_name, temperature, prompt)
+            cached = self.response_cache.get(cache_key)
+            if cached is not None:
+                return cached, cache_key, standalone
+        if self.semantic_cache and standalone:
+            entry = self.semantic_cache.lookup(auth_code, model_name, question)
+            if entry is not None:
+                return entry['answer'], cache_key, standalone
+        return None, cache_key, standalone
+    
+    def _store_cached_response(self, auth_code, question, answer, cache_key, standalone, model_name=None):
+        """把模型的回答写入回答缓存和语义缓存"""
+        if not answer:
+            return
+        model_name = model_name or self.current_model
+        if cache_key:
+            self.response_cache.put(cache_key, model_name, answer)
+        if self.semantic_cache and standalone:
+            self.semantic_cache.add(auth_code, model_name, question, answer)
+    
+    def close(self):
+        """程序退出时保存缓存索引并关闭数据库"""
+        if self.semantic_cache:
+            self.semantic_cache.flush()
+        self.adb.close()
+        self.db_manager.close()
+    
+    @staticmethod
+    async def _areplay_response(response):
+        """按流式输出的方式分块返回缓存的回答，分块间隔不阻塞事件循环"""
+        if RESPONSE_CACHE_REPLAY_CHUNK_CHARS <= 0:
+            yield response
+            return
+        for start in range(0, len(response), RESPONSE_CACHE_REPLAY_CHUNK_CHARS):
+            if start and RESPONSE_CACHE_REPLAY_DELAY > 0:
+                await asyncio.sleep(RESPONSE_CACHE_REPLAY_DELAY)
+            yield response[start:start + RESPONSE_CACHE_REPLAY_CHUNK_CHARS]
+    
     def chat(self, question, model="gpt-3.5-turbo"):
-        # 如果没有当前对话ID，则创建新对话
-        if self.current_conversation_id is None:
-            # 获取授权码作为用户标识
-            auth_code = os.environ.get('AUTH_CODE', 'default_user')
-            # 创建新对话，仅使用当前时间作为标题
-            from datetime import datetime
-            new_conversation_title = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-            self.current_conversation_id = self.db_manager.create_conversation(auth_code, new_conversation_title)
+        # 对话ID和模型在这一轮开始时确定，生成期间切换对话或模型不影响回答写入的对话
+        conversation_id = self.ensure_conversation()
+        model_name = self.current_model
         
         # 获取授权码作为用户标识
         auth_code = os.environ.get('AUTH_CODE', 'default_user')
         
-        # 保存问题到当前对话
-        self.db_manager.save_message_to_conversation(auth_code, self.current_conversation_id, question, is_user=True)
+        # 保存问题到对话
+        self.save_message(auth_code, conversation_id, question, is_user=True)
+        
+        # 历史记录每轮只构建一次，缓存查询和模型请求共用
+        history, window_size = self._build_history(auth_code, conversation_id, model_name)
+        
+        # 命中回答缓存或语义缓存时直接返回
+        cached, cache_key, standalone = self._lookup_cached_response(
+            auth_code, question, history.messages, model_name)
+        if cached is not None:
+            self.save_message(auth_code, conversation_id, cached, is_user=False)
+            self._schedule_summary(auth_code, conversation_id, window_size)
+            return cached
+        
+        # 获取回答，请求先经过调度器排队
+        prompt_tokens = self.estimate_request_tokens(history.messages, question) - SCHEDULER_OUTPUT_TOKEN_ESTIMATE
+        
+        def invoke():
+            # 每次尝试都重新排队
+            with self.scheduler.slot(model_name, prompt_tokens + SCHEDULER_OUTPUT_TOKEN_ESTIMATE) as ticket:
+                response = self.get_runnable(model_name).invoke({"history": history.messages, "input": question})
+                ticket.used_tokens = prompt_tokens + count_tokens(response.content)
+            return response
         
-        # 获取回答
-        config = {"configurable": {"session_id": str(self.current_conversation_id)}}
-        response = self.conversation_chain.invoke({"input": question}, config=config)
+        response = self.resilience.call(invoke)
         
-        # 保存回答到当前对话
-        self.db_manager.save_message_to_conversation(auth_code, self.current_conversation_id, response.content, is_user=False)
+        # 保存回答到对话
+        self.save_message(auth_code, conversation_id, response.content, is_user=False)
+        self._store_cached_response(auth_code, question, response.content, cache_key, standalone, model_name)
+        self._schedule_summary(auth_code, conversation_id, window_size)
         
         return response.content
     
-    def stream_chat(self, question, model="gpt-3.5-turbo"):
-        """流式聊天方法"""
-        # 如果没有当前对话ID，则创建新对话
+    def stream_chat(self, question, model="gpt-3.5-turbo", cancel_token=None, metrics=None):
+        """流式聊天方法，在共享事件循环中运行 astream_chat 并逐块返回
+        
+        cancel_token 被取消时立即取消生成任务，正在等待的上游响应随之关闭，已生成的部分标记为中断后保存。
+        调用方提前关闭生成器时同样取消生成任务。不能在共享事件循环的线程中调用。
+        metrics 为调用方提供的 TurnMetrics，由调用方保存；为空时自动记录并保存本轮的延迟统计。
+        """
+        # 对话ID在这一轮开始时确定，生成期间切换对话不影响回答写入的对话
+        conversation_id = self.ensure_conversation()
+        chunks = queue.Queue()
+        
+        async def pump():
+            try:
+                async for chunk in self.astream_chat(question, model, conversation_id, cancel_token, metrics):
+                    chunks.put(chunk)
+            except asyncio.CancelledError:
+                # 被取消令牌或调用方取消，部分回答已由 astream_chat 保存
+                pass
+            except Exception as e:
+                chunks.put(e)
+            finally:
+                chunks.put(_STREAM_END)
+        
+        future = get_async_runtime().submit(pump())
+        try:
+            while True:
+                item = chunks.get()
+                if item is _STREAM_END:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            if not future.done():
+                future.cancel()
+    
+    def get_runnable(self, model_name=None, streaming=False):
+        """获取 提示模板 | 模型，同一模型和输出方式只创建一次；历史记录由调用方每轮构建后传入"""
+        model_name = model_name or self.current_model
+        key = (model_name, streaming)
+        runnable = self._runnables.get(key)
+        if runnable is None:
+            runnable = self.prompt | self.llm_pool.get(model_name, streaming=streaming, temperature=0.7)
+            self._runnables[key] = runnable
+        return runnable
+    
+    def ensure_conversation(self):
+        """返回当前对话ID，没有当前对话时新建一个"""
         if self.current_conversation_id is None:
-            # 获取授权码作为用户标识
             auth_code = os.environ.get('AUTH_CODE', 'default_user')
-            # 创建新对话，仅使用当前时间作为标题
             from datetime import datetime
             new_conversation_title = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
             self.current_conversation_id = self.db_manager.create_conversation(auth_code, new_conversation_title)
+        return self.current_conversation_id
+    
+    async def _aprepare_turn(self, question, conversation_id=None, metrics=None):
+        """异步接口的公共准备：确定对话、保存问题、构建历史记录并查询缓存
         
-        print("当前对话ID:", self.current_conversation_id)
-        print("从stream_chat调用get_session_history")
-        
-        # 获取授权码作为用户标识
+        返回 (授权码, 对话ID, 模型, 历史记录, 窗口中的消息条数, 命中的缓存回答或 None, 回答缓存键, 是否为独立问题)。
+        对话ID和模型在这一轮开始时确定，之后切换对话或模型不影响本轮生成。
+        """
         auth_code = os.environ.get('AUTH_CODE', 'default_user')
+        if conversation_id is None:
+            conversation_id = await self.adb.run(self.ensure_conversation)
+        model_name = self.current_model
+        if metrics is not None:
+            metrics.model = model_name
+            metrics.conversation_id = conversation_id
         
-        # 保存问题到当前对话
-        self.db_manager.save_message_to_conversation(auth_code, self.current_conversation_id, question, is_user=True)
+        start = time.perf_counter()
+        await self.adb.run(self.save_message, auth_code, conversation_id, question, True)
+        if metrics is not None:
+            metrics.db_enqueue += time.perf_counter() - start
+        start = time.perf_counter()
+        history, window_size = await self.adb.run(self._build_history, auth_code, conversation_id, model_name)
+        if metrics is not None:
+            metrics.history_load = (metrics.history_load or 0.0) + time.perf_counter() - start
+        cached, cache_key, standalone = await self.adb.run(
+            self._lookup_cached_response, auth_code, question, history.messages, model_name)
+        return auth_code, conversation_id, model_name, history, window_size, cached, cache_key, standalone
+    
+    async def achat(self, question, model="gpt-3.5-turbo", conversation_id=None):
+        """chat 的异步版本，conversation_id 为空时使用当前对话"""
+        (auth_code, conversation_id, model_name, history, window_size,
+         cached, cache_key, standalone) = await self._aprepare_turn(question, conversation_id)
+        if cached is not None:
+            await self.adb.run(self.save_message, auth_code, conversation_id, cached, False)
+            self._schedule_summary(auth_code, conversation_id, window_size)
+            return cached
         
-        # 创建回调处理器
-        tokens = []
-        def on_new_token(token):
-            tokens.append(token)
+        prompt_tokens = self.estimate_request_tokens(history.messages, question) - SCHEDULER_OUTPUT_TOKEN_ESTIMATE
         
-        callback_handler = StreamCallbackHandler(on_new_token_callback=on_new_token)
+        async def invoke():
+            async with self.scheduler.aslot(model_name, prompt_tokens + SCHEDULER_OUTPUT_TOKEN_ESTIMATE) as ticket:
+                response = await self.get_runnable(model_name).ainvoke({"history": history.messages, "input": question})
+                ticket.used_tokens = prompt_tokens + count_tokens(response.content)
+            return response
         
-        # 创建带流式输出的模型
-        # 确保API URL包含协议
-        api_url = self.api_url
-        if not api_url.startswith(('http://', 'https://')):
-            api_url = 'http://' + api_url
-        
-        streaming_llm = ChatOpenAI(
-            model=self.current_model,
-            openai_api_key=self.api_key,
-            openai_api_base=api_url.replace("/chat/completions", ""),
-            temperature=0.7,
-            streaming=True,
-            callbacks=[callback_handler]
-        )
-        
-        # 创建对话链
-        streaming_conversation_chain = RunnableWithMessageHistory(
-            self.prompt | streaming_llm,
-            self.get_session_history,
-            input_messages_key="input",
-            history_messages_key="history"
-        )
-        
-        # 流式获取回答
-        config = {"configurable": {"session_id": str(self.current_conversation_id)}}
-        # 使用stream方法而不是invoke方法来实现真正的流式输出
-        response = streaming_conversation_chain.stream({"input": question}, config=config)
+        response = await self.resilience.acall(invoke)
+        
+        await self.adb.run(self.save_message, auth_code, conversation_id, response.content, False)
+        await self.adb.run(self._store_cached_response, auth_code, question, response.content,
+                           cache_key, standalone, model_name)
+        self._schedule_summary(auth_code, conversation_id, window_size)
+        return response.content
+    
+    async def astream_chat(self, question, model="gpt-3.5-turbo", conversation_id=None, cancel_token=None,
+                           metrics=None):
+        """stream_chat 的异步版本，多个对话可以在同一个事件循环中并发生成
+        
+        conversation_id 为空时使用当前对话；生成过程中切换当前对话不影响回答写入的对话。
+        cancel_token 被取消时立即取消当前任务，上游连接随之关闭，已生成的部分标记为中断后保存。
+        metrics 为调用方提供的 TurnMetrics（如需要加上界面渲染时间），由调用方保存；
+        为空时自动记录并保存本轮的延迟统计。
+        """
+        own_metrics = metrics is None
+        if own_metrics:
+            metrics = TurnMetrics(self.current_model, conversation_id)
+        try:
+            stream = self._astream_chat(question, conversation_id, cancel_token, metrics)
+            try:
+                async for chunk in stream:
+                    yield chunk
+            finally:
+                await stream.aclose()
+        finally:
+            if own_metrics:
+                self.record_turn_metrics(metrics)
+    
+    async def _astream_chat(self, question, conversation_id, cancel_token, metrics):
+        (auth_code, conversation_id, model_name, history, window_size,
+         cached, cache_key, standalone) = await self._aprepare_turn(question, conversation_id, metrics)
+        if cached is not None:
+            metrics.cached = True
+            # 回放缓存时取消只是停止显示，缓存的完整回答照常保存
+            async for chunk in self._areplay_response(cached):
+                if cancel_token is not None and cancel_token.cancelled:
+                    break
+                metrics.token_received()
+                yield chunk
+            metrics.finish(cached)
+            with metrics.measure("db_enqueue"):
+                await self.adb.run(self.save_message, auth_code, conversation_id, cached, False)
+            self._schedule_summary(auth_code, conversation_id, window_size)
+            return
         
         full_response = ""
-        # 逐个处理流式返回的token
-        for chunk in response:
-            full_response += chunk.content
-            yield chunk.content
+        # 首 token 之前失败时重试，迟迟没有输出时可能由等价模型的对冲请求胜出
+        info = {}
+        stream = self._astream_model(model_name, history.messages, question, info, metrics=metrics)
+        cancel_handle = cancel_token.bind_current_task() if cancel_token is not None else None
+        try:
+            async for chunk in stream:
+                metrics.token_received()
+                full_response += chunk
+                yield chunk
+        except (asyncio.CancelledError, GeneratorExit):
+            # 保存已生成的部分；写入队列是异步的，这里直接调用不会阻塞事件循环
+            metrics.finish(full_response, "cancelled")
+            if full_response:
+                with metrics.measure("db_enqueue"):
+                    try:
+                        self.save_message(auth_code, conversation_id, full_response, False, truncated=True)
+                    except sqlite3.IntegrityError as e:
+                        # 对话在生成过程中被删除，部分回答无处保存
+                        self.db_manager.logger.log_error(
+                            f"对话 {conversation_id} 已删除，未保存中断的回答: {str(e)}")
+            raise
+        except Exception:
+            metrics.finish(full_response, "error")
+            raise
+        finally:
+            if cancel_handle is not None:
+                cancel_token.remove_callback(cancel_handle)
+            await stream.aclose()
         
-        # 保存完整回答到当前对话
-        self.db_manager.save_message_to_conversation(auth_code, self.current_conversation_id, full_response, is_user=False)
+        # 对冲请求胜出时统计记在实际回答的模型上
+        metrics.model = info.get("model", model_name)
+        metrics.finish(full_response)
+        # 保存完整回答到对话
+        with metrics.measure("db_enqueue"):
+            await self.adb.run(self.save_message, auth_code, conversation_id, full_response, False)
+        # 对冲请求的回答来自其他模型，不写入按本模型计算的缓存
+        if info.get("model") == model_name:
+            await self.adb.run(self._store_cached_response, auth_code, question, full_response,
+                               cache_key, standalone, model_name)
+        self._schedule_summary(auth_code, conversation_id, window_size)
+    
+    def _astream_model(self, model_name, messages, question, info=None, hedge=True, metrics=None):
+        """以 messages 为历史记录流式请求模型，经过调度器排队和重试/对冲，info 中写入胜出的模型和路径"""
+        prompt_tokens = self.estimate_request_tokens(messages, question) - SCHEDULER_OUTPUT_TOKEN_ESTIMATE
+        
+        async def make_stream(name, timing):
+            # 排队等待期间不阻塞事件循环，其他对话照常生成
+            async with self.scheduler.aslot(name, prompt_tokens + SCHEDULER_OUTPUT_TOKEN_ESTIMATE) as ticket:
+                # 首 token 延迟从放行时开始计算，不含排队时间
+                timing["start"] = time.monotonic()
+                if metrics is not None:
+                    metrics.request_started(ticket.waited)
+                text = ""
+                async for chunk in self.get_runnable(name, streaming=True).astream(
+                        {"history": messages, "input": question}):
+                    text += chunk.content
+                    yield chunk.content
+                ticket.used_tokens = prompt_tokens + count_tokens(text)
+        
+        return self.resilience.astream(make_stream, model_name, info, hedge=hedge)
+    
+    async def astream_compare(self, question, model_name, conversation_id=None, cancel_token=None, metrics=None):
+        """对比模式：用指定模型回答问题，以对话历史为上下文，问题和回答都不写入对话
+        
+        多个模型的 astream_compare 在同一个事件循环中并发运行，不使用缓存，也不对冲到其他模型。
+        metrics 为调用方提供的 TurnMetrics，由调用方保存。
+        """
+        metrics = metrics or TurnMetrics(model_name, conversation_id)
+        conversation_id = conversation_id or self.current_conversation_id
+        messages = []
+        if conversation_id is not None:
+            with metrics.measure("history_load"):
+                history, _ = await self.adb.run(
+                    self._build_history, os.environ.get('AUTH_CODE', 'default_user'), conversation_id, model_name)
+            messages = history.messages
+        
+        text = ""
+        stream = self._astream_model(model_name, messages, question, hedge=False, metrics=metrics)
+        cancel_handle = cancel_token.bind_current_task() if cancel_token is not None else None
+        try:
+            async for chunk in stream:
+                metrics.token_received()
+                text += chunk
+                yield chunk
+            metrics.finish(text)
+        except (asyncio.CancelledError, GeneratorExit):
+            metrics.finish(text, "cancelled")
+            raise
+        except Exception:
+            metrics.finish(text, "error")
+            raise
+        finally:
+            if cancel_handle is not None:
+                cancel_token.remove_callback(cancel_handle)
+            await stream.aclose()
+    
+    def warm_up(self):
+        """提前建立到模型接口的连接，返回是否发起了预热"""
+        return warm_up(self.llm_pool.api_base)
     
     def update_model(self, model_name):
-        """更新模型配置"""
+        """更新模型配置，客户端在第一次使用该模型时才创建"""
         self.current_model = model_name
-        # 重新创建LLM实例以应用新模型
-        self.llm = ChatOpenAI(
-            model=model_name,
-            openai_api_key=self.api_key,
-            openai_api_base=self.api_url.replace("/chat/completions", ""),
-            temperature=0.7
-        )
-        
-        # 重新创建对话链
-        self.conversation_chain = RunnableWithMessageHistory(
-            self.prompt | self.llm,
-            self.get_session_history,
-            input_messages_key="input",
-            history_messages_key="history"
-        )
-    
-    
-    def get_model(self, model_name):
-        """获取指定的模型"""
-        # 这里可以根据需要返回不同的模型实例
-        # 目前我们只使用一个模型，所以直接返回当前模型
-        return self.llm
+    
+    def get_model(self, model_name=None):
+        """获取指定的模型，默认为当前模型"""
+        return self.llm_pool.get(model_name or self.current_model, temperature=0.7)
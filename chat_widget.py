@@ -1,51 +1,136 @@
 from PyQt5.QtWidgets import (
     QWidget, QVBoxLayout, QHBoxLayout, QTextEdit, QPushButton, QLabel, QScrollArea, QSizePolicy, QApplication, QMessageBox
-    ,QToolTip
+    ,QToolTip, QDialog, QDialogButtonBox, QListWidget, QListWidgetItem
 )
-from PyQt5.QtCore import Qt, QThread, pyqtSignal ,QTimer
+from PyQt5.QtCore import Qt, QObject, pyqtSignal ,QTimer
 from PyQt5.QtGui import QPixmap
 import markdown
+import asyncio
+import concurrent.futures
+import time
 import os
 import sys
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from utils.logger import Logger
+from utils.async_runtime import get_async_runtime
+from utils.cancellation import CancellationToken
+from utils.metrics import TurnMetrics
+from config.settings import API_MODELS
 
-class StreamChatWorker(QThread):
+# 被取消的回答末尾显示的提示
+TRUNCATED_NOTE = "\n\n*（回答已中断）*"
+
+
+class StreamChatWorker(QObject):
+    """在共享事件循环中运行 astream_chat，通过 Qt 信号把结果送回界面线程
+    
+    接口与原先的 QThread 版本保持一致（start / cancel / isRunning / wait），
+    但不再为每条消息创建线程，多个生成任务共用同一个事件循环。
+    """
     finished = pyqtSignal(str)
     stream_data = pyqtSignal(str)
     
-    def __init__(self, chat_core, question, model_name):
+    def __init__(self, chat_core, question, model_name, conversation_id=None):
         super().__init__()
         self.chat_core = chat_core
         self.question = question
         self.model_name = model_name
+        self.conversation_id = conversation_id
+        # 已生成的内容，切换回该对话时用于恢复显示
+        self.answer = ""
+        # 界面线程已收到的字符数；answer 在事件循环线程中更新，可能领先于排队中的 stream_data 信号
+        self.delivered_chars = 0
+        # 本轮的延迟统计，ChatCore 记录生成各阶段，界面记录渲染时间
+        self.turn_metrics = TurnMetrics(model_name, conversation_id)
         self._is_cancelled = False  # 添加取消标志位
+        # 取消令牌传给 ChatCore，取消时立即中断正在等待的上游请求
+        self.cancel_token = CancellationToken()
+        self._future = None
         
         # 初始化日志记录器
         self.logger = Logger()
         
+    def start(self):
+        """把生成任务提交到共享事件循环"""
+        self._future = get_async_runtime().submit(self._run())
+        
     def cancel(self):
-        """设置取消标志位"""
+        """取消生成：上游连接立即关闭，已生成的部分由 ChatCore 标记为中断后保存"""
         self._is_cancelled = True
+        self.cancel_token.cancel()
+        
+    def isRunning(self):
+        return self._future is not None and not self._future.done()
+        
+    def wait(self, timeout=None):
+        """等待生成任务结束，超时返回 False"""
+        if self._future is None:
+            return True
+        try:
+            self._future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            return False
+        except Exception:
+            pass
+        return True
         
-    def run(self):
+    def _open_stream(self):
+        return self.chat_core.astream_chat(
+            self.question, model=self.model_name, conversation_id=self.conversation_id,
+            cancel_token=self.cancel_token, metrics=self.turn_metrics)
+        
+    async def _run(self):
         # 使用流式方式获取回答
         full_answer = ""
+        stream = self._open_stream()
         try:
             # 使用流式聊天方法
-            for chunk in self.chat_core.stream_chat(self.question, model=self.model_name):
+            async for chunk in stream:
                 # 检查是否已取消
                 if self._is_cancelled:
                     self.finished.emit("对话生成已取消")
                     return
                 full_answer += chunk
+                self.answer = full_answer
                 self.stream_data.emit(chunk)
             self.finished.emit(full_answer)
+        except asyncio.CancelledError:
+            # 被取消令牌中断，任务正常结束
+            self.finished.emit("对话生成已取消")
         except Exception as e:
             error_msg = f"流式生成对话时出错: {str(e)}"
             # 记录异常日志
             self.logger.log_exception(error_msg)
             self.finished.emit(f"错误：{str(e)}")
+        finally:
+            # 关闭生成器，停止接收上游的数据
+            await stream.aclose()
+
+
+class CompareStreamWorker(StreamChatWorker):
+    """对比模式中一个模型的生成任务，结束后通过 metrics 信号报告首 token 延迟、生成速度和总耗时"""
+    metrics = pyqtSignal(dict)
+    
+    def _open_stream(self):
+        return self.chat_core.astream_compare(
+            self.question, self.model_name, conversation_id=self.conversation_id,
+            cancel_token=self.cancel_token, metrics=self.turn_metrics)
+        
+    async def _run(self):
+        await super()._run()
+        if self.turn_metrics.status == "ok":
+            self.metrics.emit(self.get_metrics())
+        
+    def get_metrics(self):
+        """首 token 延迟、总耗时（秒）和首 token 之后的生成速度（token/秒）"""
+        metrics = self.turn_metrics
+        return {
+            "model": self.model_name,
+            "ttft": metrics.ttft if metrics.ttft is not None else metrics.total,
+            "total": metrics.total,
+            "tokens": metrics.tokens,
+            "tokens_per_second": metrics.tokens_per_second or 0.0,
+        }
 
 class ChatWidget(QWidget):
     def __init__(self, chat_core,get_model_func):
@@ -53,7 +138,18 @@ class ChatWidget(QWidget):
         self.chat_core = chat_core
         self.init_ui()
         self.get_model_func = get_model_func
-        self.worker = None  # 保存当前运行的worker线程
+        # 各对话正在进行的生成任务，对话ID -> worker，切换对话后生成在后台继续
+        self.workers = {}
+        # 对比模式选中的模型，为空时为普通模式；对比模式的生成任务只属于当前界面
+        self.compare_models = []
+        self.compare_workers = []
+        # 对比任务 -> (回答标签, 统计标签)
+        self.compare_labels = {}
+    
+    @property
+    def worker(self):
+        """当前显示的对话的生成任务"""
+        return self.workers.get(self.chat_core.current_conversation_id)
     
         
 
@@ -92,8 +188,13 @@ class ChatWidget(QWidget):
         self.cancel_button.setStyleSheet("background-color: red; color: white;")
         self.cancel_button.setVisible(False)  # 初始隐藏取消按钮
         
+        # 对比模式按钮：选择多个模型同时回答同一个问题
+        self.compare_button = QPushButton("对比")
+        self.compare_button.setFixedHeight(40)
+        self.compare_button.setToolTip("选择多个模型，同时回答同一个问题")
         
         input_layout.addWidget(self.model_base_input)
+        input_layout.addWidget(self.compare_button)
         input_layout.addWidget(self.model_base_button)
         input_layout.addWidget(self.cancel_button)
 
@@ -103,6 +204,7 @@ class ChatWidget(QWidget):
 
         self.model_base_button.clicked.connect(self.run_model_base)
         self.cancel_button.clicked.connect(self.cancel_generation)
+        self.compare_button.clicked.connect(self.select_compare_models)
         # 添加使用 Enter 键发送消息的功能
         self.model_base_input.installEventFilter(self)
         self.setLayout(main_layout)
@@ -111,9 +213,13 @@ class ChatWidget(QWidget):
         self.current_theme = "浅色主题"
         
         # 初始化分页加载相关属性
-        self.page_size = 20  # 每页加载的消息数量
-        self.current_page = 0  # 当前页码
-        self.loaded_history = []  # 已加载的历史消息
+        self.page_size = 20  # 向上滚动时每页加载的消息数量
+        self.oldest_message_id = None  # 已显示的最早一条消息的ID，作为向前翻页的游标
+        self.has_more_history = False  # 是否还有更早的消息
+        self.message_labels = {}  # 消息ID -> 消息标签，用于定位搜索结果
+        
+        # 连接滚动条的滚动事件，滚动到顶部时加载更早的消息
+        self.scroll_area.verticalScrollBar().valueChanged.connect(self.check_scroll_position)
         
     def apply_qss_style(self):
         """应用QSS样式"""
@@ -136,64 +242,74 @@ class ChatWidget(QWidget):
         self.apply_qss_style()
     
     def display_history_messages(self, history):
-        """显示从数据库加载的历史消息（分页加载）"""
-        # 重置分页状态
-        self.current_page = 0
-        self.loaded_history = []
-        
+        """显示从数据库加载的最近历史消息，更早的消息在滚动到顶部时分页加载"""
         # 清空当前聊天界面
         self.clear_chat()
         
-        # 加载第一页
-        self.load_more_history(history)
+        for entry in history:
+            is_user = entry['is_user']
+            message = entry['message']
+            if entry.get('truncated'):
+                message += TRUNCATED_NOTE
+            self.add_message(message, is_user=is_user, show_copy=not is_user, message_id=entry['id'])
+        
+        # 记录翻页游标
+        self.oldest_message_id = history[0]['id'] if history else None
+        self.has_more_history = bool(history)
     
-    def load_more_history(self, history):
-        """加载更多历史消息（分页加载）"""
-        # 计算当前页的起始和结束索引
-        start_index = self.current_page * self.page_size
-        end_index = start_index + self.page_size
+    def load_more_history(self):
+        """加载当前最早消息之前的一页历史消息，插入到聊天区域顶部"""
+        conversation_id = self.chat_core.current_conversation_id
+        if not self.has_more_history or self.oldest_message_id is None or conversation_id is None:
+            return
         
-        # 获取当前页需要显示的消息
-        page_messages = history[start_index:end_index]
+        auth_code = os.environ.get('AUTH_CODE', 'default_user')
+        # 以最早消息ID为游标向前取一页（从新到旧）
+        page_messages = self.chat_core.db_manager.get_conversation_messages(
+            auth_code, conversation_id, before_id=self.oldest_message_id, limit=self.page_size)
         
         # 如果没有更多消息，直接返回
+        if len(page_messages) < self.page_size:
+            self.has_more_history = False
         if not page_messages:
             return
         
-        # 将当前页消息添加到已加载历史中
-        self.loaded_history.extend(page_messages)
+        # 记录插入前的滚动范围，插入后保持当前可见内容不跳动
+        scroll_bar = self.scroll_area.verticalScrollBar()
+        old_maximum = scroll_bar.maximum()
         
-        # 显示当前页消息
+        # 从新到旧依次插入到顶部，最终按时间顺序排列
         for entry in page_messages:
             is_user = entry['is_user']
             message = entry['message']
-            self.add_message(message, is_user=is_user, show_copy=not is_user)
+            if entry.get('truncated'):
+                message += TRUNCATED_NOTE
+            self.add_message(message, is_user=is_user, show_copy=not is_user, index=0, message_id=entry['id'])
+        self.oldest_message_id = page_messages[-1]['id']
         
-        # 更新页码
-        self.current_page += 1
-        
-        # 连接滚动条的滚动事件，实现懒加载
-        self.scroll_area.verticalScrollBar().valueChanged.connect(self.check_scroll_position)
+        QTimer.singleShot(0, lambda: scroll_bar.setValue(scroll_bar.maximum() - old_maximum))
+    
+    def scroll_to_message(self, message_id):
+        """滚动到指定消息，消息尚未加载时向前分页加载直到包含该消息"""
+        while message_id not in self.message_labels and self.has_more_history:
+            if self.oldest_message_id is not None and self.oldest_message_id < message_id:
+                break
+            self.load_more_history()
+        
+        label = self.message_labels.get(message_id)
+        if label is None:
+            return
+        # 等待新插入的消息完成布局后再滚动
+        QTimer.singleShot(0, lambda: self.scroll_area.ensureWidgetVisible(label, 0, 50))
     
     def check_scroll_position(self, value):
         """检查滚动位置，实现懒加载"""
-        # 获取滚动条的最大值和当前值
-        scroll_bar = self.scroll_area.verticalScrollBar()
-        max_value = scroll_bar.maximum()
-        current_value = scroll_bar.value()
-        
-        # 如果滚动到顶部，加载更多历史消息
-        if current_value == 0 and self.current_page > 0:
-            # 这里可以实现向上滚动加载更多历史消息的逻辑
-            # 为简化实现，我们暂时不处理向上滚动加载
-            pass
-        
-        # 如果滚动到底部，可以在这里添加加载更多消息的逻辑（如果需要）
-        # 例如：
-        # if current_value == max_value:
-        #     self.load_next_page()
+        # 如果滚动到顶部，加载更早的历史消息
+        if value == 0 and self.has_more_history:
+            self.load_more_history()
 
-    def add_message(self, text, is_user=True, question=None, show_copy=False, return_label=False):
+    def add_message(self, text, is_user=True, question=None, show_copy=False, return_label=False, index=None,
+                    message_id=None):
         msg_layout = QHBoxLayout()
         avatar = QLabel()
         avatar.setFixedSize(40, 40)
@@ -244,9 +360,15 @@ class ChatWidget(QWidget):
             msg_layout.addWidget(avatar)
             msg_layout.addLayout(bubble_layout)
             msg_layout.addStretch()
-        self.chat_layout.addLayout(msg_layout)
-        # 确保发送新消息后滚动到对话列表的最底部
-        QTimer.singleShot(0, lambda: self.scroll_area.verticalScrollBar().setValue(self.scroll_area.verticalScrollBar().maximum()))
+        if message_id is not None:
+            self.message_labels[message_id] = msg_label
+        if index is not None:
+            # 插入到指定位置（加载更早的历史消息），不滚动到底部
+            self.chat_layout.insertLayout(index, msg_layout)
+        else:
+            self.chat_layout.addLayout(msg_layout)
+            # 确保发送新消息后滚动到对话列表的最底部
+            QTimer.singleShot(0, lambda: self.scroll_area.verticalScrollBar().setValue(self.scroll_area.verticalScrollBar().maximum()))
         
         # 如果需要返回标签引用
         if return_label:
@@ -254,17 +376,24 @@ class ChatWidget(QWidget):
 
     def run_model_base(self):
         question = self.model_base_input.toPlainText().strip()
-        if question:
+        if question and self.compare_models:
+            if not self.is_compare_running():
+                self.run_compare(question)
+            return
+        # 当前对话正在生成时不能再发送
+        if question and not self.is_worker_running():
             self.add_message(question, is_user=True, show_copy=True)
             self.model_base_input.clear()
             # 显示加载提示
             model = self.get_model_func()  # 动态获取
             self.add_message("嗯🤔,让我想想哈～", is_user=False, show_copy=False)
-            # 启动流式异步线程
-            self.worker = StreamChatWorker(self.chat_core, question, model_name=model)
-            self.worker.stream_data.connect(self.on_stream_data)
-            self.worker.finished.connect(lambda answer: self.on_answer(answer, question))
-            self.worker.start()
+            # 生成任务绑定到发送时的对话，切换对话后仍写入该对话
+            conversation_id = self.chat_core.ensure_conversation()
+            worker = StreamChatWorker(self.chat_core, question, model_name=model, conversation_id=conversation_id)
+            worker.stream_data.connect(lambda chunk: self.on_stream_data(chunk, conversation_id, worker))
+            worker.finished.connect(lambda answer: self._on_worker_finished(worker, answer, question))
+            self.workers[conversation_id] = worker
+            worker.start()
             # 显示取消按钮
             self.cancel_button.setVisible(True)
             self.model_base_button.setVisible(False)
@@ -274,6 +403,9 @@ class ChatWidget(QWidget):
     
     def eventFilter(self, source, event):
         # 添加使用 Enter 键发送消息的功能
+        # 输入框获得焦点时预热到模型接口的连接，发送时无需再握手
+        if source == self.model_base_input and event.type() == event.FocusIn:
+            self.chat_core.warm_up()
         if source == self.model_base_input and event.type() == event.KeyPress:
             if event.key() in (Qt.Key_Return, Qt.Key_Enter):
                 # 检查是否按下了 Shift 键
@@ -288,12 +420,24 @@ class ChatWidget(QWidget):
                     return True
         return super().eventFilter(source, event)
 
-    def on_stream_data(self, chunk):
+    def on_stream_data(self, chunk, conversation_id=None, worker=None):
         # 更新流式消息
+        if worker is not None:
+            worker.delivered_chars += len(chunk)
         # 检查scroll_area是否仍然存在
         if not self.scroll_area:
             return
-            
+        # 后台对话的数据只累积在 worker 中，不更新界面
+        if conversation_id is not None and conversation_id != self.chat_core.current_conversation_id:
+            return
+        
+        # 记录界面渲染耗时，计入该轮的延迟统计
+        render_start = time.perf_counter()
+        self._render_stream_chunk(chunk)
+        if worker is not None:
+            worker.turn_metrics.add_render(time.perf_counter() - render_start)
+    
+    def _render_stream_chunk(self, chunk):
         if self.stream_message_label is None:
             # 移除加载提示
             if self.chat_layout.count() > 0:
@@ -368,9 +512,37 @@ class ChatWidget(QWidget):
         #     # 记录错误日志
         #     logger = Logger()
         #     logger.log_exception(f"保存回答到数据库时出错: {str(e)}")
+    
+    def _on_worker_finished(self, worker, answer, question):
+        """生成任务结束：回答已由 astream_chat 写入数据库，只有正在显示该对话时才更新界面
+        
+        已被取消或停止的任务不再登记在 workers 中，界面已由 cancel_generation 处理。
+        """
+        self.chat_core.record_turn_metrics(worker.turn_metrics)
+        conversation_id = worker.conversation_id
+        if self.workers.get(conversation_id) is not worker:
+            return
+        del self.workers[conversation_id]
+        if conversation_id == self.chat_core.current_conversation_id:
+            self.on_answer(answer, question)
+    
+    def attach_stream(self, conversation_id):
+        """切换回仍在生成的对话时，恢复显示已生成的内容并继续接收后续数据
         
-        # 重置worker引用
-        self.worker = None
+        只恢复界面线程已收到的部分，仍在排队的 stream_data 信号随后照常追加，不会重复显示。
+        """
+        worker = self.workers.get(conversation_id)
+        if worker is None or not worker.isRunning():
+            return
+        self.cancel_button.setVisible(True)
+        self.model_base_button.setVisible(False)
+        delivered = worker.answer[:worker.delivered_chars]
+        if delivered:
+            self.stream_message_text = delivered
+            self.stream_message_label = self.add_message(
+                self.stream_message_text, is_user=False, show_copy=False, return_label=True)
+        else:
+            self.add_message("嗯🤔,让我想想哈～", is_user=False, show_copy=False)
 
     def _clear_layout(self, layout):
         """递归清除布局中的所有控件和子布局"""
@@ -382,31 +554,138 @@ class ChatWidget(QWidget):
                 self._clear_layout(item.layout())
         layout.deleteLater()
 
+    def select_compare_models(self):
+        """选择对比模式的模型，不选择任何模型时回到普通模式"""
+        dialog = QDialog(self)
+        dialog.setWindowTitle("对比模式")
+        layout = QVBoxLayout()
+        layout.addWidget(QLabel("选择要同时回答的模型："))
+        model_list = QListWidget()
+        for model in dict.fromkeys(API_MODELS):
+            item = QListWidgetItem(model)
+            item.setFlags(item.flags() | Qt.ItemIsUserCheckable)
+            item.setCheckState(Qt.Checked if model in self.compare_models else Qt.Unchecked)
+            model_list.addItem(item)
+        layout.addWidget(model_list)
+        buttons = QDialogButtonBox(QDialogButtonBox.Ok | QDialogButtonBox.Cancel)
+        buttons.accepted.connect(dialog.accept)
+        buttons.rejected.connect(dialog.reject)
+        layout.addWidget(buttons)
+        dialog.setLayout(layout)
+        dialog.resize(360, 480)
+        
+        if dialog.exec_() != QDialog.Accepted:
+            return
+        self.compare_models = [model_list.item(i).text() for i in range(model_list.count())
+                               if model_list.item(i).checkState() == Qt.Checked]
+        self.compare_button.setText(f"对比({len(self.compare_models)})" if self.compare_models else "对比")
+    
+    def run_compare(self, question):
+        """对比模式：把问题同时发给选中的模型，每个模型的回答流式显示在各自的一列中
+        
+        所有模型并发生成，总耗时取决于最慢的模型。对比结果只用于评估，不写入对话。
+        """
+        self.add_message(question, is_user=True, show_copy=True)
+        self.model_base_input.clear()
+        
+        row = QWidget()
+        row_layout = QHBoxLayout()
+        row_layout.setContentsMargins(0, 0, 0, 0)
+        row.setLayout(row_layout)
+        for model in self.compare_models:
+            column = QVBoxLayout()
+            name_label = QLabel(f"<b>{model}</b>")
+            answer_label = QLabel("嗯🤔,让我想想哈～")
+            answer_label.setTextFormat(Qt.RichText)
+            answer_label.setWordWrap(True)
+            answer_label.setTextInteractionFlags(Qt.TextSelectableByMouse)
+            answer_label.setProperty("msgType", "assistant")
+            answer_label.setAlignment(Qt.AlignTop | Qt.AlignLeft)
+            metrics_label = QLabel("生成中…")
+            metrics_label.setStyleSheet("font-size: 12px;color: #888888;")
+            column.addWidget(name_label)
+            column.addWidget(answer_label, 1)
+            column.addWidget(metrics_label)
+            row_layout.addLayout(column, 1)
+            
+            worker = CompareStreamWorker(self.chat_core, question, model_name=model,
+                                         conversation_id=self.chat_core.current_conversation_id)
+            worker.stream_data.connect(lambda chunk, w=worker: self._on_compare_data(w))
+            worker.finished.connect(lambda answer, w=worker: self._on_compare_finished(w, answer))
+            worker.metrics.connect(lambda metrics, w=worker: self._on_compare_metrics(w, metrics))
+            self.compare_workers.append(worker)
+            self.compare_labels[worker] = (answer_label, metrics_label)
+        self.chat_layout.addWidget(row)
+        QTimer.singleShot(0, lambda: self.scroll_area.verticalScrollBar().setValue(
+            self.scroll_area.verticalScrollBar().maximum()))
+        
+        for worker in self.compare_workers:
+            worker.start()
+        self.cancel_button.setVisible(True)
+        self.model_base_button.setVisible(False)
+    
+    def _on_compare_data(self, worker):
+        # 界面已清空（标签已删除）时忽略
+        labels = self.compare_labels.get(worker)
+        if labels and worker in self.compare_workers:
+            labels[0].setText(markdown.markdown(worker.answer, extensions=['tables', 'fenced_code', 'codehilite']))
+    
+    def _on_compare_finished(self, worker, answer):
+        self.chat_core.record_turn_metrics(worker.turn_metrics)
+        if worker not in self.compare_workers:
+            return
+        self.compare_workers.remove(worker)
+        if worker.turn_metrics.status != "ok":
+            # 出错时显示错误信息
+            self.compare_labels[worker][0].setText(markdown.markdown(answer))
+            self.compare_labels[worker][1].setText("生成失败")
+        if not self.compare_workers:
+            self.cancel_button.setVisible(False)
+            self.model_base_button.setVisible(True)
+    
+    def _on_compare_metrics(self, worker, metrics):
+        labels = self.compare_labels.get(worker)
+        if labels:
+            labels[1].setText(
+                f"首字 {metrics['ttft']:.2f} 秒 · {metrics['tokens_per_second']:.1f} token/秒 · "
+                f"总耗时 {metrics['total']:.2f} 秒")
+    
+    def stop_compare(self):
+        """取消对比模式中所有未完成的生成任务"""
+        for worker in self.compare_workers:
+            worker.cancel()
+            if worker in self.compare_labels:
+                self.compare_labels[worker][1].setText("已取消")
+        self.compare_workers = []
+    
+    def is_compare_running(self):
+        return any(worker.isRunning() for worker in self.compare_workers)
+    
     def cancel_generation(self):
         """取消当前的对话生成"""
-        # 调用worker的取消方法
-        if self.worker and self.worker.isRunning():
-            self.worker.cancel()
+        # 对比模式的回答不写入对话，保留已生成的部分即可
+        if self.compare_workers:
+            self.stop_compare()
+            self.cancel_button.setVisible(False)
+            self.model_base_button.setVisible(True)
+            return
+        # 调用worker的取消方法，上游连接立即关闭，已生成的部分由 ChatCore 标记为中断后保存
+        self.stop_worker()
         
         # 隐藏取消按钮，显示发送按钮
         self.cancel_button.setVisible(False)
         self.model_base_button.setVisible(True)
         
-        # 移除流式消息标签
+        # 保留已生成的部分，并标明回答被中断
         if self.stream_message_label:
-            # 找到包含流式消息标签的布局并删除
-            for i in range(self.chat_layout.count()):
-                layout_item = self.chat_layout.itemAt(i)
-                if layout_item and layout_item.widget():
-                    widget = layout_item.widget()
-                    # 检查widget中是否包含stream_message_label
-                    if self.stream_message_label in widget.findChildren(QLabel):
-                        widget.deleteLater()
-                        break
+            self.stream_message_text += TRUNCATED_NOTE
+            formatted_text = markdown.markdown(self.stream_message_text, extensions=['tables', 'fenced_code', 'codehilite'])
+            self.stream_message_label.setText(formatted_text)
             self.stream_message_label = None
             self.stream_message_text = ""
+            return
         
-        # 如果没有找到流式消息标签，尝试删除最后一个加载提示
+        # 还没有生成任何内容时，删除最后一个加载提示
         else:
             if self.chat_layout.count() > 0:
                 last_item = self.chat_layout.itemAt(self.chat_layout.count() - 1)
@@ -422,16 +701,9 @@ class ChatWidget(QWidget):
                     if last_msg_label and "嗯🤔,让我想想哈～" in last_msg_label.text():
                         last_widget.deleteLater()
         
-        # 显示取消消息并写入数据库
+        # 只在界面上显示取消消息，不写入数据库
         cancel_message = "🤭 好像发生了一些意外，是不是我又说错话了？ "
         self.add_message(cancel_message, is_user=False, show_copy=False)
-        
-        # 获取授权码
-        auth_code = os.environ.get('AUTH_CODE', 'default_user')
-        # 保存取消消息到数据库
-        if hasattr(self.chat_core, 'db_manager') and self.chat_core.current_conversation_id:
-            self.chat_core.db_manager.save_message_to_conversation(
-                auth_code, self.chat_core.current_conversation_id, cancel_message, False)
     
     def update_theme(self, theme_name):
         """更新聊天界面主题"""
@@ -463,9 +735,20 @@ class ChatWidget(QWidget):
         pass
     
     def clear_chat(self):
-        """清空聊天界面"""
-        # 停止正在进行的worker线程
-        self.stop_worker()
+        """清空聊天界面，其他对话的生成任务在后台继续"""
+        # 对比模式的结果只显示在当前界面，随界面一起清除
+        self.stop_compare()
+        self.compare_labels = {}
+        # 重置流式消息和按钮状态，切换回仍在生成的对话时由 attach_stream 恢复
+        self.stream_message_label = None
+        self.stream_message_text = ""
+        self.cancel_button.setVisible(False)
+        self.model_base_button.setVisible(True)
+        
+        # 重置翻页状态
+        self.oldest_message_id = None
+        self.has_more_history = False
+        self.message_labels = {}
         
         # 清空聊天记录显示区域
         # 逐个删除布局中的所有项目
@@ -480,13 +763,24 @@ class ChatWidget(QWidget):
         # 注意：我们不重新初始化整个UI，只需要清空聊天记录即可
         # self.init_ui()
     
-    def stop_worker(self):
-        """停止当前运行的worker线程"""
-        if self.worker and self.worker.isRunning():
-            self.worker.quit()
-            self.worker.wait()
-            self.worker = None
+    def stop_worker(self, conversation_id=None):
+        """停止指定对话的生成任务，conversation_id 为空时停止当前对话的"""
+        if conversation_id is None:
+            conversation_id = self.chat_core.current_conversation_id
+        worker = self.workers.pop(conversation_id, None)
+        # 只设置取消标志，不等待，避免模型迟迟不返回数据时阻塞界面
+        if worker and worker.isRunning():
+            worker.cancel()
+    
+    def cancel_all_workers(self):
+        """取消所有对话的生成任务（程序退出时调用）"""
+        for worker in self.workers.values():
+            worker.cancel()
+        self.stop_compare()
     
-    def is_worker_running(self):
-        """检查是否有正在进行的worker线程"""
-        return self.worker is not None and self.worker.isRunning()
+    def is_worker_running(self, conversation_id=None):
+        """检查指定对话（默认为当前对话）是否正在生成"""
+        if conversation_id is None:
+            conversation_id = self.chat_core.current_conversation_id
+        worker = self.workers.get(conversation_id)
+        return worker is not None and worker.isRunning()
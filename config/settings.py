@@ -3,6 +3,33 @@ import os
 # 数据库路径配置
 DATABASE_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'database', 'chat_history.db')
 
+# 数据库连接配置
+DB_CACHE_SIZE_KB = 20000  # 每个连接的页缓存大小（KB）
+DB_SYNCHRONOUS = "NORMAL"  # WAL 模式下 NORMAL 即可保证数据库一致性
+DB_STATEMENT_CACHE_SIZE = 128  # 每个连接缓存的预编译语句数量
+DB_BUSY_TIMEOUT_MS = 5000  # 数据库被锁定时的等待时间（毫秒）
+DB_WRITE_BEHIND_ENABLED = True  # 对话消息是否异步批量写入
+DB_WRITE_BATCH_SIZE = 256  # 每个写入事务最多包含的消息数
+DB_WRITE_RETRY_BASE_DELAY = 0.2  # 数据库暂时无法写入时第一次重试前的等待时间（秒），之后逐次翻倍
+DB_WRITE_RETRY_MAX_DELAY = 5.0  # 重试等待时间的上限（秒）
+DB_WRITE_MAX_RETRIES = 20  # 数据库持续被锁定时最多重试的次数，超过后丢弃这批消息
+
+# 冷数据归档配置
+ARCHIVE_DATABASE_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'database', 'chat_archive.db')  # None 表示不归档
+ARCHIVE_IDLE_DAYS = 30  # 对话闲置超过该天数后移入归档库
+
+# 消息压缩配置
+MESSAGE_COMPRESSION_CODEC = "zlib"  # 压缩算法："zlib"、"zstd"（需要安装 zstandard），None 表示不压缩
+MESSAGE_COMPRESSION_THRESHOLD = 4096  # 消息超过该字节数时才压缩
+MESSAGE_COMPRESSION_LEVEL = 6  # 压缩级别
+
+# 对外 HTTP 请求的连接池配置
+HTTP_MAX_CONNECTIONS = 20  # 最大连接数
+HTTP_MAX_KEEPALIVE_CONNECTIONS = 10  # 最多保持的空闲连接数
+HTTP_KEEPALIVE_EXPIRY = 120  # 空闲连接保持时间（秒）
+HTTP_ENABLE_HTTP2 = True  # 是否启用 HTTP/2（需要安装 h2，未安装时使用 HTTP/1.1）
+HTTP_TIMEOUT = 120  # 请求超时时间（秒），流式回答可能持续较长时间
+
 # 日志目录配置
 LOG_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'log')
 
@@ -28,6 +55,79 @@ API_MODELS = [
 # 默认模型
 DEFAULT_MODEL = "deepseek-ai/DeepSeek-V3"
 
+# 各模型的上下文长度（token），用于计算历史消息的 token 预算
+MODEL_CONTEXT_LENGTHS = {
+    "deepseek-ai/DeepSeek-V3": 65536,
+    "deepseek-ai/DeepSeek-R1": 65536,
+    "deepseek-ai/DeepSeek-R1-0528-Qwen3-8B": 32768,
+    "deepseek-ai/deepseek-vl2": 4096,
+    "Qwen/QwQ-32B": 32768,
+    "Qwen/Qwen2.5-VL-32B-Instruct": 32768,
+    "Qwen/Qwen2.5-Coder-32B-Instruct": 32768,
+    "Qwen/Qwen3-235B-A22B-Instruct-2507": 262144,
+    "Tongyi-Zhiwen/QwenLong-L1-32B": 131072,
+    "tencent/Hunyuan-A13B-Instruct": 32768,
+    "THUDM/glm-4-9b-chat": 32768,
+    "THUDM/GLM-4.1V-9B-Thinking": 65536,
+    "THUDM/GLM-Z1-32B-0414": 32768,
+    "baidu/ERNIE-4.5-300B-A47B": 131072,
+}
+DEFAULT_CONTEXT_LENGTH = 32768  # 未在上表中配置的模型使用的上下文长度
+CONTEXT_RESERVED_OUTPUT_TOKENS = 4096  # 为模型回答预留的 token 数
+CONTEXT_HISTORY_TOKEN_LIMIT = 16384  # 历史消息最多占用的 token 数，None 表示只受模型上下文长度限制
+HISTORY_CACHE_MAX_BYTES = 32 * 1024 * 1024  # 对话历史内存缓存的容量上限（字节）
+
+# 回答缓存配置：同一用户相同模型、温度和完整提示词的问题直接返回缓存的回答
+RESPONSE_CACHE_ENABLED = False  # 是否启用回答缓存（默认关闭）
+RESPONSE_CACHE_MEMORY_ENTRIES = 256  # 内存中保留的回答数
+RESPONSE_CACHE_TTL_SECONDS = 7 * 24 * 3600  # 缓存有效期（秒）
+RESPONSE_CACHE_MAX_BYTES = 64 * 1024 * 1024  # 数据库中缓存的总大小上限（字节）
+RESPONSE_CACHE_REPLAY_CHUNK_CHARS = 8  # 回放缓存回答时每块的字符数，0 表示一次性返回
+RESPONSE_CACHE_REPLAY_DELAY = 0.01  # 回放时每块之间的间隔（秒），模拟流式输出
+
+# 语义缓存配置：对话中的第一个问题与缓存的问题足够相似时直接返回缓存的回答（需要安装 numpy）
+SEMANTIC_CACHE_ENABLED = False  # 是否启用语义缓存（默认关闭）
+SEMANTIC_CACHE_DIM = 128  # 问题向量的维度
+SEMANTIC_CACHE_THRESHOLD = 0.92  # 余弦相似度达到该值才视为命中
+SEMANTIC_CACHE_MIN_CHARS = 6  # 短于该长度的问题不使用语义缓存
+SEMANTIC_CACHE_INDEX_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'database', 'semantic_index')  # 向量快照目录，None 表示每次启动从数据库重建
+SEMANTIC_CACHE_SNAPSHOT_EVERY = 1024  # 新写入的向量达到该数量时合并进快照
+
+# 滚动摘要配置：超出 token 预算的早期消息在后台合并进对话摘要
+SUMMARY_MEMORY_ENABLED = False  # 是否启用摘要记忆（默认关闭，会额外调用摘要模型），关闭后早期消息直接丢弃
+SUMMARY_MODEL = "THUDM/glm-4-9b-chat"  # 生成摘要使用的低成本模型
+SUMMARY_MAX_TOKENS = 1024  # 摘要的最大长度
+SUMMARY_CHUNK_TOKENS = 8000  # 每次合并进摘要的消息最多包含的 token 数
+
+# 请求调度配置：按模型限制每分钟请求数（rpm）、每分钟 token 数（tpm）和并发数（concurrency），None 表示不限制
+MODEL_RATE_LIMITS = {
+    "deepseek-ai/DeepSeek-R1": {"rpm": 30, "tpm": 100000, "concurrency": 2},
+    "THUDM/glm-4-9b-chat": {"rpm": 60, "tpm": 200000, "concurrency": 2},
+}
+DEFAULT_MODEL_RATE_LIMIT = {"rpm": 60, "tpm": 200000, "concurrency": 4}  # 未在上表中配置的模型使用的限制
+SCHEDULER_OUTPUT_TOKEN_ESTIMATE = 1024  # 发送前预估回答的 token 数，结束后按实际消耗修正
+
+# 重试与对冲配置：收到第一个 token 之前失败的请求自动重试，首 token 迟迟不到时可向等价模型发送对冲请求
+RETRY_MAX_ATTEMPTS = 3  # 每个请求最多尝试的次数（含第一次）
+RETRY_BASE_DELAY = 0.5  # 重试退避的基准时间（秒），每次翻倍并加随机抖动
+RETRY_MAX_DELAY = 8.0  # 单次退避的最长时间（秒）
+HEDGE_ENABLED = False  # 是否启用对冲请求（会增加调用量，默认关闭）
+HEDGE_EQUIVALENT_MODELS = {  # 对冲请求使用的等价模型，未配置的模型不对冲
+    "deepseek-ai/DeepSeek-V3": "Qwen/Qwen3-235B-A22B-Instruct-2507",
+    "Qwen/Qwen3-235B-A22B-Instruct-2507": "deepseek-ai/DeepSeek-V3",
+    "deepseek-ai/DeepSeek-R1": "Qwen/QwQ-32B",
+    "Qwen/QwQ-32B": "deepseek-ai/DeepSeek-R1",
+}
+HEDGE_PERCENTILE = 95  # 首 token 延迟超过该分位数时发送对冲请求
+HEDGE_MIN_SAMPLES = 20  # 首 token 延迟样本少于该数量时使用默认等待时间
+HEDGE_DEFAULT_DELAY = 8.0  # 默认的对冲等待时间（秒）
+HEDGE_MIN_DELAY = 1.0  # 对冲等待时间的下限（秒）
+
+# 延迟统计配置：每轮对话的排队、首 token、生成速度、保存消息和界面渲染耗时保存在 turn_metrics 表中
+METRICS_ENABLED = True  # 是否记录延迟统计
+METRICS_RETENTION_DAYS = 30  # 统计记录保留的天数，启动时删除更早的记录
+METRICS_STATS_DAYS = 7  # 统计面板汇总最近多少天的记录
+
 # 主题列表
 THEMES = [
     "浅色主题",
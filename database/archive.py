@@ -0,0 +1,45 @@
+"""
+冷数据归档库
+
+长时间未活动的对话会把消息从 chat_history 移到通过 ATTACH 挂载的归档库中，
+conversations 表中保留对话记录（archived_at 不为空）作为存根，读取时再移回主库。
+归档库只保存消息，不建全文索引，归档中的对话在移回主库前不会出现在搜索结果里。
+"""
+
+ARCHIVE_SCHEMA = "archive"
+
+
+def init_archive_schema(conn, schema=ARCHIVE_SCHEMA):
+    """在归档库中创建消息表"""
+    conn.execute(f'''
+        CREATE TABLE IF NOT EXISTS {schema}.chat_history (
+            id INTEGER PRIMARY KEY,
+            user_id INTEGER,
+            conversation_id INTEGER,
+            message TEXT NOT NULL,
+            is_user BOOLEAN NOT NULL,
+            timestamp TIMESTAMP,
+            codec TEXT,
+            raw_size INTEGER,
+            token_count INTEGER,
+            truncated INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    # 早期创建的归档库没有 token_count、truncated 列
+    columns = [row[1] for row in conn.execute(f"PRAGMA {schema}.table_info(chat_history)")]
+    if "token_count" not in columns:
+        conn.execute(f"ALTER TABLE {schema}.chat_history ADD COLUMN token_count INTEGER")
+    if "truncated" not in columns:
+        conn.execute(f"ALTER TABLE {schema}.chat_history ADD COLUMN truncated INTEGER NOT NULL DEFAULT 0")
+    conn.execute(f'''
+        CREATE INDEX IF NOT EXISTS {schema}.idx_archive_chat_history_conversation
+        ON chat_history (conversation_id)
+    ''')
+    conn.execute(f'''
+        CREATE INDEX IF NOT EXISTS {schema}.idx_archive_chat_history_user
+        ON chat_history (user_id)
+    ''')
+
+
+# 主库与归档库之间搬运消息时复制的列
+ARCHIVE_COLUMNS = "id, user_id, conversation_id, message, is_user, timestamp, codec, raw_size, token_count, truncated"
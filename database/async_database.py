@@ -0,0 +1,41 @@
+"""
+ChatDatabase 的异步包装
+
+数据库操作在专用线程池中执行，协程中 await 调用不会阻塞事件循环。
+线程池大小固定，每个线程复用自己的数据库连接（见 ConnectionManager）。
+
+用法:
+    adb = AsyncChatDatabase(db)
+    history = await adb.get_conversation_tail(auth_code, conversation_id)
+"""
+
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+
+class AsyncChatDatabase:
+    def __init__(self, db, max_workers=4):
+        self.db = db
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="AsyncDB")
+
+    async def run(self, func, *args, **kwargs):
+        """在数据库线程池中执行任意同步函数（可以是 ChatDatabase 之外的函数）"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(func, *args, **kwargs))
+
+    def __getattr__(self, name):
+        attr = getattr(self.db, name)
+        if not callable(attr):
+            return attr
+
+        async def call(*args, **kwargs):
+            return await self.run(attr, *args, **kwargs)
+
+        call.__name__ = name
+        call.__doc__ = attr.__doc__
+        return call
+
+    def close(self):
+        """关闭线程池，不关闭底层数据库"""
+        self._executor.shutdown(wait=True)
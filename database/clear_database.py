@@ -12,6 +12,11 @@ def clear_database(db_path="chat_history.db"):
     
     # 删除所有聊天历史记录
     cursor.execute("DELETE FROM chat_history")
+    # 压缩存储的消息不经过触发器，直接清空全文索引
+    try:
+        cursor.execute("INSERT INTO chat_history_fts (chat_history_fts) VALUES ('delete-all')")
+    except sqlite3.OperationalError:
+        pass
     print("已清空聊天历史记录")
     
     # 删除所有对话
@@ -0,0 +1,80 @@
+"""
+消息正文压缩
+
+超过阈值的消息以压缩后的 BLOB 存入 chat_history.message，codec 列记录压缩算法，
+codec 为 NULL 表示原始文本。zstd 需要安装 zstandard，未安装时只能使用 zlib。
+"""
+
+import zlib
+import os
+import sys
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# 获取当前文件的目录
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+# 将项目根目录添加到sys.path
+ROOT_DIR = os.path.dirname(CURRENT_DIR)
+sys.path.append(ROOT_DIR)
+
+from config.settings import (
+    MESSAGE_COMPRESSION_CODEC, MESSAGE_COMPRESSION_THRESHOLD, MESSAGE_COMPRESSION_LEVEL
+)
+
+
+def available_codecs():
+    """当前环境可用的压缩算法"""
+    codecs = ["zlib"]
+    if zstandard is not None:
+        codecs.append("zstd")
+    return codecs
+
+
+def _compress(data, codec, level):
+    if codec == "zlib":
+        return zlib.compress(data, level)
+    if codec == "zstd":
+        if zstandard is None:
+            raise ValueError("使用 zstd 压缩需要安装 zstandard")
+        return zstandard.ZstdCompressor(level=level).compress(data)
+    raise ValueError(f"不支持的压缩算法: {codec}")
+
+
+def encode_message(text, codec=None, threshold=None, level=None):
+    """编码待存储的消息，返回 (存储值, codec, 原始字节数)
+
+    未达到阈值或压缩后没有变小时按原文存储，codec 为 None。
+    """
+    codec = MESSAGE_COMPRESSION_CODEC if codec is None else codec
+    threshold = MESSAGE_COMPRESSION_THRESHOLD if threshold is None else threshold
+    level = MESSAGE_COMPRESSION_LEVEL if level is None else level
+
+    data = text.encode("utf-8")
+    if not codec or len(data) < threshold:
+        return text, None, len(data)
+
+    compressed = _compress(data, codec, level)
+    if len(compressed) >= len(data):
+        return text, None, len(data)
+    return compressed, codec, len(data)
+
+
+def decode_message(value, codec):
+    """还原存储的消息正文"""
+    if codec is None:
+        return value
+    if codec == "zlib":
+        return zlib.decompress(value).decode("utf-8")
+    if codec == "zstd":
+        if zstandard is None:
+            raise ValueError("读取 zstd 压缩的消息需要安装 zstandard")
+        return zstandard.ZstdDecompressor().decompress(value).decode("utf-8")
+    raise ValueError(f"不支持的压缩算法: {codec}")
+
+
+def register_sql_functions(conn):
+    """注册 SQL 函数 message_text(message, codec)，全文索引的内容视图和短关键词搜索依赖该函数"""
+    conn.create_function("message_text", 2, decode_message, deterministic=True)
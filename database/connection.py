@@ -0,0 +1,116 @@
+import sqlite3
+import threading
+import os
+import sys
+from contextlib import contextmanager
+
+# 获取当前文件的目录
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+# 将项目根目录添加到sys.path
+ROOT_DIR = os.path.dirname(CURRENT_DIR)
+sys.path.append(ROOT_DIR)
+
+from config.settings import (
+    DB_CACHE_SIZE_KB, DB_SYNCHRONOUS, DB_STATEMENT_CACHE_SIZE, DB_BUSY_TIMEOUT_MS
+)
+from database.compression import register_sql_functions
+
+
+class ConnectionManager:
+    """按线程复用的 SQLite 连接管理器
+
+    GUI 线程和 StreamChatWorker 线程都会访问数据库，sqlite3 连接不能安全地
+    跨线程共享，因此每个线程持有一个长期连接，避免每次查询都重新打开文件。
+    """
+    def __init__(self, db_path, cache_size_kb=None, synchronous=None,
+                 statement_cache_size=None, busy_timeout_ms=None, attachments=None):
+        """attachments: {schema名: 数据库路径}，每个新连接都会 ATTACH 这些数据库"""
+        self.db_path = db_path
+        self.attachments = dict(attachments or {})
+        self.cache_size_kb = cache_size_kb or DB_CACHE_SIZE_KB
+        self.synchronous = synchronous or DB_SYNCHRONOUS
+        self.statement_cache_size = statement_cache_size or DB_STATEMENT_CACHE_SIZE
+        self.busy_timeout_ms = busy_timeout_ms or DB_BUSY_TIMEOUT_MS
+
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        # 线程ID -> 连接，用于统一关闭
+        self._connections = {}
+
+    def _connect(self):
+        """创建新连接并应用 PRAGMA 配置"""
+        conn = sqlite3.connect(
+            self.db_path,
+            timeout=self.busy_timeout_ms / 1000,
+            # 连接只会在创建它的线程中使用，关闭时可能来自其他线程
+            check_same_thread=False,
+            # 复用预编译语句
+            cached_statements=self.statement_cache_size,
+            # 自动提交模式，事务由 transaction() 显式控制
+            isolation_level=None,
+        )
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(f"PRAGMA synchronous={self.synchronous}")
+        # 负数表示以 KB 为单位
+        conn.execute(f"PRAGMA cache_size=-{int(self.cache_size_kb)}")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        # 启用外键约束，删除对话时级联删除历史记录
+        conn.execute("PRAGMA foreign_keys=ON")
+        # 触发器和视图中使用的自定义函数
+        register_sql_functions(conn)
+        for schema, path in self.attachments.items():
+            conn.execute(f"ATTACH DATABASE ? AS {schema}", (path,))
+            conn.execute(f"PRAGMA {schema}.journal_mode=WAL")
+            conn.execute(f"PRAGMA {schema}.synchronous={self.synchronous}")
+        return conn
+
+    def get_connection(self):
+        """获取当前线程的连接（不存在时创建）"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._connect()
+            self._local.conn = conn
+            with self._lock:
+                self._connections[threading.get_ident()] = conn
+        return conn
+
+    @contextmanager
+    def transaction(self):
+        """在当前线程的连接上开启写事务，嵌套调用时复用外层事务"""
+        conn = self.get_connection()
+        if conn.in_transaction:
+            yield conn
+            return
+
+        # IMMEDIATE 提前获取写锁，避免 WAL 下读锁升级写锁时的 SQLITE_BUSY
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.rollback()
+            raise
+        else:
+            conn.commit()
+
+    def release(self):
+        """关闭当前线程的连接（线程结束前调用）"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            return
+        self._local.conn = None
+        with self._lock:
+            self._connections.pop(threading.get_ident(), None)
+        conn.close()
+
+    def close_all(self):
+        """关闭所有线程的连接"""
+        with self._lock:
+            connections = list(self._connections.values())
+            self._connections.clear()
+        for conn in connections:
+            try:
+                conn.close()
+            except sqlite3.Error:
+                pass
+        self._local = threading.local()
@@ -1,6 +1,8 @@
 import sqlite3
 import os
 import sys
+import threading
+import atexit
 
 # 获取当前文件的目录
 CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -8,119 +10,163 @@ CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
 ROOT_DIR = os.path.dirname(CURRENT_DIR)
 sys.path.append(ROOT_DIR)
 
-from config.settings import DATABASE_PATH
+from config.settings import (
+    DATABASE_PATH, DB_WRITE_BEHIND_ENABLED, DB_WRITE_BATCH_SIZE, DB_WRITE_RETRY_BASE_DELAY, DB_WRITE_RETRY_MAX_DELAY,
+    DB_WRITE_MAX_RETRIES, ARCHIVE_DATABASE_PATH, ARCHIVE_IDLE_DAYS
+)
+from database.connection import ConnectionManager
+from database.migrations import migrate
+from database.write_queue import MessageWriteQueue
+from database.compression import encode_message, decode_message
+from database.archive import ARCHIVE_SCHEMA, ARCHIVE_COLUMNS, init_archive_schema
+from utils.tokenizer import count_tokens, count_message_tokens, truncate_tokens, MESSAGE_TOKEN_OVERHEAD
 from utils.logger import Logger
 
 class ChatDatabase:
-    def __init__(self, db_path=None):
+    def __init__(self, db_path=None, write_behind=None, archive_path=None):
         """初始化数据库连接"""
         self.db_path = db_path or DATABASE_PATH
         self.logger = Logger()  # 初始化日志记录器
+        
+        # 归档库默认与主库放在一起，使用非默认主库时（如测试）不与默认归档库混用
+        if archive_path is None and ARCHIVE_DATABASE_PATH:
+            if self.db_path == DATABASE_PATH:
+                archive_path = ARCHIVE_DATABASE_PATH
+            else:
+                archive_path = os.path.splitext(self.db_path)[0] + "_archive.db"
+        self.archive_path = archive_path
+        attachments = {ARCHIVE_SCHEMA: archive_path} if archive_path else None
+        
+        # 每个线程复用一个连接，避免每次操作都重新打开数据库
+        self.connections = ConnectionManager(self.db_path, attachments=attachments)
+        # 授权码 -> 用户ID 的缓存，映射创建后不会改变，每个授权码只查询一次数据库
+        self._user_cache = {}
+        self._user_cache_lock = threading.Lock()
+        self.user_cache_hits = 0
+        self.user_cache_misses = 0
         self.init_db()
+        
+        # 对话消息异步批量写入
+        if write_behind is None:
+            write_behind = DB_WRITE_BEHIND_ENABLED
+        self.write_queue = None
+        if write_behind:
+            self.write_queue = MessageWriteQueue(
+                self.connections, self._insert_messages, self.logger, batch_size=DB_WRITE_BATCH_SIZE,
+                retry_base_delay=DB_WRITE_RETRY_BASE_DELAY, retry_max_delay=DB_WRITE_RETRY_MAX_DELAY,
+                max_retries=DB_WRITE_MAX_RETRIES)
+        # 进程退出时确保队列中的消息全部落盘
+        atexit.register(self.close)
     
     def init_db(self):
-        """创建数据库表"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        # 创建用户表
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                auth_code TEXT UNIQUE NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        # 创建对话列表
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS conversations (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                title TEXT NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users (id)
-            )
-        ''')
-        
-        # 创建对话历史表（如果不存在）
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS chat_history (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                conversation_id INTEGER,
-                message TEXT NOT NULL,
-                is_user BOOLEAN NOT NULL,
-                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users (id),
-                FOREIGN KEY (conversation_id) REFERENCES conversations (id)
-            )
-        ''')
-        
-        # 检查并添加 conversation_id 列到 chat_history 表
+        """创建数据库表并执行未应用的结构迁移"""
+        conn = self.connections.get_connection()
         try:
-            cursor.execute("ALTER TABLE chat_history ADD COLUMN conversation_id INTEGER REFERENCES conversations (id)")
-        except sqlite3.OperationalError as e:
-            # 列已存在，忽略错误
-            if "duplicate column name" not in str(e):
-                error_msg = f"初始化数据库时出错: {str(e)}"
-                self.logger.log_exception(error_msg)
-                raise
-        
-        conn.commit()
-        conn.close()
+            migrate(conn)
+            if self.archive_path:
+                init_archive_schema(conn)
+        except sqlite3.Error as e:
+            error_msg = f"初始化数据库时出错: {str(e)}"
+            self.logger.log_exception(error_msg)
+            raise
+    
+    def close(self):
+        """写完待保存的消息并关闭所有线程的数据库连接"""
+        if self.write_queue is not None:
+            self.write_queue.close()
+        self.connections.close_all()
+    
+    def flush(self):
+        """等待所有待写入的消息落盘，写入失败正在重试时返回 False（读取结果不包含这些消息）"""
+        if self.write_queue is not None:
+            return self.write_queue.flush()
+        return True
+    
+    def get_write_queue_stats(self):
+        """异步写入队列的待写入数、丢弃数和正在重试的错误，未启用异步写入时返回 None"""
+        return self.write_queue.stats() if self.write_queue is not None else None
+    
+    def _wait_for_conversation(self, conversation_id):
+        """读取对话前等待该对话待写入的消息落盘"""
+        if self.write_queue is not None:
+            return self.write_queue.wait_for_conversation(conversation_id)
+        return True
+    
+    def release_connection(self):
+        """释放当前线程的数据库连接（工作线程结束前调用）"""
+        self.connections.release()
     
     def update_conversation_title(self, auth_code, conversation_id, new_title):
         """更新对话标题"""
         user_id = self.get_or_create_user(auth_code)
         
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute("""
+        conn = self.connections.get_connection()
+        conn.execute("""
             UPDATE conversations 
             SET title = ? 
             WHERE id = ? AND user_id = ?
         """, (new_title, conversation_id, user_id))
-        
-        conn.commit()
-        conn.close()
     
     def get_or_create_user(self, auth_code):
-        """获取或创建用户"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        """获取或创建用户（结果会被缓存）"""
+        user_id = self._user_cache.get(auth_code)
+        if user_id is not None:
+            with self._user_cache_lock:
+                self.user_cache_hits += 1
+            return user_id
+        
+        # 未命中时加锁，保证多个线程同时请求同一授权码时只解析一次
+        with self._user_cache_lock:
+            user_id = self._user_cache.get(auth_code)
+            if user_id is not None:
+                self.user_cache_hits += 1
+                return user_id
+            
+            self.user_cache_misses += 1
+            user_id = self._resolve_user(auth_code)
+            self._user_cache[auth_code] = user_id
+            return user_id
+    
+    def _resolve_user(self, auth_code):
+        """从数据库查询用户ID，不存在时创建"""
+        conn = self.connections.get_connection()
         
         # 尝试获取现有用户
-        cursor.execute("SELECT id FROM users WHERE auth_code = ?", (auth_code,))
-        user = cursor.fetchone()
+        user = conn.execute("SELECT id FROM users WHERE auth_code = ?", (auth_code,)).fetchone()
+        if user is not None:
+            return user[0]
         
-        if user is None:
-            # 创建新用户
-            cursor.execute("INSERT INTO users (auth_code) VALUES (?)", (auth_code,))
-            conn.commit()
-            user_id = cursor.lastrowid
-        else:
-            user_id = user[0]
+        # 创建新用户，其他进程可能同时创建了同一用户，因此忽略唯一约束冲突
+        with self.connections.transaction() as conn:
+            conn.execute("INSERT OR IGNORE INTO users (auth_code) VALUES (?)", (auth_code,))
+            user = conn.execute("SELECT id FROM users WHERE auth_code = ?", (auth_code,)).fetchone()
         
-        conn.close()
-        return user_id
+        return user[0]
+    
+    def get_user_cache_stats(self):
+        """获取用户ID缓存的命中统计"""
+        with self._user_cache_lock:
+            total = self.user_cache_hits + self.user_cache_misses
+            return {
+                "hits": self.user_cache_hits,
+                "misses": self.user_cache_misses,
+                "size": len(self._user_cache),
+                "hit_rate": self.user_cache_hits / total if total else 0.0,
+            }
+    
+    def clear_user_cache(self):
+        """清空用户ID缓存（外部修改了 users 表后调用）"""
+        with self._user_cache_lock:
+            self._user_cache.clear()
     
     def save_message(self, auth_code, message, is_user):
-        """保存对话消息"""
+        """保存不属于任何对话的消息"""
         try:
             user_id = self.get_or_create_user(auth_code)
             
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            
-            cursor.execute("""
-                INSERT INTO chat_history (user_id, message, is_user) 
-                VALUES (?, ?, ?)
-            """, (user_id, message, is_user))
-            
-            conn.commit()
-            conn.close()
+            # 与对话消息共用写入逻辑，压缩存储的消息同样需要加入全文索引
+            with self.connections.transaction() as conn:
+                self._insert_messages(conn, [(user_id, None, message, is_user, False)])
         except Exception as e:
             error_msg = f"保存消息时出错: {str(e)}"
             self.logger.log_exception(error_msg)
@@ -130,132 +176,740 @@ class ChatDatabase:
         """获取用户的对话历史"""
         try:
             user_id = self.get_or_create_user(auth_code)
+            self.flush()
             
-            conn = sqlite3.connect(self.db_path)
-            conn.row_factory = sqlite3.Row  # 使结果可以通过列名访问
-            cursor = conn.cursor()
-            
-            cursor.execute("""
-                SELECT message, is_user, timestamp 
+            conn = self.connections.get_connection()
+            cursor = conn.execute("""
+                SELECT message, codec, is_user, timestamp 
                 FROM chat_history 
                 WHERE user_id = ? 
-                ORDER BY timestamp ASC 
+                ORDER BY id ASC 
                 LIMIT ?
             """, (user_id, limit))
             
             history = cursor.fetchall()
-            conn.close()
             
             # 转换为字典列表
-            return [dict(row) for row in history]
+            return self._decode_rows(history)
         except Exception as e:
             error_msg = f"获取聊天历史时出错: {str(e)}"
             self.logger.log_exception(error_msg)
             raise
     
     def clear_user_history(self, auth_code):
-        """清除用户的对话历史"""
+        """清除用户的对话历史
+
+        ChatCore 缓存了对话历史，应通过 ChatCore.clear_user_history 调用，以同时清除缓存。
+        """
         user_id = self.get_or_create_user(auth_code)
+        self.flush()
         
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute("DELETE FROM chat_history WHERE user_id = ?", (user_id,))
-        
-        conn.commit()
-        conn.close()
+        with self.connections.transaction() as conn:
+            self.unindex_compressed_messages(conn, "user_id = ?", (user_id,))
+            conn.execute("DELETE FROM chat_history WHERE user_id = ?", (user_id,))
+            conn.execute("""
+                DELETE FROM conversation_summaries
+                WHERE conversation_id IN (SELECT id FROM conversations WHERE user_id = ?)
+            """, (user_id,))
+            if self.archive_path:
+                conn.execute(f"DELETE FROM {ARCHIVE_SCHEMA}.chat_history WHERE user_id = ?", (user_id,))
     
     def create_conversation(self, auth_code, title):
         """为用户创建新对话"""
         try:
             user_id = self.get_or_create_user(auth_code)
             
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            
-            cursor.execute("""
+            conn = self.connections.get_connection()
+            cursor = conn.execute("""
                 INSERT INTO conversations (user_id, title) 
                 VALUES (?, ?)
             """, (user_id, title))
             
-            conn.commit()
-            conversation_id = cursor.lastrowid
-            conn.close()
-            
-            return conversation_id
+            return cursor.lastrowid
         except Exception as e:
             error_msg = f"创建对话时出错: {str(e)}"
             self.logger.log_exception(error_msg)
             raise
     
     def get_user_conversations(self, auth_code):
-        """获取用户的所有对话"""
-        user_id = self.get_or_create_user(auth_code)
+        """获取用户的所有对话，按最后活动时间从新到旧排列
         
-        conn = sqlite3.connect(self.db_path)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
+        message_count、last_message_at、last_snippet 由触发器维护，无需聚合查询。
+        """
+        user_id = self.get_or_create_user(auth_code)
+        # 让排队中的消息落盘，保证统计值是最新的
+        self.flush()
         
-        cursor.execute("""
-            SELECT id, title, created_at
+        conn = self.connections.get_connection()
+        cursor = conn.execute("""
+            SELECT id, title, created_at, message_count, last_message_at, last_snippet
             FROM conversations 
             WHERE user_id = ?
-            ORDER BY created_at DESC
+            ORDER BY COALESCE(last_message_at, created_at) DESC, id DESC
         """, (user_id,))
         
         conversations = cursor.fetchall()
-        conn.close()
         
         return [dict(row) for row in conversations]
     
     def get_conversation_history(self, auth_code, conversation_id, limit=50, offset=0):
         """获取特定对话的历史记录（支持分页）"""
         user_id = self.get_or_create_user(auth_code)
+        self._wait_for_conversation(conversation_id)
+        self._ensure_hot(conversation_id)
         
-        conn = sqlite3.connect(self.db_path)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        
-        cursor.execute("""
-            SELECT message, is_user, timestamp 
+        conn = self.connections.get_connection()
+        cursor = conn.execute("""
+            SELECT id, message, codec, is_user, timestamp, truncated 
             FROM chat_history 
             WHERE user_id = ? AND conversation_id = ?
-            ORDER BY timestamp ASC 
+            ORDER BY id ASC 
             LIMIT ? OFFSET ?
         """ , (user_id, conversation_id, limit, offset))
         
         history = cursor.fetchall()
-        conn.close()
         
-        return [dict(row) for row in history]
+        return self._decode_rows(history)
+    
+    def get_conversation_messages(self, auth_code, conversation_id, before_id=None, after_id=None,
+                                  limit=50, newest_first=True):
+        """按消息ID游标分页获取对话消息
+        
+        before_id / after_id 为上一页边界消息的ID（不包含边界本身），
+        newest_first 为 True 时从新到旧返回，否则从旧到新返回。
+        每一页都是索引上的一次范围扫描，与翻页深度无关。
+        """
+        user_id = self.get_or_create_user(auth_code)
+        self._wait_for_conversation(conversation_id)
+        self._ensure_hot(conversation_id)
+        
+        conditions = ["user_id = ?", "conversation_id = ?"]
+        params = [user_id, conversation_id]
+        if before_id is not None:
+            conditions.append("id < ?")
+            params.append(before_id)
+        if after_id is not None:
+            conditions.append("id > ?")
+            params.append(after_id)
+        order = "DESC" if newest_first else "ASC"
+        params.append(limit)
+        
+        conn = self.connections.get_connection()
+        cursor = conn.execute(f"""
+            SELECT id, message, codec, is_user, timestamp, truncated 
+            FROM chat_history 
+            WHERE {" AND ".join(conditions)}
+            ORDER BY id {order} 
+            LIMIT ?
+        """, params)
+        
+        return self._decode_rows(cursor.fetchall())
+    
+    def get_conversation_tail(self, auth_code, conversation_id, limit=50):
+        """获取对话最近的 limit 条消息（按时间从旧到新排列）"""
+        history = self.get_conversation_messages(auth_code, conversation_id, limit=limit, newest_first=True)
+        history.reverse()
+        return history
+    
+    def get_conversation_context(self, auth_code, conversation_id, max_tokens, after_id=None, page_size=64):
+        """获取总 token 数不超过 max_tokens 的最近消息（按时间从旧到新排列）
+        
+        从最新的消息往前累加 token_count，超出预算即停止，只解压被选中的消息；
+        最新的一条消息一定会返回，单独超出预算时只保留末尾（见 utils.tokenizer.truncate_tokens）；
+        after_id 不为空时只取该ID之后的消息（如已合并进摘要的消息不再重复发送）。
+        返回的每条消息包含 token_count，为空的旧消息在这里计算一次并写回数据库。
+        """
+        user_id = self.get_or_create_user(auth_code)
+        self._wait_for_conversation(conversation_id)
+        self._ensure_hot(conversation_id)
+        
+        conn = self.connections.get_connection()
+        selected = []
+        computed = []
+        used = 0
+        before_id = None
+        exhausted = False
+        while not exhausted:
+            cursor = conn.execute("""
+                SELECT id, message, codec, is_user, timestamp, token_count 
+                FROM chat_history 
+                WHERE user_id = ? AND conversation_id = ?
+                  AND id < COALESCE(?, 9223372036854775807) AND id > COALESCE(?, 0)
+                ORDER BY id DESC 
+                LIMIT ?
+            """, (user_id, conversation_id, before_id, after_id, page_size))
+            rows = cursor.fetchall()
+            if len(rows) < page_size:
+                exhausted = True
+            
+            for row in rows:
+                entry = dict(row)
+                message = decode_message(entry['message'], entry.pop('codec'))
+                token_count = entry['token_count']
+                if token_count is None:
+                    token_count = entry['token_count'] = count_tokens(message)
+                    computed.append((token_count, entry['id']))
+                
+                cost = count_message_tokens(token_count)
+                if used + cost > max_tokens:
+                    if not selected:
+                        # 最新的一条消息（通常是本轮的问题）单独就超出预算时截断后保留
+                        entry['message'] = truncate_tokens(message, max_tokens - MESSAGE_TOKEN_OVERHEAD)
+                        entry['token_count'] = count_tokens(entry['message'])
+                        selected.append(entry)
+                    exhausted = True
+                    break
+                used += cost
+                entry['message'] = message
+                selected.append(entry)
+                before_id = entry['id']
+        
+        if computed:
+            try:
+                with self.connections.transaction() as conn:
+                    conn.executemany("UPDATE chat_history SET token_count = ? WHERE id = ?", computed)
+            except sqlite3.Error as e:
+                # 写回失败不影响本次结果，下次读取时会重新计算
+                self.logger.log_exception(f"保存消息 token 数时出错: {str(e)}")
+        
+        selected.reverse()
+        return selected
+    
+    def get_conversation_summary(self, conversation_id):
+        """获取对话的滚动摘要，返回包含 summary、watermark_id、updated_at 的字典，没有摘要时返回 None"""
+        conn = self.connections.get_connection()
+        row = conn.execute("""
+            SELECT summary, watermark_id, updated_at 
+            FROM conversation_summaries 
+            WHERE conversation_id = ?
+        """, (conversation_id,)).fetchone()
+        return dict(row) if row else None
+    
+    def save_conversation_summary(self, conversation_id, summary, watermark_id):
+        """保存对话摘要，只有 watermark_id 比已保存的更新时才覆盖，返回是否写入"""
+        with self.connections.transaction() as conn:
+            cursor = conn.execute("""
+                INSERT INTO conversation_summaries (conversation_id, summary, watermark_id) 
+                VALUES (?, ?, ?)
+                ON CONFLICT (conversation_id) DO UPDATE SET 
+                    summary = excluded.summary,
+                    watermark_id = excluded.watermark_id,
+                    updated_at = CURRENT_TIMESTAMP
+                WHERE excluded.watermark_id > conversation_summaries.watermark_id
+            """, (conversation_id, summary, watermark_id))
+            return cursor.rowcount > 0
     
     def delete_conversation(self, auth_code, conversation_id):
         """删除对话及其相关历史记录"""
         user_id = self.get_or_create_user(auth_code)
+        # 先等待排队中的消息写入，避免删除后再插入孤立记录
+        self._wait_for_conversation(conversation_id)
         
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        # 历史记录通过外键 ON DELETE CASCADE 一并删除，压缩消息的全文索引需要先删除
+        with self.connections.transaction() as conn:
+            if conn.execute("SELECT 1 FROM conversations WHERE id = ? AND user_id = ?",
+                            (conversation_id, user_id)).fetchone():
+                self.unindex_compressed_messages(conn, "conversation_id = ?", (conversation_id,))
+            cursor = conn.execute("DELETE FROM conversations WHERE id = ? AND user_id = ?", (conversation_id, user_id))
+            # 归档库不受外键约束，需要单独删除
+            if self.archive_path and cursor.rowcount:
+                conn.execute(f"DELETE FROM {ARCHIVE_SCHEMA}.chat_history WHERE conversation_id = ?", (conversation_id,))
+    
+    def archive_idle_conversations(self, idle_days=None, auth_code=None):
+        """把闲置超过 idle_days 天的对话移入归档库，返回归档的对话数
         
-        # 删除对话相关的历史记录
-        cursor.execute("DELETE FROM chat_history WHERE user_id = ? AND conversation_id = ?", (user_id, conversation_id))
+        auth_code 为空时处理所有用户。对话的最后活动时间取最后一条消息的时间，
+        没有消息时取创建时间。idle_days 必须大于 0，可以是小数。
+        """
+        idle_days = ARCHIVE_IDLE_DAYS if idle_days is None else idle_days
+        # 0 或负数会把所有对话（包括正在使用的）都移入归档库
+        if not idle_days > 0:
+            raise ValueError(f"idle_days 必须大于 0: {idle_days!r}")
+        if not self.archive_path:
+            return 0
         
-        # 删除对话
-        cursor.execute("DELETE FROM conversations WHERE id = ? AND user_id = ?", (conversation_id, user_id))
+        params = []
+        user_filter = ""
+        if auth_code is not None:
+            user_filter = "AND c.user_id = ?"
+            params.append(self.get_or_create_user(auth_code))
+        params.append(f"-{float(idle_days)} days")
         
-        conn.commit()
-        conn.close()
+        conn = self.connections.get_connection()
+        rows = conn.execute(f"""
+            SELECT c.id FROM conversations c
+            WHERE c.archived_at IS NULL {user_filter}
+              AND COALESCE((
+                  SELECT h.timestamp FROM chat_history h
+                  WHERE h.conversation_id = c.id AND h.user_id = c.user_id
+                  ORDER BY h.id DESC LIMIT 1
+              ), c.created_at) < datetime('now', ?)
+        """, params).fetchall()
+        
+        archived = 0
+        for row in rows:
+            try:
+                self.archive_conversation(row['id'])
+                archived += 1
+            except sqlite3.Error as e:
+                self.logger.log_exception(f"归档对话 {row['id']} 时出错: {str(e)}")
+        return archived
+    
+    def archive_conversation(self, conversation_id):
+        """把对话的消息移入归档库，对话记录保留在主库中作为存根"""
+        if not self.archive_path:
+            return
+        self._wait_for_conversation(conversation_id)
+        
+        # 跨库事务在 WAL 模式下不保证整体原子性，因此先提交复制，再删除主库数据；
+        # 中途失败最多在归档库留下副本，下次归档时会被覆盖
+        with self.connections.transaction() as conn:
+            conn.execute(f"""
+                INSERT OR REPLACE INTO {ARCHIVE_SCHEMA}.chat_history ({ARCHIVE_COLUMNS})
+                SELECT {ARCHIVE_COLUMNS} FROM main.chat_history WHERE conversation_id = ?
+            """, (conversation_id,))
+        with self.connections.transaction() as conn:
+            conn.execute("UPDATE conversations SET archived_at = CURRENT_TIMESTAMP WHERE id = ?", (conversation_id,))
+            self.unindex_compressed_messages(conn, "conversation_id = ?", (conversation_id,))
+            conn.execute("DELETE FROM main.chat_history WHERE conversation_id = ?", (conversation_id,))
     
-    def save_message_to_conversation(self, auth_code, conversation_id, message, is_user):
-        """保存对话消息到特定对话"""
+    def _ensure_hot(self, conversation_id):
+        """读取对话前，如果对话已归档则把消息移回主库"""
+        if not self.archive_path:
+            return
+        conn = self.connections.get_connection()
+        row = conn.execute("SELECT archived_at FROM conversations WHERE id = ?", (conversation_id,)).fetchone()
+        if row is None or row['archived_at'] is None:
+            return
+        
+        # 与归档相反：先复制回主库并清除归档标记，再删除归档库中的副本
+        with self.connections.transaction() as conn:
+            conn.execute(f"""
+                INSERT OR IGNORE INTO main.chat_history ({ARCHIVE_COLUMNS})
+                SELECT {ARCHIVE_COLUMNS} FROM {ARCHIVE_SCHEMA}.chat_history WHERE conversation_id = ?
+            """, (conversation_id,))
+            self.index_compressed_messages(
+                conn, f"conversation_id = ? AND id IN (SELECT id FROM {ARCHIVE_SCHEMA}.chat_history WHERE conversation_id = ?)",
+                (conversation_id, conversation_id))
+            conn.execute("UPDATE conversations SET archived_at = NULL WHERE id = ?", (conversation_id,))
+        with self.connections.transaction() as conn:
+            conn.execute(f"DELETE FROM {ARCHIVE_SCHEMA}.chat_history WHERE conversation_id = ?", (conversation_id,))
+    
+    def search_messages(self, auth_code, query, limit=20, highlight=("【", "】")):
+        """在用户的所有对话中全文搜索消息，按相关度返回带高亮片段的结果
+        
+        每条结果包含 id、conversation_id、title、is_user、timestamp 和 snippet。
+        """
+        terms = query.split()
+        if not terms:
+            return []
+        
         user_id = self.get_or_create_user(auth_code)
+        # 搜索前让排队中的消息落盘，保证刚发送的消息也能被搜到
+        self.flush()
+        
+        conn = self.connections.get_connection()
+        
+        # trigram 分词至少需要3个字符，更短的关键词只能逐行匹配
+        if self._fts_tokenizer(conn) == "trigram" and min(len(term) for term in terms) < 3:
+            return self._search_messages_by_scan(conn, user_id, terms, limit, highlight)
+        
+        # 每个关键词作为短语匹配，避免用户输入被当成 FTS 查询语法
+        match_query = " ".join('"{}"'.format(term.replace('"', '""')) for term in terms)
+        cursor = conn.execute("""
+            SELECT h.id, h.conversation_id, c.title, h.is_user, h.timestamp,
+                   snippet(chat_history_fts, 0, ?, ?, '…', 32) AS snippet
+            FROM chat_history_fts
+            JOIN chat_history h ON h.id = chat_history_fts.rowid
+            JOIN conversations c ON c.id = h.conversation_id
+            WHERE chat_history_fts MATCH ? AND h.user_id = ?
+            ORDER BY chat_history_fts.rank
+            LIMIT ?
+        """, (highlight[0], highlight[1], match_query, user_id, limit))
+        
+        return [dict(row) for row in cursor.fetchall()]
+    
+    def _fts_tokenizer(self, conn):
+        """获取全文索引使用的分词器"""
+        if not hasattr(self, "_fts_tokenizer_name"):
+            row = conn.execute(
+                "SELECT sql FROM sqlite_master WHERE name = 'chat_history_fts'").fetchone()
+            self._fts_tokenizer_name = "trigram" if row and "trigram" in row[0] else "unicode61"
+        return self._fts_tokenizer_name
+    
+    def _search_messages_by_scan(self, conn, user_id, terms, limit, highlight):
+        """逐行匹配短关键词，按时间从新到旧返回"""
+        conditions = " AND ".join("message_text(h.message, h.codec) LIKE ? ESCAPE '\\'" for _ in terms)
+        patterns = [
+            "%" + term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+            for term in terms
+        ]
+        cursor = conn.execute(f"""
+            SELECT h.id, h.conversation_id, c.title, h.is_user, h.timestamp,
+                   message_text(h.message, h.codec) AS message
+            FROM chat_history h
+            JOIN conversations c ON c.id = h.conversation_id
+            WHERE h.user_id = ? AND {conditions}
+            ORDER BY h.id DESC
+            LIMIT ?
+        """, [user_id] + patterns + [limit])
+        
+        results = []
+        for row in cursor.fetchall():
+            result = dict(row)
+            result["snippet"] = self._make_snippet(result.pop("message"), terms[0], highlight)
+            results.append(result)
+        return results
+    
+    @staticmethod
+    def _make_snippet(text, term, highlight, context=16):
+        """截取关键词附近的文本并高亮关键词"""
+        position = text.lower().find(term.lower())
+        if position < 0:
+            return text[:context * 2]
+        start = max(0, position - context)
+        end = min(len(text), position + len(term) + context)
+        return "{}{}{}{}{}{}{}".format(
+            "…" if start > 0 else "",
+            text[start:position],
+            highlight[0],
+            text[position:position + len(term)],
+            highlight[1],
+            text[position + len(term):end],
+            "…" if end < len(text) else "",
+        )
+    
+    def save_message_to_conversation(self, auth_code, conversation_id, message, is_user, truncated=False):
+        """保存对话消息到特定对话（启用异步写入时只入队，立即返回）
+        
+        truncated 为 True 表示生成中途被取消，只保存了部分回答。
+        """
+        user_id = self.get_or_create_user(auth_code)
+        row = (user_id, conversation_id, message, is_user, truncated)
+        
+        if self.write_queue is not None and self.write_queue.put(conversation_id, row):
+            return
+        
+        # 未启用异步写入或队列已关闭时同步写入
+        with self.connections.transaction() as conn:
+            self._insert_messages(conn, [row])
+    
+    def _insert_messages(self, conn, rows):
+        """批量插入对话消息，rows 为 (user_id, conversation_id, message, is_user, truncated) 列表"""
+        encoded_rows = []
+        compressed_conversations = set()
+        # 对话ID -> [本批消息数, 最后一条消息]
+        batch_summary = {}
+        for user_id, conversation_id, message, is_user, truncated in rows:
+            stored, codec, raw_size = encode_message(message)
+            encoded_rows.append((user_id, conversation_id, stored, is_user, codec, raw_size, count_tokens(message),
+                                 int(truncated)))
+            if codec is not None:
+                compressed_conversations.add(conversation_id)
+            summary = batch_summary.setdefault(conversation_id, [0, None])
+            summary[0] += 1
+            summary[1] = message
+        
+        last_id = None
+        if compressed_conversations:
+            last_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM main.chat_history").fetchone()[0]
+        conn.executemany("""
+            INSERT INTO chat_history (user_id, conversation_id, message, is_user, codec, raw_size, token_count, truncated) 
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        """, encoded_rows)
+        if compressed_conversations:
+            self.index_compressed_messages(conn, "id > ?", (last_id,))
+            self.refresh_last_snippets(conn, compressed_conversations)
+        self._update_archived_summaries(conn, batch_summary)
+    
+    @staticmethod
+    def _update_archived_summaries(conn, batch_summary):
+        """消息写入已归档的对话时触发器不更新摘要列（避免搬运消息时重复计数），在这里直接更新
+        
+        batch_summary 为 对话ID -> [本批消息数, 最后一条消息]；之后移回主库时触发器同样跳过，计数不会重复。
+        """
+        conversation_ids = [cid for cid in batch_summary if cid is not None]
+        if not conversation_ids:
+            return
+        placeholders = ", ".join("?" for _ in conversation_ids)
+        archived = conn.execute(f"""
+            SELECT id FROM conversations WHERE archived_at IS NOT NULL AND id IN ({placeholders})
+        """, conversation_ids).fetchall()
+        for row in archived:
+            count, message = batch_summary[row['id']]
+            conn.execute("""
+                UPDATE conversations SET
+                    message_count = message_count + ?,
+                    last_message_at = (
+                        SELECT timestamp FROM main.chat_history WHERE conversation_id = ? ORDER BY id DESC LIMIT 1
+                    ),
+                    last_snippet = ?
+                WHERE id = ?
+            """, (count, row['id'], message[:80], row['id']))
+    
+    @staticmethod
+    def index_compressed_messages(conn, where, params=()):
+        """把满足 where 条件的压缩消息加入全文索引，须在写入这些消息的事务中调用
         
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        触发器不调用 Python 注册的解压函数，只索引原文存储的消息，压缩存储的消息由这里补上。
+        """
+        rows = conn.execute(
+            f"SELECT id, message, codec FROM main.chat_history WHERE codec IS NOT NULL AND {where}", params).fetchall()
+        conn.executemany("INSERT INTO chat_history_fts (rowid, message) VALUES (?, ?)",
+                         [(row['id'], decode_message(row['message'], row['codec'])) for row in rows])
+    
+    @staticmethod
+    def unindex_compressed_messages(conn, where, params=()):
+        """从全文索引中删除满足 where 条件的压缩消息，须在删除这些消息之前、同一事务中调用"""
+        rows = conn.execute(
+            f"SELECT id, message, codec FROM main.chat_history WHERE codec IS NOT NULL AND {where}", params).fetchall()
+        conn.executemany("INSERT INTO chat_history_fts (chat_history_fts, rowid, message) VALUES ('delete', ?, ?)",
+                         [(row['id'], decode_message(row['message'], row['codec'])) for row in rows])
+    
+    @staticmethod
+    def refresh_last_snippets(conn, conversation_ids):
+        """最后一条消息是压缩存储时，触发器无法生成 last_snippet，由这里解压后写入"""
+        for conversation_id in conversation_ids:
+            row = conn.execute("""
+                SELECT message, codec FROM main.chat_history WHERE conversation_id = ?
+                ORDER BY id DESC LIMIT 1
+            """, (conversation_id,)).fetchone()
+            if row is not None and row['codec'] is not None:
+                conn.execute("UPDATE conversations SET last_snippet = ? WHERE id = ? AND archived_at IS NULL",
+                             (decode_message(row['message'], row['codec'])[:80], conversation_id))
+    
+    @staticmethod
+    def _decode_rows(rows):
+        """将查询结果转换为字典列表，并还原压缩存储的消息正文"""
+        result = []
+        for row in rows:
+            entry = dict(row)
+            entry['message'] = decode_message(entry['message'], entry.pop('codec'))
+            result.append(entry)
+        return result
+    
+    def get_storage_stats(self, auth_code=None):
+        """统计每个对话的消息存储情况（原始字节数与实际存储字节数）
         
-        cursor.execute("""
-            INSERT INTO chat_history (user_id, conversation_id, message, is_user) 
-            VALUES (?, ?, ?, ?)
-        """, (user_id, conversation_id, message, is_user))
+        auth_code 为空时统计所有用户。
+        """
+        self.flush()
+        params = []
+        where = ""
+        if auth_code is not None:
+            where = "WHERE h.user_id = ?"
+            params.append(self.get_or_create_user(auth_code))
+        
+        conn = self.connections.get_connection()
+        cursor = conn.execute(f"""
+            SELECT h.conversation_id, c.title,
+                   COUNT(*) AS message_count,
+                   SUM(h.codec IS NOT NULL) AS compressed_count,
+                   SUM(h.raw_size) AS raw_bytes,
+                   SUM(length(CAST(h.message AS BLOB))) AS stored_bytes
+            FROM chat_history h
+            LEFT JOIN conversations c ON c.id = h.conversation_id
+            {where}
+            GROUP BY h.conversation_id
+            ORDER BY raw_bytes DESC
+        """, params)
+        
+        return [dict(row) for row in cursor.fetchall()]
+    
+    def recompress_messages(self, codec=None, threshold=None, batch_size=500):
+        """按当前（或指定的）压缩配置重新编码所有消息，返回被改写的消息数
         
-        conn.commit()
-        conn.close()
\ No newline at end of file
+        codec 传入空字符串表示全部解压为原文。分批在独立事务中处理，可随时中断。
+        """
+        self.flush()
+        conn = self.connections.get_connection()
+        last_id = 0
+        rewritten = 0
+        while True:
+            rows = conn.execute("""
+                SELECT id, message, codec FROM chat_history
+                WHERE id > ? ORDER BY id LIMIT ?
+            """, (last_id, batch_size)).fetchall()
+            if not rows:
+                break
+            last_id = rows[-1]['id']
+            
+            updates = []
+            # 压缩消息的全文索引由这里维护（触发器只处理原文存储的消息）
+            unindex = []
+            index = []
+            for row in rows:
+                text = decode_message(row['message'], row['codec'])
+                stored, new_codec, raw_size = encode_message(text, codec=codec, threshold=threshold)
+                if new_codec != row['codec'] or stored != row['message']:
+                    updates.append((stored, new_codec, raw_size, row['id']))
+                    if row['codec'] is not None:
+                        unindex.append((row['id'], text))
+                    if new_codec is not None:
+                        index.append((row['id'], text))
+            
+            if updates:
+                with self.connections.transaction() as conn:
+                    conn.executemany(
+                        "INSERT INTO chat_history_fts (chat_history_fts, rowid, message) VALUES ('delete', ?, ?)",
+                        unindex)
+                    conn.executemany(
+                        "UPDATE chat_history SET message = ?, codec = ?, raw_size = ? WHERE id = ?", updates)
+                    conn.executemany("INSERT INTO chat_history_fts (rowid, message) VALUES (?, ?)", index)
+                rewritten += len(updates)
+        
+        return rewritten
+    
+    def get_cached_response(self, cache_key, min_created_at, now):
+        """查询回答缓存，创建时间早于 min_created_at 的记录视为过期并删除，命中时返回 (回答正文, 创建时间)"""
+        conn = self.connections.get_connection()
+        row = conn.execute("""
+            SELECT response, codec, created_at 
+            FROM response_cache 
+            WHERE cache_key = ?
+        """, (cache_key,)).fetchone()
+        if row is None:
+            return None
+        
+        with self.connections.transaction() as conn:
+            if row['created_at'] < min_created_at:
+                conn.execute("DELETE FROM response_cache WHERE cache_key = ?", (cache_key,))
+                return None
+            conn.execute("""
+                UPDATE response_cache SET last_hit_at = ?, hit_count = hit_count + 1 
+                WHERE cache_key = ?
+            """, (now, cache_key))
+        return decode_message(row['response'], row['codec']), row['created_at']
+    
+    def save_cached_response(self, cache_key, model, response, now, max_bytes=None, min_created_at=None):
+        """写入回答缓存，并淘汰过期记录和超出 max_bytes 的最久未命中记录"""
+        stored, codec, raw_size = encode_message(response)
+        size = len(stored) if codec else raw_size
+        with self.connections.transaction() as conn:
+            conn.execute("""
+                INSERT OR REPLACE INTO response_cache 
+                    (cache_key, model, response, codec, size, created_at, last_hit_at) 
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            """, (cache_key, model, stored, codec, size, now, now))
+            if min_created_at is not None:
+                conn.execute("DELETE FROM response_cache WHERE created_at < ?", (min_created_at,))
+            if max_bytes is not None:
+                # 按最近命中时间从新到旧累计大小，超出上限的部分删除
+                conn.execute("""
+                    DELETE FROM response_cache WHERE cache_key IN (
+                        SELECT cache_key FROM (
+                            SELECT cache_key, SUM(size) OVER (ORDER BY last_hit_at DESC, cache_key) AS total 
+                            FROM response_cache
+                        ) WHERE total > ?
+                    )
+                """, (max_bytes,))
+    
+    def get_response_cache_stats(self):
+        """回答缓存表的记录数和占用字节数"""
+        conn = self.connections.get_connection()
+        row = conn.execute("""
+            SELECT COUNT(*) AS entries, COALESCE(SUM(size), 0) AS bytes, COALESCE(SUM(hit_count), 0) AS hits 
+            FROM response_cache
+        """).fetchone()
+        return dict(row)
+    
+    def clear_response_cache(self):
+        """清空回答缓存"""
+        with self.connections.transaction() as conn:
+            conn.execute("DELETE FROM response_cache")
+    
+    def add_semantic_cache_entry(self, scope, question, answer, embedding, now):
+        """写入一条语义缓存，embedding 为向量的原始字节，返回记录ID"""
+        stored, codec, _ = encode_message(answer)
+        with self.connections.transaction() as conn:
+            cursor = conn.execute("""
+                INSERT INTO semantic_cache (scope, question, answer, codec, embedding, created_at) 
+                VALUES (?, ?, ?, ?, ?, ?)
+            """, (scope, question, stored, codec, embedding, now))
+            return cursor.lastrowid
+    
+    def get_semantic_cache_entry(self, entry_id):
+        """按ID获取语义缓存的问题和回答，不存在时返回 None"""
+        conn = self.connections.get_connection()
+        row = conn.execute("""
+            SELECT question, answer, codec FROM semantic_cache WHERE id = ?
+        """, (entry_id,)).fetchone()
+        if row is None:
+            return None
+        return {'question': row['question'], 'answer': decode_message(row['answer'], row['codec'])}
+    
+    def get_semantic_cache_extent(self, scope):
+        """某个范围内语义缓存的记录数和最大ID"""
+        conn = self.connections.get_connection()
+        row = conn.execute("""
+            SELECT COUNT(*), COALESCE(MAX(id), 0) FROM semantic_cache WHERE scope = ?
+        """, (scope,)).fetchone()
+        return row[0], row[1]
+    
+    def iter_semantic_cache_embeddings(self, scope, batch_size=2000):
+        """按ID顺序逐条生成某个范围内的 (ID, 向量字节)"""
+        conn = self.connections.get_connection()
+        cursor = conn.execute("""
+            SELECT id, embedding FROM semantic_cache WHERE scope = ? ORDER BY id
+        """, (scope,))
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                return
+            for row in rows:
+                yield row['id'], row['embedding']
+    
+    def clear_semantic_cache(self):
+        """清空语义缓存"""
+        with self.connections.transaction() as conn:
+            conn.execute("DELETE FROM semantic_cache")
+    
+    def save_turn_metrics(self, row):
+        """保存一轮对话的延迟统计，row 为列名到值的字典（见 utils/metrics.py）"""
+        columns = ", ".join(row)
+        placeholders = ", ".join("?" for _ in row)
+        with self.connections.transaction() as conn:
+            conn.execute(f"INSERT INTO turn_metrics ({columns}) VALUES ({placeholders})", tuple(row.values()))
+    
+    def get_turn_metrics(self, since=None, model=None, cached=None, status=None, limit=10000):
+        """获取 since（Unix 时间戳）之后的延迟统计记录，从新到旧最多 limit 条
+        
+        cached、status 不为 None 时只返回是否命中缓存、结束状态与之相同的记录。
+        """
+        conditions = []
+        params = []
+        if since is not None:
+            conditions.append("created_at >= ?")
+            params.append(since)
+        if model is not None:
+            conditions.append("model = ?")
+            params.append(model)
+        if cached is not None:
+            conditions.append("cached = ?")
+            params.append(int(cached))
+        if status is not None:
+            conditions.append("status = ?")
+            params.append(status)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        params.append(limit)
+        conn = self.connections.get_connection()
+        cursor = conn.execute(f"""
+            SELECT * FROM turn_metrics {where} ORDER BY created_at DESC LIMIT ?
+        """, params)
+        return [dict(row) for row in cursor.fetchall()]
+    
+    def count_turn_outcomes(self, since=None):
+        """since 之后各结束状态的轮次数，返回 {"ok": n, "cached": n, "cancelled": n, "error": n}，命中缓存的单独计数"""
+        where = "WHERE created_at >= ?" if since is not None else ""
+        params = [since] if since is not None else []
+        conn = self.connections.get_connection()
+        cursor = conn.execute(f"""
+            SELECT CASE WHEN cached THEN 'cached' ELSE status END AS outcome, COUNT(*)
+            FROM turn_metrics {where} GROUP BY outcome
+        """, params)
+        return {outcome: count for outcome, count in cursor.fetchall()}
+    
+    def prune_turn_metrics(self, before):
+        """删除 before（Unix 时间戳）之前的延迟统计，返回删除的记录数"""
+        with self.connections.transaction() as conn:
+            return conn.execute("DELETE FROM turn_metrics WHERE created_at < ?", (before,)).rowcount
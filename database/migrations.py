@@ -0,0 +1,445 @@
+"""
+数据库版本迁移
+
+schema_version 表记录已经执行过的迁移版本，MIGRATIONS 中的步骤按版本号顺序执行，
+每个步骤在独立事务中完成。新增表结构变更时，只需在 MIGRATIONS 末尾追加新的步骤，
+不要修改已经发布的步骤。
+"""
+
+import sqlite3
+
+
+def _migrate_base_tables(conn):
+    """创建基础表（兼容没有版本记录的旧数据库）"""
+    # 创建用户表
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            auth_code TEXT UNIQUE NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    # 创建对话列表
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS conversations (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            title TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+    ''')
+
+    # 创建对话历史表
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS chat_history (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            conversation_id INTEGER,
+            message TEXT NOT NULL,
+            is_user BOOLEAN NOT NULL,
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id),
+            FOREIGN KEY (conversation_id) REFERENCES conversations (id)
+        )
+    ''')
+
+    # 早期版本的 chat_history 表没有 conversation_id 列
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(chat_history)")]
+    if "conversation_id" not in columns:
+        conn.execute("ALTER TABLE chat_history ADD COLUMN conversation_id INTEGER REFERENCES conversations (id)")
+
+
+def _rebuild_table(conn, table, create_sql, columns):
+    """按 SQLite 推荐的方式重建表（新建、复制、删除、重命名），并保留自增序列"""
+    new_table = f"{table}_new"
+    column_list = ", ".join(columns)
+
+    row = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = ?", (table,)).fetchone()
+    sequence = row[0] if row else None
+
+    conn.execute(create_sql.format(table=new_table))
+    conn.execute(f"INSERT INTO {new_table} ({column_list}) SELECT {column_list} FROM {table}")
+    conn.execute(f"DROP TABLE {table}")
+    conn.execute(f"ALTER TABLE {new_table} RENAME TO {table}")
+
+    # 复制数据只会把序列推进到现存最大ID，这里恢复原序列，避免复用已删除记录的ID
+    if sequence is not None:
+        conn.execute("UPDATE sqlite_sequence SET seq = MAX(seq, ?) WHERE name = ?", (sequence, table))
+
+
+def _migrate_cascade_foreign_keys(conn):
+    """外键改为 ON DELETE CASCADE，删除对话时由数据库级联删除历史记录"""
+    _rebuild_table(conn, "conversations", '''
+        CREATE TABLE {table} (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            title TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE
+        )
+    ''', ["id", "user_id", "title", "created_at"])
+
+    _rebuild_table(conn, "chat_history", '''
+        CREATE TABLE {table} (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            conversation_id INTEGER,
+            message TEXT NOT NULL,
+            is_user BOOLEAN NOT NULL,
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE,
+            FOREIGN KEY (conversation_id) REFERENCES conversations (id) ON DELETE CASCADE
+        )
+    ''', ["id", "user_id", "conversation_id", "message", "is_user", "timestamp"])
+
+
+def _migrate_hot_query_indexes(conn):
+    """为对话历史和对话列表的热点查询添加索引"""
+    # 对话历史：按 conversation_id + user_id 过滤，索引隐含 rowid，可直接按 id 顺序扫描；
+    # 级联删除对话时也通过该索引定位历史记录
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_chat_history_conversation
+        ON chat_history (conversation_id, user_id)
+    ''')
+    # 按用户清空或查询历史记录
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_chat_history_user
+        ON chat_history (user_id)
+    ''')
+    # 对话列表：覆盖索引，查询无需回表也无需额外排序
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_conversations_user
+        ON conversations (user_id, created_at, title)
+    ''')
+
+
+def _migrate_full_text_search(conn):
+    """创建 FTS5 全文索引，并通过触发器与 chat_history 保持同步"""
+    # trigram 分词器支持中文等不以空格分词的文本（SQLite 3.34+），旧版本退回 unicode61
+    try:
+        conn.execute('''
+            CREATE VIRTUAL TABLE chat_history_fts USING fts5(
+                message, content='chat_history', content_rowid='id', tokenize='trigram'
+            )
+        ''')
+    except sqlite3.OperationalError:
+        conn.execute('''
+            CREATE VIRTUAL TABLE chat_history_fts USING fts5(
+                message, content='chat_history', content_rowid='id', tokenize='unicode61'
+            )
+        ''')
+
+    conn.execute('''
+        CREATE TRIGGER chat_history_fts_insert AFTER INSERT ON chat_history BEGIN
+            INSERT INTO chat_history_fts (rowid, message) VALUES (new.id, new.message);
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER chat_history_fts_delete AFTER DELETE ON chat_history BEGIN
+            INSERT INTO chat_history_fts (chat_history_fts, rowid, message) VALUES ('delete', old.id, old.message);
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER chat_history_fts_update AFTER UPDATE OF message ON chat_history BEGIN
+            INSERT INTO chat_history_fts (chat_history_fts, rowid, message) VALUES ('delete', old.id, old.message);
+            INSERT INTO chat_history_fts (rowid, message) VALUES (new.id, new.message);
+        END
+    ''')
+
+    # 为已有消息建立索引
+    conn.execute("INSERT INTO chat_history_fts (chat_history_fts) VALUES ('rebuild')")
+
+
+def _migrate_message_compression(conn):
+    """添加压缩标记列，全文索引的外部内容改为解压视图
+
+    触发器不调用 Python 注册的函数，只索引原文存储（codec 为空）的消息，压缩存储的消息由应用
+    在写入的同一事务中维护（见 ChatDatabase.index_compressed_messages）。
+    视图 chat_history_text 读取时依赖连接上注册的 message_text 函数（见 database/compression.py），
+    因此 snippet()/highlight() 以及 FTS5 的 'rebuild'、'integrity-check' 只能在应用的连接上执行。
+    """
+    conn.execute("ALTER TABLE chat_history ADD COLUMN codec TEXT")
+    conn.execute("ALTER TABLE chat_history ADD COLUMN raw_size INTEGER")
+    conn.execute("UPDATE chat_history SET raw_size = length(CAST(message AS BLOB))")
+
+    row = conn.execute("SELECT sql FROM sqlite_master WHERE name = 'chat_history_fts'").fetchone()
+    tokenizer = "trigram" if row and "trigram" in row[0] else "unicode61"
+
+    # 外部内容表改为解压视图，snippet() 等函数读取到的是原文
+    conn.execute("DROP TRIGGER IF EXISTS chat_history_fts_insert")
+    conn.execute("DROP TRIGGER IF EXISTS chat_history_fts_delete")
+    conn.execute("DROP TRIGGER IF EXISTS chat_history_fts_update")
+    conn.execute("DROP TABLE IF EXISTS chat_history_fts")
+    conn.execute('''
+        CREATE VIEW chat_history_text AS
+        SELECT id, message_text(message, codec) AS message FROM chat_history
+    ''')
+    conn.execute(f'''
+        CREATE VIRTUAL TABLE chat_history_fts USING fts5(
+            message, content='chat_history_text', content_rowid='id', tokenize='{tokenizer}'
+        )
+    ''')
+
+    conn.execute('''
+        CREATE TRIGGER chat_history_fts_insert AFTER INSERT ON chat_history WHEN new.codec IS NULL BEGIN
+            INSERT INTO chat_history_fts (rowid, message) VALUES (new.id, new.message);
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER chat_history_fts_delete AFTER DELETE ON chat_history WHEN old.codec IS NULL BEGIN
+            INSERT INTO chat_history_fts (chat_history_fts, rowid, message) VALUES ('delete', old.id, old.message);
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER chat_history_fts_update AFTER UPDATE OF message, codec ON chat_history BEGIN
+            INSERT INTO chat_history_fts (chat_history_fts, rowid, message)
+            SELECT 'delete', old.id, old.message WHERE old.codec IS NULL;
+            INSERT INTO chat_history_fts (rowid, message)
+            SELECT new.id, new.message WHERE new.codec IS NULL;
+        END
+    ''')
+
+    # 迁移时所有消息都是原文存储，直接从原表建立索引
+    conn.execute("INSERT INTO chat_history_fts (rowid, message) SELECT id, message FROM chat_history")
+
+
+def _migrate_conversation_archive(conn):
+    """对话表添加归档时间，不为空表示消息已移入归档库"""
+    conn.execute("ALTER TABLE conversations ADD COLUMN archived_at TIMESTAMP")
+
+
+def _migrate_conversation_summary(conn):
+    """对话表添加消息数、最后活动时间和最后一条消息摘要，由触发器维护
+
+    归档和移回主库时会先设置 / 后清除 archived_at，触发器跳过已归档的对话，
+    因此搬运消息不会改变这些统计值。
+    """
+    conn.execute("ALTER TABLE conversations ADD COLUMN message_count INTEGER NOT NULL DEFAULT 0")
+    conn.execute("ALTER TABLE conversations ADD COLUMN last_message_at TIMESTAMP")
+    conn.execute("ALTER TABLE conversations ADD COLUMN last_snippet TEXT")
+
+    # 回填已有对话，已归档对话的消息在归档库中
+    sources = ["main.chat_history"]
+    attached = [row[1] for row in conn.execute("PRAGMA database_list")]
+    if "archive" in attached and conn.execute(
+            "SELECT 1 FROM archive.sqlite_master WHERE name = 'chat_history'").fetchone():
+        sources.append("archive.chat_history")
+    for source in sources:
+        conn.execute(f'''
+            UPDATE conversations SET
+                message_count = message_count + (
+                    SELECT COUNT(*) FROM {source} h WHERE h.conversation_id = conversations.id
+                ),
+                last_message_at = COALESCE((
+                    SELECT h.timestamp FROM {source} h WHERE h.conversation_id = conversations.id
+                    ORDER BY h.id DESC LIMIT 1
+                ), last_message_at),
+                last_snippet = COALESCE((
+                    SELECT substr(message_text(h.message, h.codec), 1, 80) FROM {source} h
+                    WHERE h.conversation_id = conversations.id
+                    ORDER BY h.id DESC LIMIT 1
+                ), last_snippet)
+        ''')
+
+    # 触发器不调用 message_text()，压缩存储的消息无法在 SQL 中还原，摘要先置空，由应用写入
+    conn.execute('''
+        CREATE TRIGGER conversation_summary_insert AFTER INSERT ON chat_history BEGIN
+            UPDATE conversations SET
+                message_count = message_count + 1,
+                last_message_at = new.timestamp,
+                last_snippet = CASE WHEN new.codec IS NULL THEN substr(new.message, 1, 80) END
+            WHERE id = new.conversation_id AND archived_at IS NULL;
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER conversation_summary_delete AFTER DELETE ON chat_history BEGIN
+            UPDATE conversations SET
+                message_count = message_count - 1,
+                last_message_at = (
+                    SELECT h.timestamp FROM chat_history h
+                    WHERE h.conversation_id = old.conversation_id AND h.user_id = old.user_id
+                    ORDER BY h.id DESC LIMIT 1
+                ),
+                last_snippet = (
+                    SELECT CASE WHEN h.codec IS NULL THEN substr(h.message, 1, 80) END FROM chat_history h
+                    WHERE h.conversation_id = old.conversation_id AND h.user_id = old.user_id
+                    ORDER BY h.id DESC LIMIT 1
+                )
+            WHERE id = old.conversation_id AND archived_at IS NULL;
+        END
+    ''')
+
+    # 对话列表按最后活动时间排序，替换原来按创建时间排序的索引
+    conn.execute("DROP INDEX IF EXISTS idx_conversations_user")
+    conn.execute('''
+        CREATE INDEX idx_conversations_activity
+        ON conversations (user_id, COALESCE(last_message_at, created_at))
+    ''')
+
+
+def _migrate_message_token_count(conn):
+    """添加 token_count 列缓存消息的 token 数
+
+    已有消息不在迁移中回填，首次作为上下文读取时计算并写回（见 get_conversation_context）。
+    """
+    conn.execute("ALTER TABLE chat_history ADD COLUMN token_count INTEGER")
+
+
+def _migrate_conversation_summaries(conn):
+    """创建对话摘要表，watermark_id 为已合并进摘要的最后一条消息ID"""
+    conn.execute('''
+        CREATE TABLE conversation_summaries (
+            conversation_id INTEGER PRIMARY KEY,
+            summary TEXT NOT NULL,
+            watermark_id INTEGER NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (conversation_id) REFERENCES conversations (id) ON DELETE CASCADE
+        )
+    ''')
+
+
+def _migrate_response_cache(conn):
+    """创建回答缓存表，时间为 Unix 时间戳，按 last_hit_at 淘汰最久未命中的记录"""
+    conn.execute('''
+        CREATE TABLE response_cache (
+            cache_key TEXT PRIMARY KEY,
+            model TEXT NOT NULL,
+            response TEXT NOT NULL,
+            codec TEXT,
+            size INTEGER NOT NULL,
+            created_at REAL NOT NULL,
+            last_hit_at REAL NOT NULL,
+            hit_count INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    conn.execute('''
+        CREATE INDEX idx_response_cache_last_hit ON response_cache (last_hit_at)
+    ''')
+
+
+def _migrate_semantic_cache(conn):
+    """创建语义缓存表，embedding 为 float32 向量的原始字节，scope 区分用户和模型"""
+    conn.execute('''
+        CREATE TABLE semantic_cache (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            scope TEXT NOT NULL,
+            question TEXT NOT NULL,
+            answer TEXT NOT NULL,
+            codec TEXT,
+            embedding BLOB NOT NULL,
+            created_at REAL NOT NULL
+        )
+    ''')
+    conn.execute('''
+        CREATE INDEX idx_semantic_cache_scope ON semantic_cache (scope)
+    ''')
+
+
+def _migrate_message_truncated(conn):
+    """添加 truncated 列，标记生成中途被取消、只保存了部分内容的回答"""
+    conn.execute("ALTER TABLE chat_history ADD COLUMN truncated INTEGER NOT NULL DEFAULT 0")
+
+
+def _migrate_turn_metrics(conn):
+    """创建每轮对话的延迟统计表，耗时单位为秒，created_at 为 Unix 时间戳"""
+    conn.execute('''
+        CREATE TABLE turn_metrics (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            conversation_id INTEGER,
+            model TEXT NOT NULL,
+            created_at REAL NOT NULL,
+            status TEXT,
+            cached INTEGER NOT NULL DEFAULT 0,
+            queue_wait REAL,
+            history_load REAL,
+            request_start REAL,
+            ttft REAL,
+            max_gap REAL,
+            avg_gap REAL,
+            tokens INTEGER,
+            tokens_per_second REAL,
+            total REAL,
+            db_write REAL,
+            render_total REAL,
+            render_max REAL,
+            render_updates INTEGER
+        )
+    ''')
+    conn.execute('''
+        CREATE INDEX idx_turn_metrics_created ON turn_metrics (created_at)
+    ''')
+
+
+def _migrate_turn_metrics_enqueue(conn):
+    """db_write 记录的只是消息放入写入队列的耗时，改名为 db_enqueue"""
+    conn.execute("ALTER TABLE turn_metrics RENAME COLUMN db_write TO db_enqueue")
+
+
+# (版本号, 说明, 迁移函数)，版本号必须递增
+MIGRATIONS = [
+    (1, "创建基础表", _migrate_base_tables),
+    (2, "外键改为级联删除", _migrate_cascade_foreign_keys),
+    (3, "添加热点查询索引", _migrate_hot_query_indexes),
+    (4, "添加消息全文索引", _migrate_full_text_search),
+    (5, "支持消息压缩存储", _migrate_message_compression),
+    (6, "支持对话归档", _migrate_conversation_archive),
+    (7, "对话摘要统计列", _migrate_conversation_summary),
+    (8, "缓存消息 token 数", _migrate_message_token_count),
+    (9, "对话滚动摘要", _migrate_conversation_summaries),
+    (10, "回答缓存", _migrate_response_cache),
+    (11, "语义缓存", _migrate_semantic_cache),
+    (12, "标记被中断的回答", _migrate_message_truncated),
+    (13, "对话延迟统计", _migrate_turn_metrics),
+    (14, "延迟统计的 db_write 列改名为 db_enqueue", _migrate_turn_metrics_enqueue),
+]
+
+
+def get_schema_version(conn):
+    """获取当前数据库的结构版本"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            description TEXT,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    row = conn.execute("SELECT MAX(version) FROM schema_version").fetchone()
+    return row[0] or 0
+
+
+def migrate(conn):
+    """执行所有未应用的迁移，返回迁移后的版本号
+
+    conn 必须处于自动提交模式（isolation_level=None）。
+    """
+    current_version = get_schema_version(conn)
+    pending = [m for m in MIGRATIONS if m[0] > current_version]
+    if not pending:
+        return current_version
+
+    # 重建表期间需要关闭外键检查，该 PRAGMA 在事务内无效
+    conn.execute("PRAGMA foreign_keys=OFF")
+    try:
+        for version, description, migration in pending:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                # 其他进程可能已经完成了同一步迁移
+                if get_schema_version(conn) >= version:
+                    conn.rollback()
+                    continue
+                migration(conn)
+                conn.execute(
+                    "INSERT INTO schema_version (version, description) VALUES (?, ?)",
+                    (version, description)
+                )
+            except BaseException:
+                conn.rollback()
+                raise
+            conn.commit()
+            current_version = version
+    finally:
+        conn.execute("PRAGMA foreign_keys=ON")
+
+    return current_version
@@ -0,0 +1,72 @@
+import argparse
+import os
+import sys
+
+# 获取当前文件的目录
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+# 将项目根目录添加到sys.path
+ROOT_DIR = os.path.dirname(CURRENT_DIR)
+# 直接运行脚本时 sys.path[0] 是 database 目录，database 会被解析成 database.py，改为项目根目录
+if sys.path and os.path.abspath(sys.path[0]) == CURRENT_DIR:
+    sys.path[0] = ROOT_DIR
+else:
+    sys.path.append(ROOT_DIR)
+
+from config.settings import DATABASE_PATH, MESSAGE_COMPRESSION_CODEC, MESSAGE_COMPRESSION_THRESHOLD
+from database.database import ChatDatabase
+from database.compression import available_codecs
+
+
+def format_size(size):
+    """将字节数格式化为便于阅读的字符串"""
+    size = size or 0
+    for unit in ["B", "KB", "MB", "GB"]:
+        if size < 1024 or unit == "GB":
+            return f"{size:.1f}{unit}" if unit != "B" else f"{size}{unit}"
+        size /= 1024
+
+
+def print_storage_stats(db, auth_code=None):
+    """打印每个对话的存储统计"""
+    stats = db.get_storage_stats(auth_code)
+    total_raw = sum(item['raw_bytes'] or 0 for item in stats)
+    total_stored = sum(item['stored_bytes'] or 0 for item in stats)
+
+    print(f"{'对话ID':>8}  {'消息数':>6}  {'已压缩':>6}  {'原始大小':>10}  {'存储大小':>10}  标题")
+    for item in stats:
+        print(f"{str(item['conversation_id']):>8}  {item['message_count']:>6}  {item['compressed_count']:>6}  "
+              f"{format_size(item['raw_bytes']):>10}  {format_size(item['stored_bytes']):>10}  {item['title'] or ''}")
+    ratio = total_stored / total_raw if total_raw else 1.0
+    print(f"合计: 原始 {format_size(total_raw)}，存储 {format_size(total_stored)}，压缩率 {ratio:.1%}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="按当前配置重新压缩历史消息，并输出存储统计")
+    parser.add_argument("--db", default=DATABASE_PATH, help="数据库文件路径")
+    parser.add_argument("--codec", default=MESSAGE_COMPRESSION_CODEC or "none",
+                        choices=available_codecs() + ["none"], help="压缩算法，none 表示全部解压")
+    parser.add_argument("--threshold", type=int, default=MESSAGE_COMPRESSION_THRESHOLD,
+                        help="超过该字节数的消息才压缩")
+    parser.add_argument("--stats-only", action="store_true", help="只输出存储统计，不改写数据")
+    parser.add_argument("--auth-code", default=None, help="只统计指定授权码的对话")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.db):
+        print(f"数据库文件 {args.db} 不存在")
+        return
+
+    db = ChatDatabase(args.db, write_behind=False)
+    try:
+        if not args.stats_only:
+            codec = "" if args.codec == "none" else args.codec
+            rewritten = db.recompress_messages(codec=codec, threshold=args.threshold)
+            print(f"已重新编码 {rewritten} 条消息")
+            # 回收改写后释放的空间
+            db.connections.get_connection().execute("VACUUM")
+        print_storage_stats(db, args.auth_code)
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,231 @@
+"""
+对话数据的 JSONL 导出与导入
+
+每行一条 JSON 记录，type 为 user / conversation / message，按用户、对话、消息的顺序写出，
+文件名以 .gz 结尾时自动使用 gzip 压缩。导出和导入都按批次流式处理，内存占用与数据量无关。
+
+用法:
+    python database/transfer.py export backup.jsonl.gz
+    python database/transfer.py import backup.jsonl.gz
+"""
+
+import argparse
+import gzip
+import json
+import os
+import sys
+import time
+
+# 获取当前文件的目录
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+# 将项目根目录添加到sys.path
+ROOT_DIR = os.path.dirname(CURRENT_DIR)
+# 直接运行脚本时 sys.path[0] 是 database 目录，database 会被解析成 database.py，改为项目根目录
+if sys.path and os.path.abspath(sys.path[0]) == CURRENT_DIR:
+    sys.path[0] = ROOT_DIR
+else:
+    sys.path.append(ROOT_DIR)
+
+from config.settings import DATABASE_PATH
+from database.database import ChatDatabase
+from database.compression import encode_message, decode_message
+from database.archive import ARCHIVE_SCHEMA
+
+# 每次从游标取出 / 批量写入的行数
+BATCH_SIZE = 2000
+# 导入时每个事务包含的消息数
+COMMIT_EVERY = 50000
+
+
+def _open(path, mode):
+    """按扩展名选择普通文件或 gzip 文件"""
+    if path.endswith(".gz"):
+        return gzip.open(path, mode + "t", encoding="utf-8")
+    return open(path, mode, encoding="utf-8")
+
+
+def _iter_rows(cursor, batch_size):
+    """用 fetchmany 分批读取游标"""
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            return
+        yield from rows
+
+
+def iter_records(db, auth_code=None, batch_size=BATCH_SIZE):
+    """按用户、对话、消息的顺序逐条生成导出记录
+
+    在同一个读事务中完成，导出的是某一时刻的一致快照。
+    """
+    db.flush()
+    conn = db.connections.get_connection()
+
+    user_filter = ""
+    owner_filter = ""
+    params = ()
+    if auth_code is not None:
+        user_filter = "WHERE id = ?"
+        owner_filter = "WHERE user_id = ?"
+        params = (db.get_or_create_user(auth_code),)
+
+    conn.execute("BEGIN")
+    try:
+        cursor = conn.execute(f"SELECT id, auth_code, created_at FROM users {user_filter} ORDER BY id", params)
+        for row in _iter_rows(cursor, batch_size):
+            yield {"type": "user", **dict(row)}
+
+        cursor = conn.execute(
+            f"SELECT id, user_id, title, created_at FROM conversations {owner_filter} ORDER BY id", params)
+        for row in _iter_rows(cursor, batch_size):
+            yield {"type": "conversation", **dict(row)}
+
+        # 主库和归档库中的消息都要导出
+        tables = ["main.chat_history"]
+        if db.archive_path:
+            tables.append(f"{ARCHIVE_SCHEMA}.chat_history")
+        for table in tables:
+            cursor = conn.execute(f"""
+                SELECT id, user_id, conversation_id, message, codec, is_user, timestamp, truncated
+                FROM {table} {owner_filter} ORDER BY id
+            """, params)
+            for row in _iter_rows(cursor, batch_size):
+                record = dict(row)
+                record["message"] = decode_message(record["message"], record.pop("codec"))
+                record["is_user"] = bool(record["is_user"])
+                record["truncated"] = bool(record["truncated"])
+                yield {"type": "message", **record}
+    finally:
+        conn.rollback()
+
+
+def export_jsonl(db, path, auth_code=None, batch_size=BATCH_SIZE):
+    """导出为 JSONL 文件，返回各类记录的数量"""
+    counts = {"user": 0, "conversation": 0, "message": 0}
+    with _open(path, "w") as f:
+        for record in iter_records(db, auth_code, batch_size):
+            f.write(json.dumps(record, ensure_ascii=False))
+            f.write("\n")
+            counts[record["type"]] += 1
+    return counts
+
+
+def import_jsonl(db, path, batch_size=BATCH_SIZE, commit_every=COMMIT_EVERY):
+    """从 JSONL 文件导入，用户按授权码合并，对话和消息重新分配ID
+
+    返回各类记录的导入数量，引用了未知用户或对话的记录计入 skipped。
+    """
+    counts = {"user": 0, "conversation": 0, "message": 0, "skipped": 0}
+    # 原ID -> 新ID，只保存用户和对话，消息不需要映射
+    user_map = {}
+    conversation_map = {}
+    pending = []
+    uncommitted = 0
+
+    conn = db.connections.get_connection()
+
+    def flush_messages():
+        if pending:
+            last_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM main.chat_history").fetchone()[0]
+            conn.executemany("""
+                INSERT INTO chat_history (user_id, conversation_id, message, is_user, timestamp, codec, raw_size,
+                                          truncated)
+                VALUES (?, ?, ?, ?, COALESCE(?, CURRENT_TIMESTAMP), ?, ?, ?)
+            """, pending)
+            # 压缩存储的消息不经过触发器，在同一事务中补上全文索引和对话摘要
+            compressed = {row[1] for row in pending if row[5] is not None}
+            if compressed:
+                db.index_compressed_messages(conn, "id > ?", (last_id,))
+                db.refresh_last_snippets(conn, compressed)
+            pending.clear()
+
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        with _open(path, "r") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                record_type = record.get("type")
+
+                if record_type == "user":
+                    conn.execute("""
+                        INSERT OR IGNORE INTO users (auth_code, created_at)
+                        VALUES (?, COALESCE(?, CURRENT_TIMESTAMP))
+                    """, (record["auth_code"], record.get("created_at")))
+                    row = conn.execute("SELECT id FROM users WHERE auth_code = ?", (record["auth_code"],)).fetchone()
+                    user_map[record["id"]] = row[0]
+                    counts["user"] += 1
+
+                elif record_type == "conversation":
+                    user_id = user_map.get(record["user_id"])
+                    if user_id is None:
+                        counts["skipped"] += 1
+                        continue
+                    cursor = conn.execute("""
+                        INSERT INTO conversations (user_id, title, created_at)
+                        VALUES (?, ?, COALESCE(?, CURRENT_TIMESTAMP))
+                    """, (user_id, record["title"], record.get("created_at")))
+                    conversation_map[record["id"]] = cursor.lastrowid
+                    counts["conversation"] += 1
+
+                elif record_type == "message":
+                    user_id = user_map.get(record["user_id"])
+                    conversation_id = conversation_map.get(record["conversation_id"])
+                    if user_id is None or (record["conversation_id"] is not None and conversation_id is None):
+                        counts["skipped"] += 1
+                        continue
+                    stored, codec, raw_size = encode_message(record["message"])
+                    pending.append((user_id, conversation_id, stored, record["is_user"],
+                                    record.get("timestamp"), codec, raw_size, int(record.get("truncated", False))))
+                    counts["message"] += 1
+                    uncommitted += 1
+
+                    if len(pending) >= batch_size:
+                        flush_messages()
+                    # 分段提交，避免单个事务的 WAL 无限增长
+                    if uncommitted >= commit_every:
+                        flush_messages()
+                        conn.commit()
+                        conn.execute("BEGIN IMMEDIATE")
+                        uncommitted = 0
+
+                else:
+                    counts["skipped"] += 1
+
+        flush_messages()
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description="以 JSONL 格式导出或导入对话数据（.gz 结尾时自动压缩）")
+    parser.add_argument("action", choices=["export", "import"], help="导出或导入")
+    parser.add_argument("path", help="JSONL 文件路径")
+    parser.add_argument("--db", default=DATABASE_PATH, help="数据库文件路径")
+    parser.add_argument("--auth-code", default=None, help="只导出指定授权码的数据")
+    args = parser.parse_args()
+
+    db = ChatDatabase(args.db, write_behind=False)
+    try:
+        start = time.perf_counter()
+        if args.action == "export":
+            counts = export_jsonl(db, args.path, auth_code=args.auth_code)
+        else:
+            counts = import_jsonl(db, args.path)
+        elapsed = time.perf_counter() - start
+    finally:
+        db.close()
+
+    rate = counts["message"] / elapsed if elapsed > 0 else 0
+    print(f"用户 {counts['user']} 个，对话 {counts['conversation']} 个，消息 {counts['message']} 条"
+          + (f"，跳过 {counts['skipped']} 条" if counts.get("skipped") else ""))
+    print(f"耗时 {elapsed:.2f} 秒，{rate:.0f} 条消息/秒")
+
+
+if __name__ == "__main__":
+    main()
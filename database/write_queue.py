@@ -0,0 +1,214 @@
+import queue
+import sqlite3
+import threading
+
+# 通知写线程退出的哨兵
+_STOP = object()
+
+
+def _is_transient(error):
+    """数据库被锁定或繁忙，稍后重试可能成功"""
+    code = getattr(error, "sqlite_errorcode", None)
+    if code is not None:
+        return code & 0xFF in (sqlite3.SQLITE_BUSY, sqlite3.SQLITE_LOCKED)
+    message = str(error).lower()
+    return "locked" in message or "busy" in message
+
+
+class MessageWriteQueue:
+    """消息异步写入队列（write-behind）
+
+    调用方把消息放入队列后立即返回，由单独的写线程把队列中积压的消息
+    合并到一个事务中批量提交，发送消息的路径上不再包含 fsync。
+
+    数据库被锁定或繁忙时保留消息，按指数退避重试，期间消息仍计入待写入数，flush() 返回 False；
+    连续重试 max_retries 次仍失败时放弃。其他错误（如对话已被删除、表结构不匹配）无法通过重试恢复，
+    消息记录日志后丢弃，放弃和丢弃的消息都计入 dropped。
+    """
+    def __init__(self, connections, write_batch, logger, batch_size=256, retry_base_delay=0.2,
+                 retry_max_delay=5.0, max_retries=20):
+        """
+        connections: ConnectionManager，写线程通过它获取自己的连接
+        write_batch: write_batch(conn, rows)，在事务中写入一批消息
+        """
+        self.connections = connections
+        self.write_batch = write_batch
+        self.logger = logger
+        self.batch_size = batch_size
+        self.retry_base_delay = retry_base_delay
+        self.retry_max_delay = retry_max_delay
+        self.max_retries = max_retries
+
+        self._queue = queue.Queue()
+        self._cond = threading.Condition()
+        # 对话ID -> 尚未写入的消息数
+        self._pending = {}
+        self._pending_total = 0
+        self._closed = False
+        self._stop_event = threading.Event()
+        # 正在重试时为最近一次的错误，写入成功后清空
+        self.last_error = None
+        # 无法写入而丢弃的消息数
+        self.dropped = 0
+
+        self._thread = threading.Thread(target=self._run, name="MessageWriteQueue", daemon=True)
+        self._thread.start()
+
+    def put(self, conversation_id, row):
+        """将一条消息放入队列，队列已关闭时返回 False"""
+        with self._cond:
+            if self._closed:
+                return False
+            self._pending[conversation_id] = self._pending.get(conversation_id, 0) + 1
+            self._pending_total += 1
+        self._queue.put((conversation_id, row))
+        return True
+
+    def wait_for_conversation(self, conversation_id, timeout=None):
+        """等待指定对话的待写入消息全部落盘，写入失败正在重试或超时时返回 False"""
+        with self._cond:
+            self._cond.wait_for(
+                lambda: self._pending.get(conversation_id, 0) == 0 or self.last_error is not None, timeout)
+            return self._pending.get(conversation_id, 0) == 0
+
+    def flush(self, timeout=None):
+        """等待队列中所有消息落盘，写入失败正在重试或超时时返回 False（消息仍保留在队列中）"""
+        with self._cond:
+            self._cond.wait_for(lambda: self._pending_total == 0 or self.last_error is not None, timeout)
+            return self._pending_total == 0
+
+    def stats(self):
+        """待写入的消息数、丢弃的消息数和正在重试的错误"""
+        with self._cond:
+            return {
+                "pending": self._pending_total,
+                "dropped": self.dropped,
+                "last_error": str(self.last_error) if self.last_error is not None else None,
+            }
+
+    def close(self):
+        """写完剩余消息后停止写线程"""
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+        self._stop_event.set()
+        self._queue.put(_STOP)
+        self._thread.join()
+
+    def _run(self):
+        """写线程主循环：阻塞等待第一条消息，再取出已积压的消息组成一批
+
+        写入失败的消息放在下一批的最前面，保持同一对话内消息的顺序。
+        """
+        try:
+            stopping = False
+            retry = []
+            failures = 0
+            while not stopping:
+                if retry:
+                    # 退避等待，关闭时立即进行最后一次尝试
+                    self._stop_event.wait(min(self.retry_max_delay, self.retry_base_delay * (2 ** (failures - 1))))
+                    batch = retry
+                else:
+                    item = self._queue.get()
+                    if item is _STOP:
+                        break
+                    batch = [item]
+                while not stopping and len(batch) < self.batch_size:
+                    try:
+                        item = self._queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if item is _STOP:
+                        stopping = True
+                        break
+                    batch.append(item)
+                retry = self._write(batch)
+                failures = failures + 1 if retry else 0
+                if retry and failures > self.max_retries:
+                    self._give_up(retry, f"重试 {self.max_retries} 次后仍有 {len(retry)} 条消息无法保存，已丢弃")
+                    retry = []
+                    failures = 0
+                if retry and stopping:
+                    # 关闭前最后再试一次
+                    retry = self._write(retry)
+            if retry:
+                self._give_up(retry, f"关闭时仍有 {len(retry)} 条消息无法保存")
+        finally:
+            self.connections.release()
+
+    def _write(self, batch):
+        """在一个事务中写入整批消息，失败时逐条写入，避免一条坏数据拖累整批
+
+        返回因数据库暂时不可写而需要重试的消息。
+        """
+        rows = [row for _, row in batch]
+        try:
+            with self.connections.transaction() as conn:
+                self.write_batch(conn, rows)
+        except Exception as e:
+            if isinstance(e, sqlite3.OperationalError) and _is_transient(e):
+                return self._retry_later(batch, e)
+            self.logger.log_exception(f"批量保存消息时出错，改为逐条保存: {str(e)}")
+        else:
+            self._done(batch)
+            return []
+
+        written = []
+        dropped = []
+        retry = []
+        error = None
+        for item in batch:
+            if retry:
+                # 数据库不可写，之后的消息不再逐条尝试，保持顺序一起重试
+                retry.append(item)
+                continue
+            try:
+                with self.connections.transaction() as conn:
+                    self.write_batch(conn, [item[1]])
+                written.append(item)
+            except Exception as e:
+                if isinstance(e, sqlite3.OperationalError) and _is_transient(e):
+                    error = e
+                    retry.append(item)
+                    continue
+                self.logger.log_exception(f"保存消息时出错，已丢弃: {str(e)}")
+                dropped.append(item)
+        self._done(written)
+        self._done(dropped, dropped=True)
+        if retry:
+            return self._retry_later(retry, error)
+        return []
+
+    def _retry_later(self, items, error):
+        with self._cond:
+            self.last_error = error
+            self._cond.notify_all()
+        self.logger.log_error(f"数据库暂时无法写入，{len(items)} 条消息稍后重试: {str(error)}")
+        return items
+
+    def _give_up(self, items, message):
+        """放弃重试，消息计入 dropped"""
+        self.logger.log_error(f"{message}: {str(self.last_error)}")
+        with self._cond:
+            self.last_error = None
+        self._done(items, dropped=True)
+
+    def _done(self, items, dropped=False):
+        """消息已写入（或已丢弃），从待写入计数中减去"""
+        if not items:
+            return
+        with self._cond:
+            for conversation_id, _ in items:
+                remaining = self._pending[conversation_id] - 1
+                if remaining:
+                    self._pending[conversation_id] = remaining
+                else:
+                    del self._pending[conversation_id]
+            self._pending_total -= len(items)
+            if dropped:
+                self.dropped += len(items)
+            else:
+                self.last_error = None
+            self._cond.notify_all()
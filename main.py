@@ -1,5 +1,6 @@
 from PyQt5.QtWidgets import (
-    QApplication, QMainWindow, QTabWidget, QWidget, QVBoxLayout, QHBoxLayout, QLabel, QListWidget, QPushButton, QComboBox, QSplitter, QMenu, QAction, QInputDialog, QDialog, QGroupBox
+    QApplication, QMainWindow, QTabWidget, QWidget, QVBoxLayout, QHBoxLayout, QLabel, QListWidget, QPushButton, QComboBox, QSplitter, QMenu, QAction, QInputDialog, QDialog, QGroupBox,
+    QLineEdit, QListWidgetItem, QTableWidget, QTableWidgetItem, QHeaderView
 )
 from PyQt5.QtGui import QPixmap
 from PyQt5.QtCore import Qt, QTimer
@@ -7,10 +8,12 @@ from chat_interface import ChatCore
 from chat_widget import ChatWidget
 from dotenv import load_dotenv
 from utils.logger import Logger
+from utils.http_client import get_http_client, close_http_client
+from utils.async_runtime import stop_async_runtime
 import os
 import sys
-import requests
-from config.settings import API_MODELS, THEMES, THEME_NAME_TO_QSS, DEFAULT_QSS, AUTH_MARKER_FILE_PATH
+import threading
+from config.settings import API_MODELS, THEMES, THEME_NAME_TO_QSS, DEFAULT_QSS, AUTH_MARKER_FILE_PATH, METRICS_STATS_DAYS
 
 # 加载.env
 load_dotenv()
@@ -20,7 +23,7 @@ class SettingsDialog(QDialog):
     def __init__(self, parent=None, current_theme="深色主题", current_language="中文"):
         super().__init__(parent)
         self.setWindowTitle("设置")
-        self.setFixedSize(400, 500)  # 增加高度以容纳用户信息
+        self.setFixedSize(400, 760)  # 增加高度以容纳用户信息和运行统计
         self.current_theme = current_theme
         self.current_language = current_language
         
@@ -39,7 +42,7 @@ class SettingsDialog(QDialog):
             api_key = os.getenv("API_KEY")
             url = "https://api.siliconflow.cn/v1/user/info"
             headers = {"Authorization": f"Bearer {api_key}"}
-            response = requests.get(url, headers=headers)
+            response = get_http_client().get(url, headers=headers)
             
             if response.status_code == 200:
                 return response.json()
@@ -58,6 +61,12 @@ class SettingsDialog(QDialog):
                 self.parent().logger.log_exception(error_msg)
             return None
     
+    def _get_chat_core(self):
+        """从主窗口获取 ChatCore，用于显示运行统计"""
+        parent = self.parent()
+        model_tab = getattr(parent, 'model_tab', None)
+        return getattr(model_tab, 'chat_core', None)
+    
     def apply_theme(self):
         """应用当前主题样式"""
         # 根据当前主题加载对应的QSS样式表
@@ -137,6 +146,74 @@ class SettingsDialog(QDialog):
         
         layout.addWidget(user_info_group)
         
+        # 缓存命中统计
+        chat_core = self._get_chat_core()
+        if chat_core is not None:
+            cache_group = QGroupBox("运行统计")
+            cache_layout = QVBoxLayout()
+            
+            history_stats = chat_core.get_history_cache_stats()
+            history_label = QLabel(
+                f"历史记录缓存: 命中 {history_stats['hits']} 次，未命中 {history_stats['misses']} 次，"
+                f"命中率 {history_stats['hit_rate']:.0%}")
+            history_label.setWordWrap(True)
+            history_label.setStyleSheet("font-size: 14px;color: #666666;")
+            cache_layout.addWidget(history_label)
+            
+            response_stats = chat_core.get_response_cache_stats()
+            if response_stats is None:
+                response_text = "回答缓存: 未启用"
+            else:
+                response_text = (
+                    f"回答缓存: 命中 {response_stats['memory_hits'] + response_stats['disk_hits']} 次，"
+                    f"未命中 {response_stats['misses']} 次，命中率 {response_stats['hit_rate']:.0%}，"
+                    f"已缓存 {response_stats.get('disk_entries', 0)} 条")
+            response_label = QLabel(response_text)
+            response_label.setWordWrap(True)
+            response_label.setStyleSheet("font-size: 14px;color: #666666;")
+            cache_layout.addWidget(response_label)
+            
+            semantic_stats = chat_core.get_semantic_cache_stats()
+            if semantic_stats is None:
+                semantic_text = "语义缓存: 未启用"
+            else:
+                semantic_text = (
+                    f"语义缓存: 命中 {semantic_stats['hits']} 次，未命中 {semantic_stats['misses']} 次，"
+                    f"命中率 {semantic_stats['hit_rate']:.0%}，因问题不同拒绝 {semantic_stats['rejected']} 次，"
+                    f"平均查询 {semantic_stats['avg_lookup_ms']:.2f} 毫秒")
+            semantic_label = QLabel(semantic_text)
+            semantic_label.setWordWrap(True)
+            semantic_label.setStyleSheet("font-size: 14px;color: #666666;")
+            cache_layout.addWidget(semantic_label)
+            
+            scheduler_stats = chat_core.get_scheduler_stats().values()
+            granted = sum(stats['granted'] for stats in scheduler_stats)
+            total_wait_ms = sum(stats['avg_wait_ms'] * stats['granted'] for stats in scheduler_stats)
+            scheduler_label = QLabel(
+                f"请求调度: 排队 {sum(stats['queued'] for stats in scheduler_stats)} 个，"
+                f"执行中 {sum(stats['running'] for stats in scheduler_stats)} 个，"
+                f"平均等待 {total_wait_ms / granted if granted else 0:.0f} 毫秒，"
+                f"最长等待 {max((stats['max_wait_ms'] for stats in scheduler_stats), default=0):.0f} 毫秒")
+            scheduler_label.setWordWrap(True)
+            scheduler_label.setStyleSheet("font-size: 14px;color: #666666;")
+            cache_layout.addWidget(scheduler_label)
+            
+            resilience_stats = chat_core.get_resilience_stats()
+            wins = resilience_stats['wins']
+            resilience_label = QLabel(
+                f"重试与对冲: 首次成功 {wins['primary']} 次，重试后成功 {wins['retry']} 次，"
+                f"对冲胜出 {wins['hedge']} / {resilience_stats['hedges']} 次，失败 {resilience_stats['failures']} 次")
+            resilience_label.setWordWrap(True)
+            resilience_label.setStyleSheet("font-size: 14px;color: #666666;")
+            cache_layout.addWidget(resilience_label)
+            
+            metrics_button = QPushButton("延迟统计")
+            metrics_button.clicked.connect(lambda: MetricsDialog(chat_core, self).exec_())
+            cache_layout.addWidget(metrics_button)
+            
+            cache_group.setLayout(cache_layout)
+            layout.addWidget(cache_group)
+        
         # 主题设置
         theme_label = QLabel("外观主题")
         self.theme_combo = QComboBox()
@@ -170,6 +247,67 @@ class SettingsDialog(QDialog):
         
         self.setLayout(layout)
 
+
+class MetricsDialog(QDialog):
+    """按模型显示最近几天各阶段耗时的 p50 / p95 / p99"""
+    
+    # (字段, 显示名称, 单位)，耗时以毫秒显示
+    METRIC_ROWS = [
+        ("ttft", "首字延迟", "ms"),
+        ("total", "总耗时", "ms"),
+        ("queue_wait", "排队等待", "ms"),
+        ("history_load", "读取历史", "ms"),
+        ("request_start", "发出请求", "ms"),
+        ("max_gap", "最大字间隔", "ms"),
+        ("avg_gap", "平均字间隔", "ms"),
+        ("tokens_per_second", "生成速度（token/秒）", ""),
+        ("tokens", "回答长度（token）", ""),
+        ("db_enqueue", "保存消息（入队）", "ms"),
+        ("render_total", "界面渲染总计", "ms"),
+        ("render_max", "单次渲染最长", "ms"),
+    ]
+    
+    def __init__(self, chat_core, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle(f"延迟统计（最近 {METRICS_STATS_DAYS} 天）")
+        self.resize(640, 480)
+        
+        layout = QVBoxLayout()
+        stats = chat_core.get_latency_stats()
+        # 命中缓存、被取消和出错的轮次不计入分位数，只显示数量
+        outcomes = chat_core.get_turn_outcomes()
+        layout.addWidget(QLabel(
+            f"统计正常结束的 {outcomes.get('ok', 0)} 轮；未计入：命中缓存 {outcomes.get('cached', 0)} 轮，"
+            f"取消 {outcomes.get('cancelled', 0)} 轮，出错 {outcomes.get('error', 0)} 轮"))
+        if not stats:
+            layout.addWidget(QLabel("暂无统计数据"))
+        else:
+            table = QTableWidget()
+            table.setColumnCount(6)
+            table.setHorizontalHeaderLabels(["模型", "指标", "样本数", "p50", "p95", "p99"])
+            table.horizontalHeader().setSectionResizeMode(QHeaderView.Stretch)
+            table.setEditTriggers(QTableWidget.NoEditTriggers)
+            table.verticalHeader().setVisible(False)
+            rows = []
+            for model, fields in sorted(stats.items()):
+                for field, name, unit in self.METRIC_ROWS:
+                    if field in fields:
+                        rows.append((model, name, unit, fields[field]))
+            table.setRowCount(len(rows))
+            for row, (model, name, unit, values) in enumerate(rows):
+                cells = [model, name + ("（毫秒）" if unit == "ms" else ""), str(values['count'])]
+                for q in ("p50", "p95", "p99"):
+                    value = values[q]
+                    cells.append(f"{value * 1000:.0f}" if unit == "ms" else f"{value:.1f}")
+                for column, text in enumerate(cells):
+                    table.setItem(row, column, QTableWidgetItem(text))
+            layout.addWidget(table)
+        
+        close_button = QPushButton("关闭")
+        close_button.clicked.connect(self.accept)
+        layout.addWidget(close_button)
+        self.setLayout(layout)
+
 # ===============对话主窗口====================
 class NLPDesktopApp(QMainWindow):
     def __init__(self):
@@ -212,6 +350,25 @@ class NLPDesktopApp(QMainWindow):
         sidebar_layout.addWidget(theme_label)
         sidebar_layout.addWidget(self.theme_combo)
         
+        # 历史消息搜索
+        self.search_input = QLineEdit()
+        self.search_input.setPlaceholderText("搜索历史消息...")
+        self.search_input.setClearButtonEnabled(True)
+        self.search_result_list = QListWidget()
+        self.search_result_list.setWordWrap(True)
+        self.search_result_list.setVisible(False)  # 没有搜索内容时隐藏搜索结果
+        self.search_result_list.itemClicked.connect(self.open_search_result)
+        # 输入停顿后再搜索，避免每输入一个字符都查询一次
+        self.search_timer = QTimer(self)
+        self.search_timer.setSingleShot(True)
+        self.search_timer.setInterval(300)
+        self.search_timer.timeout.connect(self.search_messages)
+        self.search_input.textChanged.connect(lambda: self.search_timer.start())
+        self.search_input.returnPressed.connect(self.search_messages)
+        
+        sidebar_layout.addWidget(self.search_input)
+        sidebar_layout.addWidget(self.search_result_list)
+        
         # 对话列表
         dialog_label = QLabel("对话列表")
         self.dialog_list = QListWidget()
@@ -304,7 +461,20 @@ class NLPDesktopApp(QMainWindow):
         
         # 清空聊天界面，确保一开始展示空白界面
         self.model_tab.clear_chat()
+        
+        # 后台把长时间未活动的对话移入归档库，保持主库小而常驻缓存
+        threading.Thread(target=self.archive_idle_conversations, daemon=True).start()
 
+    def archive_idle_conversations(self):
+        """归档闲置对话（在后台线程中运行）"""
+        db_manager = self.model_tab.chat_core.db_manager
+        try:
+            db_manager.archive_idle_conversations()
+        except Exception as e:
+            self.logger.log_exception(f"归档闲置对话时出错: {e}")
+        finally:
+            db_manager.release_connection()
+    
     def on_model_changed(self, model_name):
         """当模型切换时更新提示信息和ChatCore配置"""
         self.model_tip_label.setText(f"当前模型: {model_name}")
@@ -335,9 +505,16 @@ class NLPDesktopApp(QMainWindow):
         # 清空当前列表
         self.dialog_list.clear()
         
-        # 添加对话到列表
+        # 添加对话到列表，列表项中保存对话ID，消息数和最后一条消息显示在提示中
         for conv in conversations:
-            self.dialog_list.addItem(conv['title'])
+            item = QListWidgetItem(conv['title'])
+            item.setData(Qt.UserRole, conv['id'])
+            last_active = conv['last_message_at'] or conv['created_at']
+            tooltip = f"{conv['message_count']} 条消息 · 最后活动 {last_active}"
+            if conv['last_snippet']:
+                tooltip += f"\n{conv['last_snippet']}"
+            item.setToolTip(tooltip)
+            self.dialog_list.addItem(item)
         
         # 如果没有对话，不创建默认对话，等待用户输入第一个问题时再创建
     
@@ -363,45 +540,81 @@ class NLPDesktopApp(QMainWindow):
         self.init_conversation_list()
     
     def switch_conversation(self, item):
-        """切换对话"""
-        # 检查是否有正在进行的对话生成
-        if self.model_tab.is_worker_running():
-            # 显示提示信息
-            QMessageBox.warning(self, "提示", "当前对话正在生成中，请等待生成结束后再切换对话。")
-            return
-        
-        # 停止当前可能正在运行的worker线程
-        self.model_tab.stop_worker()
-        
+        """切换对话，正在生成的对话在后台继续生成"""
+        # 从列表项中获取选中对话的ID
+        self.open_conversation(item.data(Qt.UserRole))
+    
+    def open_conversation(self, conversation_id, focus_message_id=None):
+        """打开指定对话，focus_message_id 不为空时滚动到该消息"""
         # 获取授权码作为用户标识
         auth_code = os.environ.get('AUTH_CODE', 'default_user')
-        # 获取选中的对话标题
-        selected_title = item.text()
         
-        # 从数据库获取用户的对话列表
-        conversations = self.model_tab.chat_core.db_manager.get_user_conversations(auth_code)
+        # 更新ChatCore的当前对话ID
+        self.model_tab.chat_core.current_conversation_id = conversation_id
         
-        # 找到选中对话的ID
-        for conv in conversations:
-            if conv['title'] == selected_title:
-                # 更新ChatCore的当前对话ID
-                self.model_tab.chat_core.current_conversation_id = conv['id']
-                
-                # 获取对话历史（分页加载）
-                history = self.model_tab.chat_core.db_manager.get_conversation_history(
-                    auth_code, conv['id'], limit=100)  # 一次性获取前100条消息
-                
-                # 清空聊天界面
-                self.model_tab.clear_chat()
-                
-                # 显示对话历史
-                self.model_tab.display_history_messages(history)
-                
-                # 滚动到对话底部
-                QTimer.singleShot(0, lambda: self.model_tab.scroll_area.verticalScrollBar().setValue(
-                    self.model_tab.scroll_area.verticalScrollBar().maximum()))
+        # 获取对话历史（分页加载）
+        history = self.model_tab.chat_core.db_manager.get_conversation_tail(
+            auth_code, conversation_id, limit=100)  # 先获取最近100条消息，更早的消息滚动到顶部时再加载
+        
+        # 清空聊天界面
+        self.model_tab.clear_chat()
+        
+        # 显示对话历史
+        self.model_tab.display_history_messages(history)
+        # 该对话仍在后台生成时恢复显示生成中的回答
+        self.model_tab.attach_stream(conversation_id)
+        
+        if focus_message_id is not None:
+            # 滚动到搜索命中的消息
+            QTimer.singleShot(0, lambda: self.model_tab.scroll_to_message(focus_message_id))
+        else:
+            # 滚动到对话底部
+            QTimer.singleShot(0, lambda: self.model_tab.scroll_area.verticalScrollBar().setValue(
+                self.model_tab.scroll_area.verticalScrollBar().maximum()))
+        
+        # 在对话列表中选中该对话
+        for row in range(self.dialog_list.count()):
+            list_item = self.dialog_list.item(row)
+            if list_item.data(Qt.UserRole) == conversation_id:
+                self.dialog_list.setCurrentItem(list_item)
                 break
     
+    def search_messages(self):
+        """在所有对话中搜索历史消息"""
+        self.search_timer.stop()
+        query = self.search_input.text().strip()
+        self.search_result_list.clear()
+        if not query:
+            self.search_result_list.setVisible(False)
+            return
+        
+        # 获取授权码作为用户标识
+        auth_code = os.environ.get('AUTH_CODE', 'default_user')
+        try:
+            results = self.model_tab.chat_core.db_manager.search_messages(auth_code, query, limit=50)
+        except Exception as e:
+            error_msg = f"搜索历史消息时出错: {e}"
+            print(error_msg)
+            self.logger.log_exception(error_msg)
+            results = []
+        
+        if not results:
+            self.search_result_list.addItem("没有找到相关消息")
+        for result in results:
+            role = "我" if result['is_user'] else "AI"
+            item = QListWidgetItem(f"{result['title']}\n{role}: {result['snippet']}")
+            item.setData(Qt.UserRole, (result['conversation_id'], result['id']))
+            self.search_result_list.addItem(item)
+        self.search_result_list.setVisible(True)
+    
+    def open_search_result(self, item):
+        """打开搜索结果所在的对话并定位到命中的消息"""
+        target = item.data(Qt.UserRole)
+        if not target:
+            return
+        conversation_id, message_id = target
+        self.open_conversation(conversation_id, focus_message_id=message_id)
+    
     def show_conversation_context_menu(self, position):
         """显示对话列表的上下文菜单"""
         # 获取右键点击的项
@@ -435,19 +648,12 @@ class NLPDesktopApp(QMainWindow):
             # 获取授权码作为用户标识
             auth_code = os.environ.get('AUTH_CODE', 'default_user')
             
-            # 从数据库获取用户的对话列表
-            conversations = self.model_tab.chat_core.db_manager.get_user_conversations(auth_code)
-            
-            # 找到选中对话的ID
-            conversation_id = None
-            for conv in conversations:
-                if conv['title'] == current_title:
-                    conversation_id = conv['id']
-                    break
+            # 列表项保存了对话ID，标题可能重复，不能按标题查找
+            conversation_id = item.data(Qt.UserRole)
             
             if conversation_id is not None:
                 # 更新数据库中的对话标题
-                self.model_tab.chat_core.db_manager.update_conversation_title(auth_code, conversation_id, new_title)
+                self.model_tab.chat_core.rename_conversation(auth_code, conversation_id, new_title)
                 
                 # 更新列表项的显示
                 item.setText(new_title)
@@ -471,19 +677,14 @@ class NLPDesktopApp(QMainWindow):
             # 获取授权码作为用户标识
             auth_code = os.environ.get('AUTH_CODE', 'default_user')
             
-            # 从数据库获取用户的对话列表
-            conversations = self.model_tab.chat_core.db_manager.get_user_conversations(auth_code)
-            
-            # 找到选中对话的ID
-            conversation_id = None
-            for conv in conversations:
-                if conv['title'] == current_title:
-                    conversation_id = conv['id']
-                    break
+            # 列表项保存了对话ID，标题可能重复，不能按标题查找
+            conversation_id = item.data(Qt.UserRole)
             
             if conversation_id is not None:
+                # 停止该对话的生成任务
+                self.model_tab.stop_worker(conversation_id)
                 # 从数据库删除对话
-                self.model_tab.chat_core.db_manager.delete_conversation(auth_code, conversation_id)
+                self.model_tab.chat_core.delete_conversation(auth_code, conversation_id)
                 
                 # 从列表中移除项
                 self.dialog_list.takeItem(self.dialog_list.row(item))
@@ -502,14 +703,15 @@ class NLPDesktopApp(QMainWindow):
                         self.model_tab.chat_core.current_conversation_id = first_conv['id']
                         
                         # 获取对话历史（分页加载）
-                        history = self.model_tab.chat_core.db_manager.get_conversation_history(
-                            auth_code, first_conv['id'], limit=100)  # 一次性获取前100条消息
+                        history = self.model_tab.chat_core.db_manager.get_conversation_tail(
+                            auth_code, first_conv['id'], limit=100)  # 先获取最近100条消息
                         
                         # 清空聊天界面
                         self.model_tab.clear_chat()
                         
                         # 显示对话历史
                         self.model_tab.display_history_messages(history)
+                        self.model_tab.attach_stream(first_conv['id'])
                     else:
                         # 没有剩余对话，清空聊天界面
                         self.model_tab.clear_chat()
@@ -536,6 +738,15 @@ class NLPDesktopApp(QMainWindow):
                 self.theme_combo.setCurrentText(selected_theme)
                 self.on_theme_changed(selected_theme)
     
+    def closeEvent(self, event):
+        """关闭窗口时写完待保存的消息并关闭数据库"""
+        self.model_tab.cancel_all_workers()
+        # 先停止事件循环中的生成任务，再关闭数据库
+        stop_async_runtime()
+        self.model_tab.chat_core.close()
+        close_http_client()
+        super().closeEvent(event)
+    
     def display_chat_history(self):
         """显示聊天历史记录（分页加载）"""
         # 获取授权码作为用户标识
@@ -543,8 +754,8 @@ class NLPDesktopApp(QMainWindow):
         # 检查是否有当前对话ID
         if self.model_tab.chat_core.current_conversation_id:
             # 从数据库获取当前对话的历史（分页加载）
-            history = self.model_tab.chat_core.db_manager.get_conversation_history(
-                auth_code, self.model_tab.chat_core.current_conversation_id, limit=100)  # 一次性获取前100条消息
+            history = self.model_tab.chat_core.db_manager.get_conversation_tail(
+                auth_code, self.model_tab.chat_core.current_conversation_id, limit=100)  # 先获取最近100条消息
             # 在聊天界面显示历史消息
             self.model_tab.display_history_messages(history)
         else:
@@ -0,0 +1,154 @@
+# ============== 滚动摘要记忆 ================
+"""
+长对话的滚动摘要
+
+超出 token 预算、不再随提示词发送的早期消息，由后台线程使用低成本模型增量合并进对话摘要。
+摘要连同水位线（已合并的最后一条消息ID）保存在 conversation_summaries 表中，
+每次只把水位线之后新被挤出窗口的消息合并进去，不会从头重新生成。
+"""
+
+import os
+import sys
+import queue
+import threading
+
+# 获取当前文件的目录
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+# 将项目根目录添加到sys.path
+ROOT_DIR = os.path.dirname(CURRENT_DIR)
+sys.path.append(ROOT_DIR)
+
+from config.settings import SUMMARY_MODEL, SUMMARY_MAX_TOKENS, SUMMARY_CHUNK_TOKENS
+from utils.tokenizer import count_tokens
+from utils.scheduler import PRIORITY_BACKGROUND
+from utils.logger import Logger
+
+SUMMARY_PROMPT = """你负责维护一段对话的摘要。请把新增的对话内容合并进已有摘要，保留用户的目标、偏好、关键事实、已经得出的结论和尚未解决的问题，省略寒暄和重复内容。只输出更新后的摘要。
+
+已有摘要：
+{summary}
+
+新增对话：
+{turns}
+
+更新后的摘要："""
+
+# 单条消息超过分块大小时按字符截断，保守地按每个字符 1 个 token 计算
+_TRUNCATED_MARK = "……（内容过长已截断）"
+
+
+class SummaryMemory:
+    """在后台把被挤出上下文窗口的早期消息增量合并进对话摘要"""
+
+    def __init__(self, db_manager, llm_pool, model=None, scheduler=None, resilience=None):
+        self.db_manager = db_manager
+        self.llm_pool = llm_pool
+        # 摘要请求以后台优先级排队，不与用户正在等待的对话争抢额度
+        self.scheduler = scheduler
+        # 可重试的失败按退避重试，每次尝试重新排队
+        self.resilience = resilience
+        self.model = model or SUMMARY_MODEL
+        self.logger = Logger()
+        # 已排队或正在处理的对话，同一对话同时只有一个摘要任务
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._thread = None
+
+    def get_summary(self, conversation_id):
+        """获取对话当前的摘要"""
+        return self.db_manager.get_conversation_summary(conversation_id)
+
+    def schedule(self, auth_code, conversation_id, keep_latest):
+        """安排把最新 keep_latest 条之外尚未合并的消息合并进摘要，返回是否新加入了任务
+
+        上下文窗口中可能有尚未落盘、还没有ID的消息，因此用条数而不是消息ID表示边界。
+        """
+        with self._lock:
+            if conversation_id in self._pending:
+                return False
+            self._pending.add(conversation_id)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="SummaryMemory", daemon=True)
+                self._thread.start()
+        self._queue.put((auth_code, conversation_id, keep_latest))
+        return True
+
+    def _get_llm(self):
+        """摘要模型从客户端池获取，只在第一次需要时创建"""
+        return self.llm_pool.get(self.model, temperature=0.3, max_tokens=SUMMARY_MAX_TOKENS)
+
+    def _run(self):
+        while True:
+            auth_code, conversation_id, keep_latest = self._queue.get()
+            try:
+                # 取窗口中最旧一条消息的ID作为合并边界
+                window = self.db_manager.get_conversation_messages(
+                    auth_code, conversation_id, limit=keep_latest, newest_first=True)
+                if len(window) == keep_latest:
+                    self.fold(auth_code, conversation_id, window[-1]['id'])
+            except Exception as e:
+                self.logger.log_exception(f"更新对话 {conversation_id} 的摘要时出错: {str(e)}")
+            finally:
+                with self._lock:
+                    self._pending.discard(conversation_id)
+                self.db_manager.release_connection()
+
+    def fold(self, auth_code, conversation_id, before_id):
+        """把水位线之后、before_id 之前的消息分块合并进摘要，返回合并的消息数"""
+        folded = 0
+        while True:
+            current = self.db_manager.get_conversation_summary(conversation_id)
+            watermark = current['watermark_id'] if current else 0
+            turns = self._next_chunk(auth_code, conversation_id, watermark, before_id)
+            if not turns:
+                return folded
+
+            prompt = SUMMARY_PROMPT.format(
+                summary=current['summary'] if current else "（无）",
+                turns="\n".join(self._format_turn(entry) for entry in turns)
+            )
+            summary = self._invoke(prompt)
+            if not summary:
+                return folded
+            # 水位线已被其他写入推进时放弃本次结果
+            if not self.db_manager.save_conversation_summary(conversation_id, summary, turns[-1]['id']):
+                return folded
+            folded += len(turns)
+
+    def _invoke(self, prompt):
+        if self.resilience is not None:
+            return self.resilience.call(self._invoke_once, prompt)
+        return self._invoke_once(prompt)
+    
+    def _invoke_once(self, prompt):
+        if self.scheduler is None:
+            return self._get_llm().invoke(prompt).content.strip()
+        prompt_tokens = count_tokens(prompt)
+        with self.scheduler.slot(self.model, prompt_tokens + SUMMARY_MAX_TOKENS, PRIORITY_BACKGROUND) as ticket:
+            summary = self._get_llm().invoke(prompt).content.strip()
+            ticket.used_tokens = prompt_tokens + count_tokens(summary)
+        return summary
+    
+    def _next_chunk(self, auth_code, conversation_id, watermark, before_id):
+        """取水位线之后一块不超过 SUMMARY_CHUNK_TOKENS 的消息，至少包含一条"""
+        entries = self.db_manager.get_conversation_messages(
+            auth_code, conversation_id, after_id=watermark, before_id=before_id,
+            limit=100, newest_first=False)
+        chunk = []
+        used = 0
+        for entry in entries:
+            tokens = count_tokens(entry['message'])
+            if chunk and used + tokens > SUMMARY_CHUNK_TOKENS:
+                break
+            if tokens > SUMMARY_CHUNK_TOKENS:
+                entry['message'] = entry['message'][:SUMMARY_CHUNK_TOKENS] + _TRUNCATED_MARK
+                tokens = SUMMARY_CHUNK_TOKENS
+            chunk.append(entry)
+            used += tokens
+        return chunk
+
+    @staticmethod
+    def _format_turn(entry):
+        role = "用户" if entry['is_user'] else "AI"
+        return f"{role}: {entry['message']}"
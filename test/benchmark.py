@@ -0,0 +1,255 @@
+"""
+ChatCore 端到端压测
+
+默认在本地启动 test/mock_server.py 中的模拟接口，无需联网；使用独立的临时数据库，不影响聊天记录。
+每个请求新建一个对话，统计吞吐量以及首 token 延迟、排队、生成速度、总耗时等的分布。
+
+    python test/benchmark.py --mode stream --requests 100 --concurrency 8 --ttft 0.5 --rate 40
+    python test/benchmark.py --mode astream --requests 200 --concurrency 32 --error-rate 0.05
+    python test/benchmark.py --mode chat --url http://127.0.0.1:8000/v1/chat/completions
+
+模式：chat（ChatCore.chat）、stream（ChatCore.stream_chat）在线程中运行，每个线程一个 ChatCore；
+astream（ChatCore.astream_chat）在共享事件循环（utils/async_runtime.py）中并发运行，
+与界面一样共用一个 ChatCore、请求调度器和异步连接池。
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+# 添加上级目录到Python路径
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.dirname(CURRENT_DIR))
+sys.path.append(CURRENT_DIR)
+
+from chat_interface import ChatCore
+from utils.http_client import close_http_client
+from utils.async_runtime import get_async_runtime, stop_async_runtime
+from utils.metrics import TurnMetrics, summarize
+from mock_server import MockOpenAIServer, add_config_arguments, config_from_args
+
+# 报告中的统计项：(字段, 名称, 是否为耗时)
+REPORT_FIELDS = [
+    ("queue_wait", "排队等待", True),
+    ("request_start", "发出请求", True),
+    ("ttft", "首 token 延迟", True),
+    ("max_gap", "最大 token 间隔", True),
+    ("tokens_per_second", "生成速度 token/秒", False),
+    ("total", "总耗时", True),
+    ("db_enqueue", "保存消息（入队）", True),
+]
+
+
+def make_question(index):
+    return f"第 {index} 个压测问题：请简单介绍一下流式输出。"
+
+
+def create_chat_core(args, db_path):
+    chat_core = ChatCore(args.api_key, args.url, db_path=db_path)
+    chat_core.current_model = args.model
+    if args.no_rate_limit:
+        # 不按模型限流，测量接口和 ChatCore 本身的吞吐量
+        chat_core.scheduler.limits = {}
+        chat_core.scheduler.default_limit = {}
+    return chat_core
+
+
+def new_conversation(chat_core, index):
+    return chat_core.db_manager.create_conversation(os.environ['AUTH_CODE'], f"压测 {index}")
+
+
+def run_sync(args, db_path):
+    """chat / stream 模式：每个线程一个 ChatCore，依次处理分配到的请求"""
+    # 依次创建，避免同时初始化数据库
+    cores = [create_chat_core(args, db_path) for _ in range(args.concurrency)]
+    indexes = itertools.count()
+    lock = threading.Lock()
+    results = []
+
+    def worker(chat_core):
+        while True:
+            with lock:
+                index = next(indexes)
+            if index >= args.requests:
+                return
+            chat_core.current_conversation_id = new_conversation(chat_core, index)
+            metrics = TurnMetrics(args.model, chat_core.current_conversation_id)
+            try:
+                if args.mode == "chat":
+                    metrics.finish(chat_core.chat(make_question(index)))
+                else:
+                    for _ in chat_core.stream_chat(make_question(index), metrics=metrics):
+                        pass
+                error = None
+            except Exception as e:
+                metrics.status = "error"
+                error = type(e).__name__
+            with lock:
+                results.append((metrics, error))
+
+    threads = [threading.Thread(target=worker, args=(chat_core,)) for chat_core in cores]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    stats = {"scheduler": {}, "resilience": {}}
+    for chat_core in cores:
+        _merge_stats(stats, chat_core)
+        chat_core.close()
+    return results, elapsed, stats
+
+
+async def _run_async(args, chat_core):
+    semaphore = asyncio.Semaphore(args.concurrency)
+    results = []
+
+    async def one(index):
+        async with semaphore:
+            conversation_id = await chat_core.adb.run(new_conversation, chat_core, index)
+            metrics = TurnMetrics(args.model, conversation_id)
+            error = None
+            try:
+                async for _ in chat_core.astream_chat(make_question(index), conversation_id=conversation_id,
+                                                      metrics=metrics):
+                    pass
+            except Exception as e:
+                error = type(e).__name__
+            results.append((metrics, error))
+
+    await asyncio.gather(*(one(index) for index in range(args.requests)))
+    return results
+
+
+def run_async(args, db_path):
+    """astream 模式：所有请求在共享事件循环中并发，共用一个 ChatCore"""
+    chat_core = create_chat_core(args, db_path)
+    start = time.perf_counter()
+    # 异步连接池属于共享事件循环，请求必须在其中发出
+    results = get_async_runtime().run(_run_async(args, chat_core))
+    elapsed = time.perf_counter() - start
+    stats = {"scheduler": {}, "resilience": {}}
+    _merge_stats(stats, chat_core)
+    chat_core.close()
+    return results, elapsed, stats
+
+
+def _merge_stats(stats, chat_core):
+    """汇总多个 ChatCore 的调度和重试统计"""
+    for model, model_stats in chat_core.get_scheduler_stats().items():
+        merged = stats["scheduler"].setdefault(model, {"granted": 0, "max_wait_ms": 0.0, "tokens_used": 0})
+        merged["granted"] += model_stats["granted"]
+        merged["max_wait_ms"] = max(merged["max_wait_ms"], model_stats["max_wait_ms"])
+        merged["tokens_used"] += model_stats["tokens_used"]
+    resilience = chat_core.get_resilience_stats()
+    merged = stats["resilience"]
+    for path, wins in resilience["wins"].items():
+        merged.setdefault("wins", {}).setdefault(path, 0)
+        merged["wins"][path] += wins
+    for name in ("retries", "hedges", "failures"):
+        merged[name] = merged.get(name, 0) + resilience[name]
+
+
+def build_report(args, results, elapsed, stats, server_stats):
+    ok = [metrics for metrics, error in results if error is None and metrics.status == "ok"]
+    errors = {}
+    for metrics, error in results:
+        if error is not None:
+            errors[error] = errors.get(error, 0) + 1
+    tokens = sum(metrics.tokens for metrics in ok)
+    latency = summarize([metrics.as_row() for metrics in ok], fields=[field for field, _, _ in REPORT_FIELDS])
+    return {
+        "mode": args.mode,
+        "requests": args.requests,
+        "concurrency": args.concurrency,
+        "succeeded": len(ok),
+        "failed": len(results) - len(ok),
+        "errors": errors,
+        "elapsed": elapsed,
+        "requests_per_second": len(ok) / elapsed if elapsed > 0 else 0.0,
+        "tokens_per_second": tokens / elapsed if elapsed > 0 else 0.0,
+        "latency": latency.get(args.model, {}),
+        "scheduler": stats["scheduler"],
+        "resilience": stats["resilience"],
+        "server": server_stats,
+    }
+
+
+def print_report(report):
+    print(f"模式 {report['mode']}，请求 {report['requests']} 个，并发 {report['concurrency']}")
+    print(f"成功 {report['succeeded']} 个，失败 {report['failed']} 个 {report['errors'] or ''}")
+    print(f"耗时 {report['elapsed']:.2f} 秒，吞吐量 {report['requests_per_second']:.2f} 请求/秒，"
+          f"{report['tokens_per_second']:.1f} token/秒")
+    print()
+    print(f"{'指标':<16}{'样本数':>8}{'p50':>12}{'p95':>12}{'p99':>12}")
+    for field, name, is_time in REPORT_FIELDS:
+        values = report["latency"].get(field)
+        if not values:
+            continue
+        cells = []
+        for q in ("p50", "p95", "p99"):
+            cells.append(f"{values[q] * 1000:.1f} ms" if is_time else f"{values[q]:.1f}")
+        print(f"{name:<16}{values['count']:>8}{cells[0]:>12}{cells[1]:>12}{cells[2]:>12}")
+    print()
+    print(f"调度: {json.dumps(report['scheduler'], ensure_ascii=False)}")
+    print(f"重试与对冲: {json.dumps(report['resilience'], ensure_ascii=False)}")
+    if report["server"]:
+        print(f"模拟接口: {json.dumps(report['server'], ensure_ascii=False)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ChatCore 端到端压测")
+    parser.add_argument("--mode", choices=["chat", "stream", "astream"], default="stream")
+    parser.add_argument("--requests", type=int, default=50, help="请求总数")
+    parser.add_argument("--concurrency", type=int, default=4, help="并发数")
+    parser.add_argument("--model", default="mock-model")
+    parser.add_argument("--url", default=None, help="接口地址，为空时启动本地模拟接口")
+    parser.add_argument("--api-key", default="mock-key")
+    parser.add_argument("--db", default=None, help="数据库路径，为空时使用临时数据库并在结束后删除")
+    parser.add_argument("--no-rate-limit", action="store_true", help="不按模型限流")
+    parser.add_argument("--json", default=None, help="把结果另存为 JSON 文件")
+    add_config_arguments(parser)
+    args = parser.parse_args()
+
+    os.environ['AUTH_CODE'] = 'benchmark'
+    server = None
+    if args.url is None:
+        server = MockOpenAIServer(config_from_args(args)).start()
+        args.url = server.url
+    temp_dir = None
+    db_path = args.db
+    if db_path is None:
+        temp_dir = tempfile.mkdtemp(prefix="chat_benchmark_")
+        db_path = os.path.join(temp_dir, "benchmark.db")
+
+    try:
+        if args.mode == "astream":
+            results, elapsed, stats = run_async(args, db_path)
+        else:
+            results, elapsed, stats = run_sync(args, db_path)
+        report = build_report(args, results, elapsed, stats, server.stats() if server else None)
+    finally:
+        stop_async_runtime()
+        close_http_client()
+        if server is not None:
+            server.stop()
+        if temp_dir is not None:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+    print_report(report)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
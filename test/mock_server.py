@@ -0,0 +1,278 @@
+"""
+本地模拟的 OpenAI 兼容接口
+
+只依赖标准库，无需联网。实现 POST /v1/chat/completions（流式 SSE 和非流式）和 GET /v1/models，
+可以配置首 token 延迟、生成速度、回答长度、错误注入和最大并发数，用于离线测试和压测 ChatCore。
+
+单独运行：
+    python test/mock_server.py --port 8000 --ttft 0.5 --rate 40 --length 200
+然后在 .env 中设置 API_URL=http://127.0.0.1:8000/v1/chat/completions
+
+在代码中使用（端口为 0 时自动分配）：
+    server = MockOpenAIServer(MockServerConfig(ttft=0.2)).start()
+    ... server.url ...
+    server.stop()
+"""
+
+import argparse
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# 模拟回答使用的词，每个词作为一个 token 输出
+_WORDS = ["这是", "一段", "模拟", "的", "回答", "，", "用于", "离线", "测试", "流式", "输出", "。",
+          " mock", " token", " stream", " test", "\n"]
+
+
+class MockServerConfig:
+    """模拟接口的行为配置，运行中修改立即对之后的请求生效"""
+
+    def __init__(self, ttft=0.3, ttft_jitter=0.0, tokens_per_second=50.0, answer_tokens=100,
+                 error_rate=0.0, error_status=500, disconnect_rate=0.0, max_concurrency=0, seed=None,
+                 fail_first=0):
+        self.ttft = ttft  # 首 token 延迟（秒）
+        self.ttft_jitter = ttft_jitter  # 首 token 延迟在 ±ttft_jitter 内随机浮动
+        self.tokens_per_second = tokens_per_second  # 生成速度，0 表示不限
+        self.answer_tokens = answer_tokens  # 回答长度（token 数）
+        self.error_rate = error_rate  # 在输出任何内容之前返回 error_status 的概率
+        self.error_status = error_status
+        self.fail_first = fail_first  # 前 fail_first 个请求一定返回 error_status（测试重试时使用）
+        self.disconnect_rate = disconnect_rate  # 输出一半后断开连接的概率
+        self.max_concurrency = max_concurrency  # 同时处理的请求数上限，超过时返回 429，0 表示不限
+        self.random = random.Random(seed)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # 保持连接，与真实接口一样可以复用连接
+
+    def log_message(self, format, *args):
+        # 不输出每个请求的访问日志
+        pass
+
+    def do_GET(self):
+        if self.path.rstrip("/").endswith("/models"):
+            self._send_json(200, {"object": "list", "data": [{"id": "mock-model", "object": "model"}]})
+        else:
+            self._send_json(404, {"error": {"message": "not found"}})
+
+    def do_POST(self):
+        server = self.server
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length)
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self._send_json(404, {"error": {"message": "not found"}})
+            return
+        try:
+            request = json.loads(body or b"{}")
+        except ValueError:
+            self._send_json(400, {"error": {"message": "invalid json", "type": "invalid_request_error"}})
+            return
+
+        if not server.enter():
+            server.count("rejected")
+            self._send_json(429, {"error": {"message": "too many concurrent requests", "type": "rate_limit"}},
+                            {"Retry-After": "1"})
+            return
+        try:
+            self._complete(request)
+        except (BrokenPipeError, ConnectionResetError):
+            # 客户端取消了请求
+            server.count("client_closed")
+        finally:
+            server.leave()
+
+    def _complete(self, request):
+        server = self.server
+        config = server.config
+        server.count("requests")
+        with server.lock:
+            error = config.random.random() < config.error_rate
+            if config.fail_first > 0:
+                config.fail_first -= 1
+                error = True
+            disconnect = config.random.random() < config.disconnect_rate
+            ttft = max(0.0, config.ttft + config.random.uniform(-config.ttft_jitter, config.ttft_jitter))
+        model = request.get("model", "mock-model")
+        tokens = [_WORDS[i % len(_WORDS)] for i in range(config.answer_tokens)]
+        prompt_tokens = sum(len(str(message.get("content", ""))) for message in request.get("messages", []))
+
+        time.sleep(ttft)
+        if error:
+            server.count("errors")
+            self._send_json(config.error_status, {"error": {"message": "injected error", "type": "server_error"}})
+            return
+
+        interval = 1.0 / config.tokens_per_second if config.tokens_per_second > 0 else 0.0
+        if not request.get("stream"):
+            time.sleep(interval * max(0, len(tokens) - 1))
+            self._send_json(200, {
+                "id": f"chatcmpl-{uuid.uuid4().hex}",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(tokens)},
+                             "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": len(tokens),
+                          "total_tokens": prompt_tokens + len(tokens)},
+            })
+            server.count("completed")
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        created = int(time.time())
+
+        def event(delta, finish_reason=None):
+            return {"id": completion_id, "object": "chat.completion.chunk", "created": created, "model": model,
+                    "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]}
+
+        self._send_event(event({"role": "assistant", "content": ""}))
+        for i, token in enumerate(tokens):
+            if disconnect and i >= len(tokens) // 2:
+                # 不发送结束块直接断开，模拟连接中途中断
+                server.count("disconnects")
+                self.close_connection = True
+                return
+            if i and interval:
+                time.sleep(interval)
+            self._send_event(event({"content": token}))
+        self._send_event(event({}, "stop"))
+        self._send_chunk(b"data: [DONE]\n\n")
+        self._send_chunk(b"")
+        server.count("completed")
+
+    def _send_event(self, payload):
+        self._send_chunk(f"data: {json.dumps(payload, ensure_ascii=False)}\n\n".encode("utf-8"))
+
+    def _send_chunk(self, data):
+        # 分块传输编码，空块表示结束
+        self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+    def _send_json(self, status, payload, headers=None):
+        data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, config):
+        super().__init__(address, _Handler)
+        self.config = config
+        self.lock = threading.Lock()
+        self.active = 0
+        self.max_active = 0
+        self.counters = {"requests": 0, "completed": 0, "errors": 0, "disconnects": 0,
+                         "rejected": 0, "client_closed": 0}
+
+    def enter(self):
+        with self.lock:
+            if self.config.max_concurrency and self.active >= self.config.max_concurrency:
+                return False
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+            return True
+
+    def leave(self):
+        with self.lock:
+            self.active -= 1
+
+    def count(self, name):
+        with self.lock:
+            self.counters[name] += 1
+
+
+class MockOpenAIServer:
+    """在后台线程中运行的模拟接口"""
+
+    def __init__(self, config=None, host="127.0.0.1", port=0):
+        self.config = config or MockServerConfig()
+        self._server = _Server((host, port), self.config)
+        self._thread = None
+
+    @property
+    def url(self):
+        """接口地址，可以直接作为 ChatCore 的 api_url"""
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/v1/chat/completions"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name="MockOpenAIServer", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+    def stats(self):
+        """各类请求的计数和最大同时处理数"""
+        with self._server.lock:
+            stats = dict(self._server.counters)
+            stats["max_active"] = self._server.max_active
+        return stats
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def add_config_arguments(parser):
+    """添加模拟接口的命令行参数，压测脚本共用"""
+    parser.add_argument("--ttft", type=float, default=0.3, help="首 token 延迟（秒）")
+    parser.add_argument("--ttft-jitter", type=float, default=0.0, help="首 token 延迟的随机浮动（秒）")
+    parser.add_argument("--rate", type=float, default=50.0, help="生成速度（token/秒），0 表示不限")
+    parser.add_argument("--length", type=int, default=100, help="回答长度（token 数）")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="返回错误的概率")
+    parser.add_argument("--error-status", type=int, default=500, help="注入错误的 HTTP 状态码")
+    parser.add_argument("--disconnect-rate", type=float, default=0.0, help="输出一半后断开连接的概率")
+    parser.add_argument("--max-concurrency", type=int, default=0, help="最大并发数，超过时返回 429，0 表示不限")
+    parser.add_argument("--seed", type=int, default=None, help="随机数种子")
+
+
+def config_from_args(args):
+    return MockServerConfig(
+        ttft=args.ttft, ttft_jitter=args.ttft_jitter, tokens_per_second=args.rate, answer_tokens=args.length,
+        error_rate=args.error_rate, error_status=args.error_status, disconnect_rate=args.disconnect_rate,
+        max_concurrency=args.max_concurrency, seed=args.seed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="本地模拟的 OpenAI 兼容流式接口")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    add_config_arguments(parser)
+    args = parser.parse_args()
+
+    server = MockOpenAIServer(config_from_args(args), args.host, args.port)
+    print(f"模拟接口已启动: {server.url}")
+    try:
+        server._server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server._server.server_close()
+        print(json.dumps(server.stats(), ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
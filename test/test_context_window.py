@@ -0,0 +1,60 @@
+import os
+import sys
+
+import pytest
+
+# 添加上级目录到Python路径
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database.database import ChatDatabase
+from utils.history_cache import select_window
+from utils.tokenizer import count_tokens, count_message_tokens, truncate_tokens, TRUNCATION_MARK
+
+
+@pytest.fixture
+def db(tmp_path):
+    db = ChatDatabase(str(tmp_path / "chat.db"), write_behind=False, archive_path="")
+    yield db
+    db.close()
+
+
+def make_conversation(db, messages):
+    conversation_id = db.create_conversation("user", "对话")
+    for i, message in enumerate(messages):
+        db.save_message_to_conversation("user", conversation_id, message, i % 2 == 0)
+    return conversation_id
+
+
+def test_truncate_tokens_keeps_the_end():
+    text = "开头" * 200 + "最后的问题是什么"
+    truncated = truncate_tokens(text, 20)
+    assert truncated.startswith(TRUNCATION_MARK)
+    assert truncated.endswith("最后的问题是什么")
+    assert count_tokens(truncated) <= 20
+    assert truncate_tokens("短消息", 20) == "短消息"
+
+
+def test_context_stays_within_budget(db):
+    messages = [f"第 {i} 条消息" for i in range(10)]
+    conversation_id = make_conversation(db, messages)
+    budget = sum(count_message_tokens(count_tokens(m)) for m in messages[-3:])
+
+    context = db.get_conversation_context("user", conversation_id, max_tokens=budget)
+    assert [entry['message'] for entry in context] == messages[-3:]
+
+
+def test_context_always_includes_latest_message(db):
+    question = "背景资料" * 500 + "请总结上面的内容"
+    conversation_id = make_conversation(db, ["你好", "你好！", question])
+
+    context = db.get_conversation_context("user", conversation_id, max_tokens=50)
+    assert len(context) == 1
+    assert context[0]['message'].endswith("请总结上面的内容")
+    assert count_message_tokens(context[0]['token_count']) <= 50
+
+    # 内存缓存选窗口的结果与数据库一致
+    loaded = db.get_conversation_context("user", conversation_id, max_tokens=100000)
+    window = select_window(loaded, 50)
+    assert [entry['message'] for entry in window] == [context[0]['message']]
+    # 截断的是副本，缓存中的原消息不变
+    assert loaded[-1]['message'] == question
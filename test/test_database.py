@@ -0,0 +1,191 @@
+import os
+import sys
+import sqlite3
+
+import pytest
+
+# 添加上级目录到Python路径
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database.database import ChatDatabase
+from database.migrations import MIGRATIONS, get_schema_version
+from database.transfer import export_jsonl, import_jsonl
+
+# 超过压缩阈值的消息
+LONG_MESSAGE = "压缩测试 " + "这是一段很长的回答内容，用来触发压缩。" * 400 + " 结尾关键词 zebra"
+
+
+def open_db(tmp_path, name="chat.db", archive=False):
+    archive_path = str(tmp_path / f"{name}.archive") if archive else ""
+    return ChatDatabase(str(tmp_path / name), write_behind=False, archive_path=archive_path)
+
+
+@pytest.fixture
+def db(tmp_path):
+    db = open_db(tmp_path)
+    yield db
+    db.close()
+
+
+@pytest.fixture
+def archive_db(tmp_path):
+    db = open_db(tmp_path, archive=True)
+    yield db
+    db.close()
+
+
+def check_fts(db):
+    """全文索引与消息表一致（压缩消息的索引由应用维护），不一致时报 database disk image is malformed"""
+    conn = db.connections.get_connection()
+    conn.execute("INSERT INTO chat_history_fts (chat_history_fts, rank) VALUES ('integrity-check', 1)")
+
+
+def messages_of(db, conversation_id, auth_code="user"):
+    return [(entry['message'], bool(entry['is_user']))
+            for entry in db.get_conversation_messages(auth_code, conversation_id, newest_first=False, limit=100)]
+
+
+def test_migrations_upgrade_old_database(tmp_path):
+    path = str(tmp_path / "old.db")
+    # 没有版本记录的旧数据库
+    conn = sqlite3.connect(path)
+    conn.executescript("""
+        CREATE TABLE users (id INTEGER PRIMARY KEY AUTOINCREMENT, auth_code TEXT UNIQUE NOT NULL,
+                            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP);
+        CREATE TABLE conversations (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER, title TEXT NOT NULL,
+                                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP);
+        CREATE TABLE chat_history (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER, conversation_id INTEGER,
+                                   message TEXT NOT NULL, is_user BOOLEAN NOT NULL,
+                                   timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP);
+        INSERT INTO users (auth_code) VALUES ('user');
+        INSERT INTO conversations (user_id, title) VALUES (1, '旧对话');
+        INSERT INTO chat_history (user_id, conversation_id, message, is_user) VALUES (1, 1, '旧消息 giraffe', 1);
+    """)
+    conn.commit()
+    conn.close()
+
+    db = ChatDatabase(path, write_behind=False, archive_path="")
+    try:
+        conn = db.connections.get_connection()
+        assert get_schema_version(conn) == MIGRATIONS[-1][0]
+        assert messages_of(db, 1) == [("旧消息 giraffe", True)]
+        # 已有消息建立了全文索引和对话摘要
+        assert [r['conversation_id'] for r in db.search_messages("user", "giraffe")] == [1]
+        conversation = db.get_user_conversations("user")[0]
+        assert conversation['message_count'] == 1
+        assert conversation['last_snippet'] == "旧消息 giraffe"
+        check_fts(db)
+    finally:
+        db.close()
+
+    # 再次打开时不重复执行迁移
+    db = ChatDatabase(path, write_behind=False, archive_path="")
+    try:
+        assert get_schema_version(db.connections.get_connection()) == MIGRATIONS[-1][0]
+    finally:
+        db.close()
+
+
+def test_compression_round_trip(db):
+    conversation_id = db.create_conversation("user", "压缩")
+    db.save_message_to_conversation("user", conversation_id, LONG_MESSAGE, True)
+    db.save_message_to_conversation("user", conversation_id, "短回答", False)
+
+    conn = db.connections.get_connection()
+    codecs = [row['codec'] for row in conn.execute("SELECT codec FROM chat_history ORDER BY id")]
+    assert codecs[0] is not None and codecs[1] is None
+    assert messages_of(db, conversation_id) == [(LONG_MESSAGE, True), ("短回答", False)]
+
+    # 全部解压后再按默认配置压缩，内容和索引保持一致
+    assert db.recompress_messages(codec="") == 1
+    assert db.recompress_messages() == 1
+    assert messages_of(db, conversation_id) == [(LONG_MESSAGE, True), ("短回答", False)]
+    check_fts(db)
+
+
+def test_search_finds_plain_and_compressed_messages(db):
+    first = db.create_conversation("user", "第一个")
+    second = db.create_conversation("user", "第二个")
+    db.save_message_to_conversation("user", first, "python zebra 排序", True)
+    db.save_message_to_conversation("user", second, LONG_MESSAGE, False)
+    db.save_message_to_conversation("other", db.create_conversation("other", "别人的"), "zebra", True)
+
+    results = db.search_messages("user", "zebra")
+    assert sorted(r['conversation_id'] for r in results) == [first, second]
+    assert all("zebra" in r['snippet'] for r in results)
+    # 短关键词逐行匹配
+    assert [r['conversation_id'] for r in db.search_messages("user", "排序")] == [first]
+    assert db.search_messages("user", "   ") == []
+
+    # 删除对话后索引中的记录一并删除
+    db.delete_conversation("user", second)
+    assert [r['conversation_id'] for r in db.search_messages("user", "zebra")] == [first]
+    check_fts(db)
+
+
+def test_legacy_messages_and_clear_keep_index_consistent(db):
+    db.save_message("user", LONG_MESSAGE, True)
+    conversation_id = db.create_conversation("user", "对话")
+    db.save_message_to_conversation("user", conversation_id, LONG_MESSAGE, True)
+    check_fts(db)
+
+    db.clear_user_history("user")
+    assert db.get_chat_history("user") == []
+    check_fts(db)
+
+
+def test_archive_and_rehydrate(archive_db):
+    db = archive_db
+    idle = db.create_conversation("user", "闲置")
+    active = db.create_conversation("user", "活跃")
+    db.save_message_to_conversation("user", idle, "旧问题 zebra", True)
+    db.save_message_to_conversation("user", idle, LONG_MESSAGE, False)
+    db.save_message_to_conversation("user", active, "新问题", True)
+    with db.connections.transaction() as conn:
+        conn.execute("UPDATE chat_history SET timestamp = datetime('now', '-60 days') WHERE conversation_id = ?",
+                     (idle,))
+        conn.execute("UPDATE conversations SET created_at = datetime('now', '-60 days')")
+
+    with pytest.raises(ValueError):
+        db.archive_idle_conversations(idle_days=0)
+    assert db.archive_idle_conversations(idle_days=30) == 1
+
+    conn = db.connections.get_connection()
+    assert conn.execute("SELECT COUNT(*) FROM main.chat_history WHERE conversation_id = ?",
+                        (idle,)).fetchone()[0] == 0
+    # 归档后对话仍在列表中，摘要列不变
+    conversations = {c['id']: c for c in db.get_user_conversations("user")}
+    assert conversations[idle]['message_count'] == 2
+    check_fts(db)
+
+    # 读取时移回主库
+    assert messages_of(db, idle) == [("旧问题 zebra", True), (LONG_MESSAGE, False)]
+    assert conn.execute("SELECT COUNT(*) FROM main.chat_history WHERE conversation_id = ?",
+                        (idle,)).fetchone()[0] == 2
+    assert {r['conversation_id'] for r in db.search_messages("user", "zebra")} == {idle}
+    assert {c['id']: c for c in db.get_user_conversations("user")}[idle]['message_count'] == 2
+    check_fts(db)
+
+
+def test_jsonl_export_import(tmp_path, db):
+    conversation_id = db.create_conversation("user", "导出")
+    db.save_message_to_conversation("user", conversation_id, "问题 zebra", True)
+    db.save_message_to_conversation("user", conversation_id, LONG_MESSAGE, False, truncated=True)
+    path = str(tmp_path / "export.jsonl.gz")
+    export_jsonl(db, path)
+
+    target = open_db(tmp_path, "target.db")
+    try:
+        counts = import_jsonl(target, path)
+        assert counts["message"] == 2
+        conversations = target.get_user_conversations("user")
+        assert [c['title'] for c in conversations] == ["导出"]
+        imported = conversations[0]['id']
+        assert messages_of(target, imported) == [("问题 zebra", True), (LONG_MESSAGE, False)]
+        conn = target.connections.get_connection()
+        assert [row['truncated'] for row in conn.execute("SELECT truncated FROM chat_history ORDER BY id")] == [0, 1]
+        assert len(target.search_messages("user", "zebra")) == 2
+        assert conversations[0]['last_snippet'] == LONG_MESSAGE[:80]
+        check_fts(target)
+    finally:
+        target.close()
@@ -0,0 +1,52 @@
+import os
+import sys
+
+# 添加上级目录到Python路径
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.history_cache import HistoryCache
+
+
+def message(text, message_id=None):
+    return {'id': message_id, 'message': text, 'is_user': True, 'timestamp': None, 'token_count': 1}
+
+
+def test_append_extends_cached_history():
+    cache = HistoryCache(max_bytes=1 << 20)
+    key = ("user", 1)
+    cache.put(key, [message("问题", 1)], budget=100)
+    cache.append(key, message("回答"))
+    assert [entry['message'] for entry in cache.select(key, 100)] == ["问题", "回答"]
+
+
+def test_stale_load_does_not_overwrite_append():
+    cache = HistoryCache(max_bytes=1 << 20)
+    key = ("user", 1)
+    cache.put(key, [message("问题", 1)], budget=100)
+    cache.invalidate(key)
+
+    # 加载开始后另一个线程追加了新消息，加载结果已经过时
+    version = cache.version(key)
+    loaded = [message("问题", 1)]
+    cache.append(key, message("回答"))
+    assert not cache.put(key, loaded, 100, version)
+    assert cache.select(key, 100) is None
+
+    version = cache.version(key)
+    assert cache.put(key, [message("问题", 1), message("回答", 2)], 100, version)
+    assert len(cache.select(key, 100)) == 2
+
+
+def test_invalidate_user_drops_only_that_user():
+    cache = HistoryCache(max_bytes=1 << 20)
+    cache.put(("alice", 1), [message("a")], budget=100)
+    cache.put(("alice", 2), [message("b")], budget=100)
+    cache.put(("bob", 3), [message("c")], budget=100)
+
+    version = cache.version(("alice", 4))
+    cache.invalidate_user("alice")
+    assert cache.select(("alice", 1), 100) is None
+    assert cache.select(("alice", 2), 100) is None
+    assert cache.select(("bob", 3), 100) is not None
+    # 清除前开始的加载不能再写入缓存
+    assert not cache.put(("alice", 4), [message("d")], 100, version)
@@ -0,0 +1,223 @@
+import os
+import sys
+import time
+import asyncio
+import threading
+
+import pytest
+
+# 添加上级目录到Python路径
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+httpx = pytest.importorskip("httpx")
+
+from utils import resilience
+from utils.resilience import ResilientStreamer
+from utils.cancellation import CancellationToken
+from mock_server import MockOpenAIServer, MockServerConfig
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(resilience, "backoff_delay", lambda attempt, base=None, cap=None: 0)
+
+
+def collect(streamer, make_stream, model="model-a", **kwargs):
+    info = {}
+
+    async def run():
+        return [chunk async for chunk in streamer.astream(make_stream, model, info, **kwargs)]
+
+    return asyncio.run(run()), info
+
+
+def flaky_stream(failures, exc_type=ConnectionError, chunks=("你", "好")):
+    """前 failures 次调用在输出之前失败"""
+    calls = []
+
+    async def make_stream(model, timing):
+        calls.append(model)
+        timing["start"] = time.monotonic()
+        if len(calls) <= failures:
+            raise exc_type("injected")
+        for chunk in chunks:
+            yield chunk
+
+    return make_stream, calls
+
+
+def test_retries_before_first_token():
+    streamer = ResilientStreamer(max_attempts=3, hedge_enabled=False)
+    make_stream, calls = flaky_stream(failures=2)
+    chunks, info = collect(streamer, make_stream)
+    assert chunks == ["你", "好"]
+    assert len(calls) == 3
+    assert info == {"model": "model-a", "path": "retry"}
+    assert streamer.stats()["retries"] == 2
+
+
+def test_gives_up_after_max_attempts():
+    streamer = ResilientStreamer(max_attempts=2, hedge_enabled=False)
+    make_stream, calls = flaky_stream(failures=5)
+    with pytest.raises(ConnectionError):
+        collect(streamer, make_stream)
+    assert len(calls) == 2
+    assert streamer.stats()["failures"] == 1
+
+
+def test_non_retryable_error_is_raised_immediately():
+    streamer = ResilientStreamer(max_attempts=3, hedge_enabled=False)
+    make_stream, calls = flaky_stream(failures=1, exc_type=ValueError)
+    with pytest.raises(ValueError):
+        collect(streamer, make_stream)
+    assert len(calls) == 1
+
+
+def test_error_after_first_token_is_not_retried():
+    streamer = ResilientStreamer(max_attempts=3, hedge_enabled=False)
+    calls = []
+
+    async def make_stream(model, timing):
+        calls.append(model)
+        yield "部分"
+        raise ConnectionError("断开")
+
+    received = []
+
+    async def run():
+        async for chunk in streamer.astream(make_stream, "model-a"):
+            received.append(chunk)
+
+    with pytest.raises(ConnectionError):
+        asyncio.run(run())
+    assert received == ["部分"]
+    assert len(calls) == 1
+
+
+def test_hedge_wins_when_primary_is_slow():
+    streamer = ResilientStreamer(max_attempts=1, hedge_enabled=True, equivalent_models={"model-a": "model-b"})
+    streamer.hedge_delay = lambda model: 0.05
+    closed = []
+
+    async def make_stream(model, timing):
+        try:
+            if model == "model-a":
+                await asyncio.sleep(10)
+            yield model
+        finally:
+            closed.append(model)
+
+    chunks, info = collect(streamer, make_stream)
+    assert chunks == ["model-b"]
+    assert info == {"model": "model-b", "path": "hedge"}
+    # 落败的主请求被取消
+    assert "model-a" in closed
+
+
+def test_retry_reaches_mock_server_after_connect_error():
+    """第一次连接被拒绝（端口没有监听），重试连到模拟接口并读完整个流"""
+    with MockOpenAIServer(MockServerConfig(ttft=0.01, tokens_per_second=0, answer_tokens=5)) as server:
+        dead_url = "http://127.0.0.1:9/v1/chat/completions"
+        urls = [dead_url, server.url]
+
+        async def make_stream(model, timing):
+            url = urls.pop(0)
+            async with httpx.AsyncClient() as client:
+                request = {"model": model, "stream": True, "messages": [{"role": "user", "content": "你好"}]}
+                async with client.stream("POST", url, json=request) as response:
+                    response.raise_for_status()
+                    async for line in response.aiter_lines():
+                        if line.startswith("data: ") and line != "data: [DONE]":
+                            yield line
+
+        streamer = ResilientStreamer(max_attempts=2, hedge_enabled=False)
+        chunks, info = collect(streamer, make_stream)
+        assert len(chunks) >= 5
+        assert info["path"] == "retry"
+        assert server.stats()["completed"] == 1
+
+
+def test_cancel_closes_upstream_stream():
+    """取消令牌取消生成任务后，模拟接口上的连接随之关闭"""
+    config = MockServerConfig(ttft=0.01, tokens_per_second=20, answer_tokens=200)
+    with MockOpenAIServer(config) as server:
+        async def make_stream(model, timing):
+            async with httpx.AsyncClient() as client:
+                request = {"model": model, "stream": True, "messages": [{"role": "user", "content": "你好"}]}
+                async with client.stream("POST", server.url, json=request) as response:
+                    async for line in response.aiter_lines():
+                        if line.startswith("data: "):
+                            yield line
+
+        streamer = ResilientStreamer(max_attempts=1, hedge_enabled=False)
+        token = CancellationToken()
+        received = []
+
+        async def consume():
+            token.bind_current_task()
+            async for chunk in streamer.astream(make_stream, "model-a"):
+                received.append(chunk)
+                if len(received) == 2:
+                    # 模拟界面线程点击停止
+                    threading.Thread(target=token.cancel).start()
+
+        with pytest.raises(asyncio.CancelledError):
+            asyncio.run(consume())
+        assert 2 <= len(received) < 200
+
+        deadline = time.monotonic() + 5
+        while server.stats()["client_closed"] == 0 and time.monotonic() < deadline:
+            time.sleep(0.05)
+        assert server.stats()["client_closed"] == 1
+        assert server.stats()["completed"] == 0
+
+
+@pytest.fixture
+def chat_core(tmp_path, monkeypatch):
+    pytest.importorskip("langchain_openai")
+    from chat_interface import ChatCore
+
+    monkeypatch.setenv("AUTH_CODE", "user")
+    server = MockOpenAIServer(MockServerConfig(ttft=0.01, tokens_per_second=50, answer_tokens=100)).start()
+    chat_core = ChatCore("test-key", server.url, db_path=str(tmp_path / "chat.db"))
+    chat_core.current_model = "mock-model"
+    chat_core.resilience.hedge_enabled = False
+    yield chat_core, server
+    chat_core.close()
+    server.stop()
+
+
+def test_chat_core_retries_server_error(chat_core):
+    chat_core, server = chat_core
+    server.config.fail_first = 1
+    server.config.tokens_per_second = 0
+    answer = "".join(chat_core.stream_chat("你好"))
+    assert answer
+    assert server.stats()["errors"] == 1
+    assert server.stats()["completed"] == 1
+    assert chat_core.resilience.stats()["wins"]["retry"] == 1
+
+    chat_core.db_manager.flush()
+    messages = chat_core.db_manager.get_conversation_messages(
+        "user", chat_core.current_conversation_id, newest_first=False, limit=10)
+    assert [m['message'] for m in messages] == ["你好", answer]
+
+
+def test_chat_core_saves_truncated_answer_on_cancel(chat_core):
+    chat_core, server = chat_core
+    token = CancellationToken()
+    received = []
+    for chunk in chat_core.stream_chat("你好", cancel_token=token):
+        received.append(chunk)
+        if len(received) == 3:
+            token.cancel()
+    assert 3 <= len(received) < 100
+
+    chat_core.db_manager.flush()
+    conn = chat_core.db_manager.connections.get_connection()
+    rows = conn.execute("SELECT message, truncated FROM chat_history WHERE is_user = 0").fetchall()
+    assert len(rows) == 1
+    assert rows[0]['truncated'] == 1
+    # 取消前已生成但界面还没读取的部分也一并保存
+    assert rows[0]['message'].startswith("".join(received))
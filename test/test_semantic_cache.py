@@ -0,0 +1,54 @@
+import os
+import sys
+
+import pytest
+
+# 添加上级目录到Python路径
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database.database import ChatDatabase
+from utils.semantic_cache import content_tokens
+
+
+def test_content_tokens_ignore_wording():
+    assert content_tokens("How do I sort a list in Python?") == content_tokens("how to sort a list in python")
+    assert content_tokens("如何把列表排序？") == content_tokens("怎样把列表排序")
+
+
+def test_content_tokens_keep_differences():
+    assert content_tokens("sort a list ascending") != content_tokens("sort a list descending")
+    assert content_tokens("列表按升序排序") != content_tokens("列表按降序排序")
+    assert content_tokens("top 5 languages") != content_tokens("top 10 languages")
+
+
+@pytest.fixture
+def semantic_cache(tmp_path):
+    pytest.importorskip("numpy")
+    from utils.semantic_cache import SemanticCache
+
+    db = ChatDatabase(str(tmp_path / "chat.db"), write_behind=False, archive_path="")
+    # 较低的阈值保证下面的问题都能进入实词比较
+    yield SemanticCache(db, threshold=0.8, index_dir=str(tmp_path / "index"))
+    db.close()
+
+
+def test_near_miss_is_not_a_hit(semantic_cache):
+    semantic_cache.add("user", "model", "sort a list ascending", "use sorted(items)")
+
+    # 两个问题的向量相似度超过阈值，但实词不同
+    vector = semantic_cache.embedder.embed("sort a list ascending")
+    other = semantic_cache.embedder.embed("sort a list descending")
+    assert float(vector @ other) >= semantic_cache.threshold
+
+    assert semantic_cache.lookup("user", "model", "sort a list descending") is None
+    assert semantic_cache.rejected == 1
+
+
+def test_rephrased_question_hits(semantic_cache):
+    semantic_cache.add("user", "model", "How do I sort a list ascending?", "use sorted(items)")
+
+    entry = semantic_cache.lookup("user", "model", "how to sort a list ascending")
+    assert entry is not None
+    assert entry["answer"] == "use sorted(items)"
+    # 不同模型的缓存互不影响
+    assert semantic_cache.lookup("user", "other-model", "how to sort a list ascending") is None
@@ -0,0 +1,101 @@
+import os
+import sys
+import sqlite3
+import time
+from contextlib import contextmanager
+
+# 添加上级目录到Python路径
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database.write_queue import MessageWriteQueue
+
+
+class FakeConnections:
+    @contextmanager
+    def transaction(self):
+        yield None
+
+    def release(self):
+        pass
+
+
+class FakeLogger:
+    def __init__(self):
+        self.errors = []
+
+    def log_error(self, message):
+        self.errors.append(message)
+
+    def log_exception(self, message):
+        self.errors.append(message)
+
+
+def make_queue(write_batch, **kwargs):
+    return MessageWriteQueue(FakeConnections(), write_batch, FakeLogger(), retry_base_delay=0.001,
+                             retry_max_delay=0.001, **kwargs)
+
+
+def wait_until_written(write_queue, timeout=5):
+    """等待队列清空（包括重试后放弃的消息）"""
+    deadline = time.monotonic() + timeout
+    while write_queue.stats()["pending"] and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+
+def test_writes_batches():
+    written = []
+    write_queue = make_queue(lambda conn, rows: written.extend(rows))
+    for i in range(5):
+        write_queue.put(1, i)
+    assert write_queue.flush(timeout=5)
+    write_queue.close()
+    assert written == [0, 1, 2, 3, 4]
+    assert write_queue.stats()["dropped"] == 0
+
+
+def test_locked_database_is_retried_then_dropped():
+    attempts = []
+
+    def write_batch(conn, rows):
+        attempts.append(rows)
+        raise sqlite3.OperationalError("database is locked")
+
+    write_queue = make_queue(write_batch, max_retries=3)
+    write_queue.put(1, "message")
+    wait_until_written(write_queue)
+    write_queue.close()
+    # 第一次写入加上 3 次重试
+    assert len(attempts) == 4
+    assert write_queue.stats() == {"pending": 0, "dropped": 1, "last_error": None}
+
+
+def test_recovers_after_lock_is_released():
+    written = []
+    failures = [sqlite3.OperationalError("database is locked")] * 2
+
+    def write_batch(conn, rows):
+        if failures:
+            raise failures.pop()
+        written.extend(rows)
+
+    write_queue = make_queue(write_batch, max_retries=3)
+    write_queue.put(1, "message")
+    wait_until_written(write_queue)
+    write_queue.close()
+    assert written == ["message"]
+    assert write_queue.stats()["dropped"] == 0
+
+
+def test_other_operational_errors_are_not_retried():
+    attempts = []
+
+    def write_batch(conn, rows):
+        attempts.append(rows)
+        raise sqlite3.OperationalError("no such table: chat_history")
+
+    write_queue = make_queue(write_batch, max_retries=3)
+    write_queue.put(1, "message")
+    write_queue.close()
+    # 整批写入一次，逐条写入一次
+    assert len(attempts) == 2
+    assert write_queue.stats()["dropped"] == 1
@@ -0,0 +1,97 @@
+"""
+共享的 asyncio 事件循环
+
+事件循环运行在一个后台守护线程中，GUI 线程或其他同步代码通过 submit() 提交协程，
+得到 concurrent.futures.Future。多个对话的流式生成可以在同一个事件循环中并发进行，
+不需要为每条消息创建线程。事件循环同时持有异步模型请求共用的 httpx.AsyncClient，停止时关闭。
+"""
+
+import os
+import sys
+import asyncio
+import threading
+
+# 获取当前文件的目录
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+# 将项目根目录添加到sys.path
+ROOT_DIR = os.path.dirname(CURRENT_DIR)
+sys.path.append(ROOT_DIR)
+
+from utils.http_client import create_async_http_client
+
+_runtime = None
+_runtime_lock = threading.Lock()
+
+
+class AsyncRuntime:
+    """在后台线程中运行的事件循环"""
+
+    def __init__(self, name="AsyncRuntime"):
+        self.loop = asyncio.new_event_loop()
+        # 异步连接池绑定在这个事件循环上，第一次使用时创建
+        self._http_client = None
+        self._http_client_lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    @property
+    def http_client(self):
+        """事件循环持有的 httpx.AsyncClient，ChatOpenAI 的异步请求（http_async_client）共用"""
+        if self._http_client is None:
+            with self._http_client_lock:
+                if self._http_client is None:
+                    self._http_client = create_async_http_client()
+        return self._http_client
+
+    def submit(self, coro):
+        """把协程提交到事件循环，返回 concurrent.futures.Future"""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def run(self, coro, timeout=None):
+        """提交协程并等待结果（不能在事件循环线程中调用）"""
+        return self.submit(coro).result(timeout)
+
+    def is_running(self):
+        return self._thread.is_alive()
+
+    def stop(self, timeout=5):
+        """取消所有未完成的任务，关闭异步连接池并停止事件循环"""
+        if not self._thread.is_alive():
+            return
+
+        async def _shutdown():
+            tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            if self._http_client is not None:
+                await self._http_client.aclose()
+
+        try:
+            self.submit(_shutdown()).result(timeout)
+        except Exception:
+            pass
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join(timeout)
+
+
+def get_async_runtime():
+    """获取进程内共享的事件循环，第一次调用时启动"""
+    global _runtime
+    with _runtime_lock:
+        if _runtime is None or not _runtime.is_running():
+            _runtime = AsyncRuntime()
+        return _runtime
+
+
+def stop_async_runtime():
+    """停止共享的事件循环（程序退出时调用）"""
+    global _runtime
+    with _runtime_lock:
+        if _runtime is not None:
+            _runtime.stop()
+            _runtime = None
@@ -0,0 +1,73 @@
+"""
+协作式取消
+
+界面线程调用 cancel()，生成任务通过注册的回调立即得到通知：
+异步生成用 bind_current_task() 把令牌绑定到当前任务，取消时任务在正在等待的位置
+（通常是读取 HTTP 响应）抛出 CancelledError，上游连接随之关闭；
+同步的 ChatCore.stream_chat 也在共享事件循环中运行 astream_chat，取消方式相同。
+"""
+
+import asyncio
+import threading
+
+
+class _TaskCanceller:
+    """取消指定任务的回调；解除绑定后，已经排入事件循环的取消请求也不再生效"""
+
+    def __init__(self, loop, task):
+        self.loop = loop
+        self.task = task
+        self.active = True
+
+    def __call__(self):
+        self.loop.call_soon_threadsafe(self._cancel)
+
+    def _cancel(self):
+        if self.active:
+            self.task.cancel()
+
+
+class CancellationToken:
+    """线程安全的取消令牌，可以注册取消时执行的回调"""
+
+    def __init__(self):
+        self._cancelled = False
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    @property
+    def cancelled(self):
+        return self._cancelled
+
+    def cancel(self):
+        """取消，回调在调用方线程中执行，重复调用无效"""
+        with self._lock:
+            if self._cancelled:
+                return
+            self._cancelled = True
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback()
+
+    def add_callback(self, callback):
+        """注册回调，已取消时立即执行；返回用于 remove_callback 的句柄"""
+        with self._lock:
+            if not self._cancelled:
+                self._callbacks.append(callback)
+                return callback
+        callback()
+        return callback
+
+    def remove_callback(self, callback):
+        if isinstance(callback, _TaskCanceller):
+            callback.active = False
+        with self._lock:
+            if callback in self._callbacks:
+                self._callbacks.remove(callback)
+
+    def bind_current_task(self):
+        """取消时取消当前 asyncio 任务（可以从其他线程触发），返回用于 remove_callback 的句柄
+
+        remove_callback 须在同一个事件循环中调用。
+        """
+        return self.add_callback(_TaskCanceller(asyncio.get_running_loop(), asyncio.current_task()))
@@ -0,0 +1,189 @@
+"""
+对话历史的内存缓存
+
+按 (auth_code, conversation_id) 缓存对话最近的消息，总大小超过上限时淘汰最久未使用的对话。
+每个缓存项记录加载时的 token 预算：缓存中的消息是对话的一段最新后缀，
+足以在不超过该预算的前提下选出上下文窗口，新消息写入时直接追加到末尾。
+
+从数据库加载和写入缓存之间可能有新消息追加或缓存被清除，加载结果已经过时。
+每个对话有一个写入版本号，加载前用 version() 读取，put() 时传回，版本变化时放弃写入缓存。
+"""
+
+import os
+import sys
+import threading
+from collections import OrderedDict
+
+# 获取当前文件的目录
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+# 将项目根目录添加到sys.path
+ROOT_DIR = os.path.dirname(CURRENT_DIR)
+sys.path.append(ROOT_DIR)
+
+from utils.tokenizer import count_tokens, count_message_tokens, truncate_tokens, MESSAGE_TOKEN_OVERHEAD
+
+# 每条缓存消息除正文外的估算开销（字典和字段）
+_ENTRY_OVERHEAD_BYTES = 200
+
+
+def _message_bytes(entry):
+    return len(entry['message'].encode("utf-8")) + _ENTRY_OVERHEAD_BYTES
+
+
+def select_window(messages, max_tokens, after_id=None):
+    """从按时间排列的消息中选出总 token 数不超过 max_tokens 的最近消息，返回新列表
+
+    最新的一条消息单独就超出预算时截断后返回，与 ChatDatabase.get_conversation_context 一致。
+    """
+    selected = []
+    used = 0
+    for entry in reversed(messages):
+        # 还没有落盘的新消息没有ID，一定比水位线新
+        if after_id is not None and entry['id'] is not None and entry['id'] <= after_id:
+            break
+        cost = count_message_tokens(entry['token_count'])
+        if used + cost > max_tokens:
+            if not selected:
+                entry = dict(entry)
+                entry['message'] = truncate_tokens(entry['message'], max_tokens - MESSAGE_TOKEN_OVERHEAD)
+                entry['token_count'] = count_tokens(entry['message'])
+                selected.append(entry)
+            break
+        used += cost
+        selected.append(dict(entry))
+    selected.reverse()
+    return selected
+
+
+class _CachedHistory:
+    __slots__ = ("messages", "budget", "size")
+
+    def __init__(self, messages, budget):
+        self.messages = messages
+        self.budget = budget
+        self.size = sum(_message_bytes(entry) for entry in messages)
+
+
+class HistoryCache:
+    """线程安全的对话历史 LRU 缓存，容量按字节数限制"""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._items = OrderedDict()
+        # 对话 -> 写入版本号，append / invalidate 时递增
+        self._versions = {}
+        self._lock = threading.Lock()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def select(self, key, max_tokens, after_id=None):
+        """从缓存中选出不超过 max_tokens 的最近消息（按时间从旧到新排列）
+
+        缓存不存在或加载时的预算小于 max_tokens 时返回 None。
+        返回的是新列表，调用方可以随意修改。
+        """
+        with self._lock:
+            cached = self._items.get(key)
+            if cached is None or cached.budget < max_tokens:
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return select_window(cached.messages, max_tokens, after_id)
+
+    def version(self, key):
+        """对话当前的写入版本号，从数据库加载前读取"""
+        with self._lock:
+            return self._versions.setdefault(key, 0)
+
+    def put(self, key, messages, budget, version=None):
+        """缓存从数据库加载的消息，messages 需包含 id、message、is_user、token_count
+
+        version 为加载前 version() 的返回值，加载期间有新消息或缓存被清除时不写入，返回 False。
+        """
+        cached = _CachedHistory([dict(entry) for entry in messages], budget)
+        with self._lock:
+            if version is not None and self._versions.get(key, 0) != version:
+                return False
+            self._remove(key)
+            self._items[key] = cached
+            self.total_bytes += cached.size
+            self._evict()
+        return True
+
+    def append(self, key, entry):
+        """追加一条新消息，对话不在缓存中时忽略（下次读取时从数据库加载）"""
+        with self._lock:
+            self._bump(key)
+            cached = self._items.get(key)
+            if cached is None:
+                return
+            entry = dict(entry)
+            cached.messages.append(entry)
+            size = _message_bytes(entry)
+            cached.size += size
+            self.total_bytes += size
+            self._trim(cached)
+            self._evict()
+
+    def invalidate(self, key):
+        with self._lock:
+            self._bump(key)
+            self._remove(key)
+
+    def invalidate_user(self, auth_code):
+        """清除用户所有对话的缓存，键为 (auth_code, conversation_id)"""
+        with self._lock:
+            for key in [key for key in set(self._versions) | set(self._items) if key[0] == auth_code]:
+                self._bump(key)
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            for key in self._versions:
+                self._bump(key)
+            self._items.clear()
+            self.total_bytes = 0
+
+    def stats(self):
+        """缓存命中统计"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+                "conversations": len(self._items),
+                "bytes": self.total_bytes,
+                "max_bytes": self.max_bytes,
+            }
+
+    def _trim(self, cached):
+        """丢弃选窗口时一定用不到的最旧消息：其余消息的 token 数已经超过预算"""
+        remaining = sum(count_message_tokens(entry['token_count']) for entry in cached.messages)
+        while len(cached.messages) > 1:
+            oldest = cached.messages[0]
+            rest = remaining - count_message_tokens(oldest['token_count'])
+            if rest <= cached.budget:
+                break
+            cached.messages.pop(0)
+            remaining = rest
+            size = _message_bytes(oldest)
+            cached.size -= size
+            self.total_bytes -= size
+
+    def _bump(self, key):
+        if key in self._versions:
+            self._versions[key] += 1
+
+    def _remove(self, key):
+        cached = self._items.pop(key, None)
+        if cached is not None:
+            self.total_bytes -= cached.size
+
+    def _evict(self):
+        # 至少保留最近使用的一项，单个对话超过上限时也能命中
+        while self.total_bytes > self.max_bytes and len(self._items) > 1:
+            _, cached = self._items.popitem(last=False)
+            self.total_bytes -= cached.size
@@ -0,0 +1,109 @@
+"""
+共享 HTTP 连接池
+
+所有对外的同步请求（大模型接口、用户信息查询）共用同一个 httpx.Client，
+连接保持复用，避免每个请求重新进行 TCP / TLS 握手。安装了 h2 时可以启用 HTTP/2。
+异步请求使用 utils/async_runtime.py 中事件循环持有的 httpx.AsyncClient，参数相同。
+"""
+
+import os
+import sys
+import threading
+import time
+from urllib.parse import urlsplit
+
+import httpx
+
+try:
+    import h2  # noqa: F401  httpx 的 HTTP/2 支持依赖 h2
+except ImportError:
+    h2 = None
+
+# 获取当前文件的目录
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+# 将项目根目录添加到sys.path
+ROOT_DIR = os.path.dirname(CURRENT_DIR)
+sys.path.append(ROOT_DIR)
+
+from config.settings import (
+    HTTP_MAX_CONNECTIONS, HTTP_MAX_KEEPALIVE_CONNECTIONS, HTTP_KEEPALIVE_EXPIRY,
+    HTTP_ENABLE_HTTP2, HTTP_TIMEOUT
+)
+
+_client = None
+_client_lock = threading.Lock()
+# 各主机最近一次预热的时间，连接仍在保活期内时不重复预热
+_warmed_at = {}
+
+
+def _client_options():
+    """同步和异步连接池共用的参数"""
+    return dict(
+        limits=httpx.Limits(
+            max_connections=HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+        ),
+        http2=HTTP_ENABLE_HTTP2 and h2 is not None,
+        timeout=HTTP_TIMEOUT,
+    )
+
+
+def get_http_client():
+    """获取共享的 httpx.Client，第一次调用时创建"""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = httpx.Client(**_client_options())
+    return _client
+
+
+def create_async_http_client():
+    """创建 httpx.AsyncClient，由共享事件循环持有并在其停止时关闭，只能在该事件循环中使用"""
+    return httpx.AsyncClient(**_client_options())
+
+
+def warm_up(url):
+    """向 url 所在主机发起一次轻量请求，同步和异步连接池各建立一个连接，返回是否发起了预热"""
+    # 在函数内导入，async_runtime 创建异步连接池时会导入本模块
+    from utils.async_runtime import get_async_runtime
+
+    parts = urlsplit(url)
+    origin = f"{parts.scheme}://{parts.netloc}"
+    now = time.monotonic()
+    with _client_lock:
+        last = _warmed_at.get(origin)
+        if last is not None and now - last < HTTP_KEEPALIVE_EXPIRY / 2:
+            return False
+        _warmed_at[origin] = now
+
+    def _run():
+        try:
+            # 只为建立连接，不关心响应内容和状态码
+            get_http_client().head(origin, timeout=10)
+        except httpx.HTTPError:
+            with _client_lock:
+                _warmed_at.pop(origin, None)
+
+    async def _arun(runtime):
+        try:
+            await runtime.http_client.head(origin, timeout=10)
+        except httpx.HTTPError:
+            with _client_lock:
+                _warmed_at.pop(origin, None)
+
+    threading.Thread(target=_run, name="HttpWarmUp", daemon=True).start()
+    runtime = get_async_runtime()
+    runtime.submit(_arun(runtime))
+    return True
+
+
+def close_http_client():
+    """关闭共享连接池（程序退出时调用）"""
+    global _client
+    with _client_lock:
+        if _client is not None:
+            _client.close()
+            _client = None
+        _warmed_at.clear()
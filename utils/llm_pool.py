@@ -0,0 +1,64 @@
+"""
+大模型客户端池
+
+按 (model, streaming, temperature) 及其他构造参数缓存 ChatOpenAI 实例，第一次使用时创建，
+所有客户端的同步请求共用 utils/http_client.py 中的连接池，异步请求共用 utils/async_runtime.py
+中事件循环持有的异步连接池，因此 ainvoke / astream 需要在该事件循环中调用。回调等每次调用不同的参数通过运行配置
+（config={"callbacks": [...]}）传入，不放在构造参数中。客户端默认关闭内置重试，
+重试和对冲由 utils/resilience.py 统一处理。
+"""
+
+import os
+import sys
+import threading
+
+# 获取当前文件的目录
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+# 将项目根目录添加到sys.path
+ROOT_DIR = os.path.dirname(CURRENT_DIR)
+sys.path.append(ROOT_DIR)
+
+from langchain_openai import ChatOpenAI
+from utils.http_client import get_http_client
+from utils.async_runtime import get_async_runtime
+
+
+class LLMClientPool:
+    """线程安全的 ChatOpenAI 客户端池"""
+
+    def __init__(self, api_key, api_base):
+        self.api_key = api_key
+        self.api_base = api_base
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    def get(self, model, streaming=False, temperature=0.7, **kwargs):
+        """获取客户端，kwargs 为其他构造参数（如 max_tokens），同样作为缓存键的一部分"""
+        key = (model, streaming, temperature, tuple(sorted(kwargs.items())))
+        client = self._clients.get(key)
+        if client is not None:
+            return client
+        with self._lock:
+            client = self._clients.get(key)
+            if client is None:
+                kwargs.setdefault("max_retries", 0)
+                client = ChatOpenAI(
+                    model=model,
+                    openai_api_key=self.api_key,
+                    openai_api_base=self.api_base,
+                    temperature=temperature,
+                    streaming=streaming,
+                    http_client=get_http_client(),
+                    http_async_client=get_async_runtime().http_client,
+                    **kwargs
+                )
+                self._clients[key] = client
+            return client
+
+    def clear(self):
+        """丢弃所有客户端（如 API 配置变化后）"""
+        with self._lock:
+            self._clients.clear()
+
+    def __len__(self):
+        return len(self._clients)
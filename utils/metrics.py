@@ -0,0 +1,157 @@
+"""
+单轮对话的延迟统计
+
+TurnMetrics 记录一轮对话各阶段的耗时（秒）：
+- queue_wait: 在请求调度器中排队的时间（重试时累加）
+- history_load: 读取历史记录的时间
+- request_start: 从本轮开始到发出模型请求的时间
+- ttft: 从本轮开始到收到第一个 token 的时间
+- max_gap / avg_gap: 相邻 token 之间的最大 / 平均间隔
+- tokens / tokens_per_second: 回答的 token 数和首 token 之后的生成速度
+- total: 从本轮开始到回答生成结束的时间
+- db_enqueue: 保存问题和回答的调用耗时。异步写入时只是放入写入队列，实际写库在写线程中完成；
+  未启用异步写入或队列已关闭时包含同步写入
+- render_total / render_max: 界面渲染流式回答的总时间 / 单次最长时间
+
+记录保存在数据库的 turn_metrics 表中，summarize() 按模型计算各项的 p50 / p95 / p99；
+命中缓存的回放和被取消、出错的轮次不计入，否则会拉低或拉高模型本身的延迟分布。
+"""
+
+import os
+import sys
+import time
+from contextlib import contextmanager
+
+# 获取当前文件的目录
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+# 将项目根目录添加到sys.path
+ROOT_DIR = os.path.dirname(CURRENT_DIR)
+sys.path.append(ROOT_DIR)
+
+from utils.tokenizer import count_tokens
+
+# 保存到 turn_metrics 表的数值列
+METRIC_FIELDS = (
+    "queue_wait", "history_load", "request_start", "ttft", "max_gap", "avg_gap",
+    "tokens", "tokens_per_second", "total", "db_enqueue", "render_total", "render_max", "render_updates",
+)
+
+
+class TurnMetrics:
+    """一轮对话的计时器，生成任务和界面线程分别写入各自的字段"""
+
+    def __init__(self, model, conversation_id=None):
+        self.model = model
+        self.conversation_id = conversation_id
+        self.created_at = time.time()
+        self.started_at = time.perf_counter()
+        self.queue_wait = 0.0
+        self.history_load = None
+        self.request_start = None
+        self.ttft = None
+        self.max_gap = None
+        self.avg_gap = None
+        self.tokens = 0
+        self.tokens_per_second = None
+        self.total = None
+        self.db_enqueue = 0.0
+        self.render_total = 0.0
+        self.render_max = 0.0
+        self.render_updates = 0
+        self.cached = False
+        self.status = None
+        self._first_token_at = None
+        self._last_token_at = None
+        self._gap_total = 0.0
+        self._gaps = 0
+
+    def elapsed(self):
+        return time.perf_counter() - self.started_at
+
+    @contextmanager
+    def measure(self, field):
+        """把代码块的耗时累加到 field"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            setattr(self, field, (getattr(self, field) or 0.0) + time.perf_counter() - start)
+
+    def request_started(self, queue_wait=0.0):
+        """排队结束、即将发出模型请求时调用"""
+        self.queue_wait += queue_wait
+        self.request_start = self.elapsed()
+
+    def token_received(self):
+        now = time.perf_counter()
+        if self._first_token_at is None:
+            self._first_token_at = now
+            self.ttft = now - self.started_at
+        else:
+            gap = now - self._last_token_at
+            self._gap_total += gap
+            self._gaps += 1
+            self.max_gap = gap if self.max_gap is None else max(self.max_gap, gap)
+            self.avg_gap = self._gap_total / self._gaps
+        self._last_token_at = now
+
+    def add_render(self, seconds):
+        self.render_total += seconds
+        self.render_max = max(self.render_max, seconds)
+        self.render_updates += 1
+
+    def finish(self, text, status="ok"):
+        """回答生成结束（或被取消、出错）时调用，status 为 ok / cancelled / error"""
+        self.total = self.elapsed()
+        self.status = status
+        self.tokens = count_tokens(text) if text else 0
+        if self._first_token_at is not None and self._last_token_at > self._first_token_at:
+            self.tokens_per_second = self.tokens / (self._last_token_at - self._first_token_at)
+
+    def as_row(self):
+        row = {field: getattr(self, field) for field in METRIC_FIELDS}
+        row.update(
+            conversation_id=self.conversation_id,
+            model=self.model,
+            created_at=self.created_at,
+            cached=int(self.cached),
+            status=self.status,
+        )
+        return row
+
+
+def percentile(sorted_values, q):
+    """已排序数据的 q 分位数（线性插值）"""
+    if not sorted_values:
+        return None
+    position = (len(sorted_values) - 1) * q / 100
+    lower = int(position)
+    upper = min(lower + 1, len(sorted_values) - 1)
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (position - lower)
+
+
+def summarize(rows, fields=METRIC_FIELDS, quantiles=(50, 95, 99)):
+    """按模型汇总，返回 {模型: {字段: {"count": 样本数, "p50": ..., "p95": ..., "p99": ...}}}
+    
+    只统计未命中缓存且正常结束的轮次，空值不计入。
+    """
+    values = {}
+    for row in rows:
+        if row.get("cached") or row.get("status") != "ok":
+            continue
+        per_model = values.setdefault(row["model"], {})
+        for field in fields:
+            value = row[field]
+            if value is not None:
+                per_model.setdefault(field, []).append(value)
+
+    result = {}
+    for model, per_model in values.items():
+        result[model] = {}
+        for field, samples in per_model.items():
+            samples.sort()
+            stats = {"count": len(samples)}
+            for q in quantiles:
+                stats[f"p{q}"] = percentile(samples, q)
+            result[model][field] = stats
+    return result
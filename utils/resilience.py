@@ -0,0 +1,261 @@
+"""
+请求重试与对冲
+
+模型接口偶尔卡顿或失败时：
+- 在收到第一个 token 之前失败的请求可以安全重试（还没有内容输出给用户），
+  按带随机抖动的指数退避重试；收到第一个 token 之后的错误直接抛出。
+- 可选地对冲：超过该模型首 token 延迟的 p95 仍没有输出时，向配置的等价模型再发一个相同的请求，
+  先输出第一个 token 的请求胜出，另一个被取消。
+
+客户端池中的 ChatOpenAI 已关闭内置重试（max_retries=0），重试统一在这里进行。
+
+流式请求只有异步接口 astream()，同步调用方通过共享事件循环使用它（见 ChatCore.stream_chat）。
+传入的 make_stream(model, timing) 在请求调度器放行后把 time.monotonic() 写入 timing["start"]，
+首 token 延迟从这里开始计算，不包含排队等待的时间，否则限流时的排队会抬高对冲等待时间。
+"""
+
+import os
+import sys
+import time
+import random
+import asyncio
+import threading
+from collections import deque
+
+import httpx
+
+try:
+    import openai
+except ImportError:
+    openai = None
+
+# 获取当前文件的目录
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+# 将项目根目录添加到sys.path
+ROOT_DIR = os.path.dirname(CURRENT_DIR)
+sys.path.append(ROOT_DIR)
+
+from config.settings import (
+    RETRY_MAX_ATTEMPTS, RETRY_BASE_DELAY, RETRY_MAX_DELAY, HEDGE_ENABLED, HEDGE_EQUIVALENT_MODELS,
+    HEDGE_PERCENTILE, HEDGE_MIN_SAMPLES, HEDGE_DEFAULT_DELAY, HEDGE_MIN_DELAY
+)
+from utils.logger import Logger
+
+# 流结束标记
+_END = object()
+
+
+def is_retryable(exc):
+    """连接失败、超时、限流和服务端错误可以重试，认证失败、参数错误等不重试"""
+    if openai is not None:
+        if isinstance(exc, openai.APIStatusError):
+            return exc.status_code in (408, 409, 429) or exc.status_code >= 500
+        if isinstance(exc, openai.APIConnectionError):
+            return True
+    return isinstance(exc, (httpx.TransportError, ConnectionError, TimeoutError, asyncio.TimeoutError))
+
+
+def backoff_delay(attempt, base=None, cap=None):
+    """第 attempt 次重试前的等待时间（full jitter）：0 到 min(cap, base * 2^attempt) 之间的随机值"""
+    base = RETRY_BASE_DELAY if base is None else base
+    cap = RETRY_MAX_DELAY if cap is None else cap
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+class _Attempt:
+    """一路请求（主请求或对冲请求）：后台任务把输出放入队列，first 在收到第一个 token 时完成"""
+
+    def __init__(self, model, path):
+        self.model = model
+        self.path = path
+        self.queue = asyncio.Queue()
+        self.first = asyncio.get_running_loop().create_future()
+        self.task = None
+
+
+class ResilientStreamer:
+    """为流式请求提供首 token 前重试和对冲，统计各路径的胜出次数"""
+
+    def __init__(self, max_attempts=None, hedge_enabled=None, equivalent_models=None):
+        self.max_attempts = RETRY_MAX_ATTEMPTS if max_attempts is None else max_attempts
+        self.hedge_enabled = HEDGE_ENABLED if hedge_enabled is None else hedge_enabled
+        self.equivalent_models = HEDGE_EQUIVALENT_MODELS if equivalent_models is None else equivalent_models
+        self.logger = Logger()
+        # 各模型最近的首 token 延迟（秒）
+        self._ttft = {}
+        self._lock = threading.Lock()
+        # 胜出路径统计：primary（首次请求）、retry（重试后成功）、hedge（对冲请求）
+        self.wins = {"primary": 0, "retry": 0, "hedge": 0}
+        self.retries = 0
+        self.hedges = 0
+        self.failures = 0
+
+    def record_ttft(self, model, seconds):
+        with self._lock:
+            samples = self._ttft.get(model)
+            if samples is None:
+                samples = self._ttft[model] = deque(maxlen=200)
+            samples.append(seconds)
+
+    def hedge_delay(self, model):
+        """对冲等待时间：该模型首 token 延迟的 p95，样本不足时使用默认值"""
+        with self._lock:
+            samples = sorted(self._ttft.get(model, ()))
+        if len(samples) < HEDGE_MIN_SAMPLES:
+            return HEDGE_DEFAULT_DELAY
+        index = min(len(samples) - 1, int(len(samples) * HEDGE_PERCENTILE / 100))
+        return max(HEDGE_MIN_DELAY, samples[index])
+
+    def _record_win(self, path, retried):
+        with self._lock:
+            if path == "primary" and retried:
+                path = "retry"
+            self.wins[path] += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                "wins": dict(self.wins),
+                "retries": self.retries,
+                "hedges": self.hedges,
+                "failures": self.failures,
+            }
+
+    # ---------- 同步接口 ----------
+
+    def call(self, func, *args, **kwargs):
+        """调用 func，可重试的错误按退避重试"""
+        for attempt in range(self.max_attempts):
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                if attempt + 1 >= self.max_attempts or not is_retryable(e):
+                    with self._lock:
+                        self.failures += 1
+                    raise
+                self._log_retry(e, attempt)
+                time.sleep(backoff_delay(attempt))
+                continue
+            self._record_win("primary", attempt > 0)
+            return result
+
+    # ---------- 异步接口 ----------
+
+    async def acall(self, func, *args, **kwargs):
+        """call 的异步版本，func 为协程函数"""
+        for attempt in range(self.max_attempts):
+            try:
+                result = await func(*args, **kwargs)
+            except Exception as e:
+                if attempt + 1 >= self.max_attempts or not is_retryable(e):
+                    with self._lock:
+                        self.failures += 1
+                    raise
+                self._log_retry(e, attempt)
+                await asyncio.sleep(backoff_delay(attempt))
+                continue
+            self._record_win("primary", attempt > 0)
+            return result
+
+    async def astream(self, make_stream, model, info=None, hedge=True):
+        """异步流式请求，首 token 前重试，超过对冲等待时间仍无输出时向等价模型发送对冲请求
+
+        make_stream(model, timing) 每次调用返回一个新的异步迭代器，info 中写入胜出的模型和路径。
+        hedge 为 False 时只重试，不对冲（必须由指定模型回答时，如对比模式）。
+        """
+        info = {} if info is None else info
+        attempts = [self._start(make_stream, model, "primary")]
+        winner = None
+        try:
+            hedge_model = self.equivalent_models.get(model) if self.hedge_enabled and hedge else None
+            if hedge_model:
+                done, _ = await asyncio.wait({attempts[0].first}, timeout=self.hedge_delay(model))
+                if not done:
+                    with self._lock:
+                        self.hedges += 1
+                    attempts.append(self._start(make_stream, hedge_model, "hedge"))
+
+            pending = {attempt.first for attempt in attempts}
+            error = None
+            while winner is None and pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for attempt in attempts:
+                    if attempt.first not in done:
+                        continue
+                    if attempt.first.exception() is None:
+                        winner = winner or attempt
+                    else:
+                        error = error or attempt.first.exception()
+            if winner is None:
+                with self._lock:
+                    self.failures += 1
+                raise error
+
+            retried = winner.first.result()
+            self._record_win(winner.path, retried)
+            info.update(model=winner.model, path="retry" if winner.path == "primary" and retried else winner.path)
+            # 取消落败的请求
+            for attempt in attempts:
+                if attempt is not winner:
+                    attempt.task.cancel()
+
+            while True:
+                item = await winner.queue.get()
+                if item is _END:
+                    return
+                if isinstance(item, BaseException):
+                    raise item
+                yield item
+        finally:
+            for attempt in attempts:
+                if not attempt.task.done():
+                    attempt.task.cancel()
+                # 避免未读取的异常在垃圾回收时报警
+                if attempt.first.done() and not attempt.first.cancelled():
+                    attempt.first.exception()
+
+    def _start(self, make_stream, model, path):
+        attempt = _Attempt(model, path)
+        attempt.task = asyncio.ensure_future(self._pump(make_stream, attempt))
+        return attempt
+
+    async def _pump(self, make_stream, attempt):
+        """在独立任务中读取一路请求的输出，首 token 之前的可重试错误按退避重试"""
+        for retry in range(self.max_attempts):
+            timing = {}
+            start = time.monotonic()
+            stream = make_stream(attempt.model, timing)
+            got_first = False
+            try:
+                async for chunk in stream:
+                    if not got_first:
+                        got_first = True
+                        self.record_ttft(attempt.model, time.monotonic() - timing.get("start", start))
+                        attempt.first.set_result(retry > 0)
+                    attempt.queue.put_nowait(chunk)
+                if not got_first:
+                    attempt.first.set_result(retry > 0)
+                attempt.queue.put_nowait(_END)
+                return
+            except asyncio.CancelledError:
+                if not attempt.first.done():
+                    attempt.first.cancel()
+                raise
+            except Exception as e:
+                if got_first:
+                    # 已经输出过内容，不能重试，交给读取方抛出
+                    attempt.queue.put_nowait(e)
+                    return
+                if retry + 1 >= self.max_attempts or not is_retryable(e):
+                    attempt.first.set_exception(e)
+                    return
+                self._log_retry(e, retry, attempt.model)
+                await asyncio.sleep(backoff_delay(retry))
+            finally:
+                await stream.aclose()
+
+    def _log_retry(self, exc, attempt, model=None):
+        with self._lock:
+            self.retries += 1
+        target = f"模型 {model} " if model else ""
+        self.logger.log_error(f"{target}请求失败，第 {attempt + 1} 次重试: {str(exc)}")
@@ -0,0 +1,123 @@
+"""
+回答缓存
+
+按 (用户, 模型, 温度, 渲染后的完整提示词) 的哈希缓存模型回答，不同用户之间不共享，内存中保留最近使用的一部分，
+全部记录持久化在数据库的 response_cache 表中，超过有效期或总大小上限的记录会被淘汰。
+"""
+
+import os
+import sys
+import json
+import time
+import hashlib
+import sqlite3
+import threading
+from collections import OrderedDict
+
+# 获取当前文件的目录
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+# 将项目根目录添加到sys.path
+ROOT_DIR = os.path.dirname(CURRENT_DIR)
+sys.path.append(ROOT_DIR)
+
+from config.settings import (
+    RESPONSE_CACHE_MEMORY_ENTRIES, RESPONSE_CACHE_TTL_SECONDS, RESPONSE_CACHE_MAX_BYTES
+)
+from utils.logger import Logger
+
+
+class ResponseCache:
+    """两级回答缓存：内存 LRU + 数据库持久化"""
+
+    def __init__(self, db_manager, max_entries=None, ttl=None, max_bytes=None):
+        self.db_manager = db_manager
+        self.max_entries = RESPONSE_CACHE_MEMORY_ENTRIES if max_entries is None else max_entries
+        self.ttl = RESPONSE_CACHE_TTL_SECONDS if ttl is None else ttl
+        self.max_bytes = RESPONSE_CACHE_MAX_BYTES if max_bytes is None else max_bytes
+        self.logger = Logger()
+        # cache_key -> (回答, 写入时间)
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.stores = 0
+
+    @staticmethod
+    def make_key(auth_code, model, temperature, prompt):
+        """由用户标识、模型、温度和渲染后的提示词生成缓存键，一个用户的回答不会回放给其他用户"""
+        payload = json.dumps([auth_code, model, temperature, prompt], ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, cache_key):
+        """查询缓存，未命中时返回 None"""
+        now = time.time()
+        with self._lock:
+            cached = self._memory.get(cache_key)
+            if cached is not None:
+                response, created_at = cached
+                if now - created_at <= self.ttl:
+                    self._memory.move_to_end(cache_key)
+                    self.memory_hits += 1
+                    return response
+                del self._memory[cache_key]
+
+        try:
+            cached = self.db_manager.get_cached_response(cache_key, now - self.ttl, now)
+        except sqlite3.Error as e:
+            self.logger.log_exception(f"读取回答缓存时出错: {str(e)}")
+            cached = None
+
+        with self._lock:
+            if cached is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+            response, created_at = cached
+            self._remember(cache_key, response, created_at)
+        return response
+
+    def put(self, cache_key, model, response):
+        """写入缓存"""
+        now = time.time()
+        with self._lock:
+            self._remember(cache_key, response, now)
+            self.stores += 1
+        try:
+            self.db_manager.save_cached_response(
+                cache_key, model, response, now, max_bytes=self.max_bytes, min_created_at=now - self.ttl)
+        except sqlite3.Error as e:
+            self.logger.log_exception(f"写入回答缓存时出错: {str(e)}")
+
+    def clear(self):
+        """清空内存和数据库中的缓存"""
+        with self._lock:
+            self._memory.clear()
+        self.db_manager.clear_response_cache()
+
+    def stats(self):
+        """缓存命中统计"""
+        with self._lock:
+            hits = self.memory_hits + self.disk_hits
+            total = hits + self.misses
+            stats = {
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": hits / total if total else 0.0,
+                "stores": self.stores,
+                "memory_entries": len(self._memory),
+            }
+        try:
+            disk = self.db_manager.get_response_cache_stats()
+            stats["disk_entries"] = disk["entries"]
+            stats["disk_bytes"] = disk["bytes"]
+        except sqlite3.Error as e:
+            self.logger.log_exception(f"统计回答缓存时出错: {str(e)}")
+        return stats
+
+    def _remember(self, cache_key, response, created_at):
+        self._memory[cache_key] = (response, created_at)
+        self._memory.move_to_end(cache_key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
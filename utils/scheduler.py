@@ -0,0 +1,266 @@
+"""
+模型请求调度器
+
+在调用模型接口之前排队，按模型限制每分钟请求数（RPM）、每分钟 token 数（TPM）和并发数，
+避免同时发送的请求触发服务商的 429 限流。RPM 和 TPM 使用令牌桶，允许一分钟额度内的突发。
+等待中的请求按优先级排队：交互式对话优先于后台摘要和批量任务，同优先级先到先得。
+
+同步代码（摘要线程、chat / stream_chat）使用 slot()，协程使用 aslot()，两者共用同一个队列：
+
+    with scheduler.slot(model, tokens, PRIORITY_BACKGROUND) as ticket:
+        ...
+        ticket.used_tokens = 实际消耗的 token 数  # 可选，用于修正预估
+
+请求的 token 数在发送前只能预估，结束时按实际消耗退还或补扣。
+"""
+
+import os
+import sys
+import time
+import heapq
+import asyncio
+import itertools
+import threading
+from contextlib import contextmanager, asynccontextmanager
+
+# 获取当前文件的目录
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+# 将项目根目录添加到sys.path
+ROOT_DIR = os.path.dirname(CURRENT_DIR)
+sys.path.append(ROOT_DIR)
+
+from config.settings import MODEL_RATE_LIMITS, DEFAULT_MODEL_RATE_LIMIT
+
+# 优先级，数值越小越先执行
+PRIORITY_INTERACTIVE = 0  # 用户正在等待的对话
+PRIORITY_BACKGROUND = 10  # 后台摘要等
+PRIORITY_BATCH = 20  # 批量任务、压测
+
+
+class TokenBucket:
+    """每分钟补充 rate 个令牌、最多积攒一分钟额度的令牌桶"""
+
+    def __init__(self, rate_per_minute):
+        self.capacity = float(rate_per_minute)
+        self.rate = rate_per_minute / 60.0
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def delay(self, amount, now):
+        """还需等待多少秒才有 amount 个令牌，超过容量的请求按容量计算，避免永远无法执行"""
+        self._refill(now)
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+    def consume(self, amount, now):
+        """扣除令牌，可以扣成负数（实际消耗超过预估时），之后的请求相应推迟"""
+        self._refill(now)
+        self.tokens -= amount
+
+    def refund(self, amount, now):
+        self._refill(now)
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+
+class Ticket:
+    """一次排队的请求，获得执行权后作为凭证，release 时归还"""
+
+    __slots__ = ("model", "tokens", "priority", "seq", "enqueued_at", "waited",
+                 "granted", "cancelled", "used_tokens", "_notify")
+
+    def __init__(self, model, tokens, priority, seq, notify):
+        self.model = model
+        self.tokens = tokens
+        self.priority = priority
+        self.seq = seq
+        self.enqueued_at = time.monotonic()
+        self.waited = 0.0
+        self.granted = False
+        self.cancelled = False
+        self.used_tokens = None
+        self._notify = notify
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class _ModelState:
+    """单个模型的限额、队列和统计"""
+
+    def __init__(self, rpm=None, tpm=None, concurrency=None):
+        self.rpm = TokenBucket(rpm) if rpm else None
+        self.tpm = TokenBucket(tpm) if tpm else None
+        self.concurrency = concurrency
+        self.limits = {"rpm": rpm, "tpm": tpm, "concurrency": concurrency}
+        self.queue = []
+        self.running = 0
+        self.timer = None
+        self.granted = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.tokens_used = 0
+
+
+class RequestScheduler:
+    """按模型限流、按优先级排队的请求调度器，线程安全，同步和异步调用共用"""
+
+    def __init__(self, limits=None, default_limit=None):
+        self.limits = MODEL_RATE_LIMITS if limits is None else limits
+        self.default_limit = DEFAULT_MODEL_RATE_LIMIT if default_limit is None else default_limit
+        self._states = {}
+        self._lock = threading.Lock()
+        self._seq = itertools.count()
+
+    def _get_state(self, model):
+        state = self._states.get(model)
+        if state is None:
+            limit = self.limits.get(model, self.default_limit)
+            state = _ModelState(limit.get("rpm"), limit.get("tpm"), limit.get("concurrency"))
+            self._states[model] = state
+        return state
+
+    def _enqueue(self, model, tokens, priority, notify):
+        with self._lock:
+            state = self._get_state(model)
+            ticket = Ticket(model, tokens, priority, next(self._seq), notify)
+            heapq.heappush(state.queue, ticket)
+            self._dispatch(state)
+        return ticket
+
+    def _dispatch(self, state):
+        """按优先级放行队首的请求，调用时须持有锁
+
+        只看队首，额度不足时整个队列等待，避免大请求被小请求一直插队。
+        """
+        while state.queue:
+            ticket = state.queue[0]
+            if ticket.cancelled:
+                heapq.heappop(state.queue)
+                continue
+            if state.concurrency and state.running >= state.concurrency:
+                return
+            now = time.monotonic()
+            delay = max(state.rpm.delay(1, now) if state.rpm else 0.0,
+                        state.tpm.delay(ticket.tokens, now) if state.tpm else 0.0)
+            if delay > 0:
+                self._retry_later(state, delay)
+                return
+            if state.rpm:
+                state.rpm.consume(1, now)
+            if state.tpm:
+                state.tpm.consume(ticket.tokens, now)
+            heapq.heappop(state.queue)
+            state.running += 1
+            ticket.granted = True
+            ticket.waited = now - ticket.enqueued_at
+            state.granted += 1
+            state.total_wait += ticket.waited
+            state.max_wait = max(state.max_wait, ticket.waited)
+            ticket._notify()
+
+    def _retry_later(self, state, delay):
+        if state.timer is not None:
+            return
+
+        def _fire():
+            with self._lock:
+                state.timer = None
+                self._dispatch(state)
+
+        state.timer = threading.Timer(delay, _fire)
+        state.timer.daemon = True
+        state.timer.start()
+
+    def _cancel(self, ticket):
+        """放弃排队；已获得执行权的请求改为归还"""
+        with self._lock:
+            if not ticket.granted:
+                ticket.cancelled = True
+                return
+        self.release(ticket)
+
+    def acquire(self, model, tokens, priority=PRIORITY_INTERACTIVE):
+        """阻塞直到获得执行权，返回 Ticket"""
+        event = threading.Event()
+        ticket = self._enqueue(model, tokens, priority, event.set)
+        try:
+            event.wait()
+        except BaseException:
+            self._cancel(ticket)
+            raise
+        return ticket
+
+    async def aacquire(self, model, tokens, priority=PRIORITY_INTERACTIVE):
+        """acquire 的协程版本，等待期间不阻塞事件循环"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def _notify():
+            loop.call_soon_threadsafe(lambda: future.done() or future.set_result(None))
+
+        ticket = self._enqueue(model, tokens, priority, _notify)
+        try:
+            await future
+        except BaseException:
+            self._cancel(ticket)
+            raise
+        return ticket
+
+    def release(self, ticket, used_tokens=None):
+        """归还执行权，used_tokens（或 ticket.used_tokens）为实际消耗时修正 TPM 额度"""
+        used_tokens = ticket.used_tokens if used_tokens is None else used_tokens
+        with self._lock:
+            if not ticket.granted:
+                return
+            ticket.granted = False
+            state = self._get_state(ticket.model)
+            state.running -= 1
+            if used_tokens is not None:
+                state.tokens_used += used_tokens
+                if state.tpm:
+                    now = time.monotonic()
+                    if used_tokens < ticket.tokens:
+                        state.tpm.refund(ticket.tokens - used_tokens, now)
+                    else:
+                        state.tpm.consume(used_tokens - ticket.tokens, now)
+            else:
+                state.tokens_used += ticket.tokens
+            self._dispatch(state)
+
+    @contextmanager
+    def slot(self, model, tokens, priority=PRIORITY_INTERACTIVE):
+        ticket = self.acquire(model, tokens, priority)
+        try:
+            yield ticket
+        finally:
+            self.release(ticket)
+
+    @asynccontextmanager
+    async def aslot(self, model, tokens, priority=PRIORITY_INTERACTIVE):
+        ticket = await self.aacquire(model, tokens, priority)
+        try:
+            yield ticket
+        finally:
+            self.release(ticket)
+
+    def stats(self):
+        """各模型的排队数、执行中的请求数和等待时间"""
+        with self._lock:
+            result = {}
+            for model, state in self._states.items():
+                result[model] = {
+                    "queued": sum(1 for ticket in state.queue if not ticket.cancelled),
+                    "running": state.running,
+                    "granted": state.granted,
+                    "avg_wait_ms": state.total_wait / state.granted * 1000 if state.granted else 0.0,
+                    "max_wait_ms": state.max_wait * 1000,
+                    "tokens_used": state.tokens_used,
+                    "limits": dict(state.limits),
+                }
+            return result
@@ -0,0 +1,308 @@
+"""
+语义缓存
+
+用哈希字符 n-gram 向量表示问题（无需下载模型，中英文通用），按 (授权码, 模型) 分范围
+保存在 NumPy 矩阵中，查询时对整个矩阵做一次矩阵向量乘法求余弦相似度，
+最相似的问题超过阈值时直接返回其缓存的回答。需要安装 numpy。
+
+n-gram 向量对只差一个词的问题区分度很低（如 "sort a list ascending" 与 "descending"），
+因此超过阈值的候选还要比较两个问题的用词：除虚词外有任何实词不同（包括数字、否定词）都不算命中。
+
+问题、回答和向量保存在数据库的 semantic_cache 表中。配置了索引目录时，
+每个范围的矩阵另存为 .npy 快照，启动时以内存映射方式加载，不必从数据库重建；
+新写入的向量先放在内存中，积累到一定数量或程序退出时合并进快照。
+"""
+
+import os
+import sys
+import re
+import time
+import zlib
+import hashlib
+import sqlite3
+import threading
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# 获取当前文件的目录
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+# 将项目根目录添加到sys.path
+ROOT_DIR = os.path.dirname(CURRENT_DIR)
+sys.path.append(ROOT_DIR)
+
+from config.settings import (
+    SEMANTIC_CACHE_DIM, SEMANTIC_CACHE_THRESHOLD, SEMANTIC_CACHE_INDEX_DIR, SEMANTIC_CACHE_SNAPSHOT_EVERY
+)
+from utils.logger import Logger
+
+_SPACE_PATTERN = re.compile(r"\s+")
+# 去掉常见标点，避免“？”与“?”之类的差异影响相似度
+_PUNCT_PATTERN = re.compile(r"[，。！？、；：“”‘’（）《》【】,.!?;:'\"()\[\]<>]")
+# 英文单词和数字按整词切分，其余（中日韩等）按单字切分
+_TOKEN_PATTERN = re.compile(r"[a-z0-9_]+|\S")
+# 只影响措辞、不影响问题含义的虚词，比较问题差异时忽略
+_FUNCTION_WORDS = frozenset("""
+a an the to of in on for with by at from as and or
+is are was were be been am do does did can could would should will shall may might must
+i me my we our you your it its this that these those there
+how what which please tell show give help want need let us
+的 地 得 了 着 过 吗 呢 吧 啊 呀 么 嘛 请 帮 我 你 您 它 这 那 个 一 下 是 在 把 给 要 想 能 会 可 以 怎 样 如 何
+""".split())
+
+
+def content_tokens(text):
+    """问题中除虚词外的词集合（已做与向量相同的归一化）"""
+    return {token for token in _TOKEN_PATTERN.findall(HashedNgramEmbedder.normalize(text))
+            if token not in _FUNCTION_WORDS}
+
+
+class HashedNgramEmbedder:
+    """把文本的 1~3 字符 n-gram 哈希到固定维度，得到 L2 归一化的 float32 向量"""
+
+    def __init__(self, dim=None, ngram_range=(1, 3)):
+        if np is None:
+            raise RuntimeError("语义缓存需要安装 numpy")
+        self.dim = dim or SEMANTIC_CACHE_DIM
+        self.ngram_range = ngram_range
+
+    @staticmethod
+    def normalize(text):
+        text = _PUNCT_PATTERN.sub(" ", text.lower())
+        return _SPACE_PATTERN.sub(" ", text).strip()
+
+    def embed(self, text):
+        vector = np.zeros(self.dim, dtype=np.float32)
+        text = self.normalize(text)
+        low, high = self.ngram_range
+        for n in range(low, high + 1):
+            # 较长的 n-gram 区分度更高，权重更大
+            for i in range(len(text) - n + 1):
+                h = zlib.crc32(text[i:i + n].encode("utf-8"))
+                # 低位决定维度，最高位决定符号，降低哈希冲突带来的偏差
+                vector[h % self.dim] += n if h & 0x80000000 else -n
+        norm = float(np.linalg.norm(vector))
+        if norm > 0:
+            vector /= norm
+        return vector
+
+
+class _ScopeIndex:
+    """一个范围（授权码 + 模型）内的向量矩阵及对应的记录ID"""
+
+    def __init__(self, dim):
+        self.dim = dim
+        # 快照部分（可能是内存映射）
+        self.base_ids = np.zeros(0, dtype=np.int64)
+        self.base = np.zeros((0, dim), dtype=np.float32)
+        # 快照之后新写入的部分，按容量倍增的缓冲区
+        self.tail_ids = np.zeros(64, dtype=np.int64)
+        self.tail = np.zeros((64, dim), dtype=np.float32)
+        self.tail_size = 0
+
+    def __len__(self):
+        return len(self.base_ids) + self.tail_size
+
+    def append(self, entry_id, vector):
+        if self.tail_size == len(self.tail_ids):
+            capacity = len(self.tail_ids) * 2
+            self.tail_ids = np.resize(self.tail_ids, capacity)
+            tail = np.zeros((capacity, self.dim), dtype=np.float32)
+            tail[:self.tail_size] = self.tail[:self.tail_size]
+            self.tail = tail
+        self.tail_ids[self.tail_size] = entry_id
+        self.tail[self.tail_size] = vector
+        self.tail_size += 1
+
+    def search(self, vector, k):
+        """返回相似度最高的 k 个 (相似度, 记录ID)，按相似度从高到低排列"""
+        scores = []
+        ids = []
+        if len(self.base_ids):
+            scores.append(self.base @ vector)
+            ids.append(self.base_ids)
+        if self.tail_size:
+            scores.append(self.tail[:self.tail_size] @ vector)
+            ids.append(self.tail_ids[:self.tail_size])
+        if not scores:
+            return []
+        scores = np.concatenate(scores) if len(scores) > 1 else scores[0]
+        ids = np.concatenate(ids) if len(ids) > 1 else ids[0]
+
+        k = min(k, len(scores))
+        if k == 1:
+            top = np.array([int(np.argmax(scores))])
+        else:
+            top = np.argpartition(-scores, k - 1)[:k]
+            top = top[np.argsort(-scores[top])]
+        return [(float(scores[i]), int(ids[i])) for i in top]
+
+    def merged(self):
+        """快照与新写入部分合并后的 (ID, 矩阵)"""
+        ids = np.concatenate([self.base_ids, self.tail_ids[:self.tail_size]])
+        matrix = np.concatenate([self.base, self.tail[:self.tail_size]])
+        return ids, matrix
+
+
+class SemanticCache:
+    """按用户和模型分范围的语义缓存"""
+
+    def __init__(self, db_manager, embedder=None, threshold=None, index_dir=None):
+        self.db_manager = db_manager
+        self.embedder = embedder or HashedNgramEmbedder()
+        self.threshold = SEMANTIC_CACHE_THRESHOLD if threshold is None else threshold
+        self.index_dir = SEMANTIC_CACHE_INDEX_DIR if index_dir is None else index_dir
+        self.logger = Logger()
+        self._indexes = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        # 相似度超过阈值但实词不同而被拒绝的候选数
+        self.rejected = 0
+        self.lookup_seconds = 0.0
+
+    @staticmethod
+    def make_scope(auth_code, model):
+        return f"{auth_code}\x1f{model}"
+
+    def lookup(self, auth_code, model, question, k=4):
+        """查找相似问题，返回 {'question', 'answer', 'score'}，没有命中时返回 None
+
+        按相似度从高到低检查前 k 个超过阈值的候选，返回第一个实词与问题完全相同的。
+        """
+        start = time.perf_counter()
+        vector = self.embedder.embed(question)
+        scope = self.make_scope(auth_code, model)
+        with self._lock:
+            index = self._get_index(scope)
+            matches = index.search(vector, k)
+        self.lookup_seconds += time.perf_counter() - start
+
+        tokens = content_tokens(question)
+        for score, entry_id in matches:
+            if score < self.threshold:
+                break
+            try:
+                entry = self.db_manager.get_semantic_cache_entry(entry_id)
+            except sqlite3.Error as e:
+                self.logger.log_exception(f"读取语义缓存时出错: {str(e)}")
+                break
+            if entry is None:
+                continue
+            if content_tokens(entry['question']) != tokens:
+                self.rejected += 1
+                continue
+            self.hits += 1
+            entry['score'] = score
+            return entry
+        self.misses += 1
+        return None
+
+    def add(self, auth_code, model, question, answer):
+        """缓存问题和回答"""
+        vector = self.embedder.embed(question)
+        scope = self.make_scope(auth_code, model)
+        # 先加载范围索引再写入数据库，否则新记录会在加载时重复加入
+        with self._lock:
+            self._get_index(scope)
+        try:
+            entry_id = self.db_manager.add_semantic_cache_entry(
+                scope, question, answer, vector.tobytes(), time.time())
+        except sqlite3.Error as e:
+            self.logger.log_exception(f"写入语义缓存时出错: {str(e)}")
+            return
+        with self._lock:
+            index = self._get_index(scope)
+            index.append(entry_id, vector)
+            if self.index_dir and index.tail_size >= SEMANTIC_CACHE_SNAPSHOT_EVERY:
+                self._save_snapshot(scope, index)
+
+    def flush(self):
+        """把内存中新写入的向量合并进快照文件"""
+        if not self.index_dir:
+            return
+        with self._lock:
+            for scope, index in self._indexes.items():
+                if index.tail_size:
+                    self._save_snapshot(scope, index)
+
+    def stats(self):
+        """缓存命中统计"""
+        total = self.hits + self.misses
+        with self._lock:
+            entries = sum(len(index) for index in self._indexes.values())
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "rejected": self.rejected,
+            "avg_lookup_ms": self.lookup_seconds / total * 1000 if total else 0.0,
+            "loaded_entries": entries,
+        }
+
+    def _get_index(self, scope):
+        index = self._indexes.get(scope)
+        if index is None:
+            index = self._load_index(scope)
+            self._indexes[scope] = index
+        return index
+
+    def _snapshot_paths(self, scope, max_id):
+        """快照文件名带上最大记录ID：内存映射中的旧文件在 Windows 上无法被覆盖，每次写入新文件"""
+        name = hashlib.sha1(scope.encode("utf-8")).hexdigest()[:16]
+        return (os.path.join(self.index_dir, f"{name}.{max_id}.ids.npy"),
+                os.path.join(self.index_dir, f"{name}.{max_id}.vectors.npy"))
+
+    def _load_index(self, scope):
+        """加载范围内的向量：快照与数据库一致时内存映射快照，否则从数据库重建"""
+        dim = self.embedder.dim
+        index = _ScopeIndex(dim)
+        count, max_id = self.db_manager.get_semantic_cache_extent(scope)
+
+        if self.index_dir and count:
+            ids_path, vectors_path = self._snapshot_paths(scope, max_id)
+            try:
+                ids = np.load(ids_path)
+                vectors = np.load(vectors_path, mmap_mode="r")
+                if len(ids) == count and int(ids[-1]) == max_id and vectors.shape == (count, dim):
+                    index.base_ids = ids
+                    index.base = vectors
+                    return index
+            except (OSError, ValueError, IndexError):
+                pass
+
+        for entry_id, blob in self.db_manager.iter_semantic_cache_embeddings(scope):
+            vector = np.frombuffer(blob, dtype=np.float32)
+            # 维度配置变化后旧向量不再可用
+            if vector.shape[0] == dim:
+                index.append(entry_id, vector)
+        if self.index_dir and index.tail_size:
+            self._save_snapshot(scope, index)
+        return index
+
+    def _save_snapshot(self, scope, index):
+        ids, matrix = index.merged()
+        old_paths = self._snapshot_paths(scope, int(index.base_ids[-1])) if len(index.base_ids) else ()
+        ids_path, vectors_path = self._snapshot_paths(scope, int(ids[-1]))
+        try:
+            os.makedirs(self.index_dir, exist_ok=True)
+            # 先写临时文件再重命名，避免中途失败留下不完整的快照；ID 文件最后写入，作为快照完整的标志
+            for path, array in ((vectors_path, matrix), (ids_path, ids)):
+                tmp_path = path + ".tmp"
+                with open(tmp_path, "wb") as f:
+                    np.save(f, array)
+                os.replace(tmp_path, path)
+            index.base_ids = ids
+            index.base = np.load(vectors_path, mmap_mode="r")
+            index.tail_size = 0
+        except OSError as e:
+            self.logger.log_exception(f"保存语义缓存索引时出错: {str(e)}")
+            return
+        # 删除旧快照，仍被映射而无法删除时留到下次
+        for path in old_paths:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
@@ -0,0 +1,77 @@
+"""
+本地 token 计数
+
+安装了 tiktoken 时使用 cl100k_base 编码计数，否则按字符估算：中日韩字符每个算 1 个 token，
+其余字符每 4 个算 1 个 token。估算值偏保守，用于控制发送给模型的历史消息长度。
+"""
+
+import re
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# 每条消息除正文外的格式开销（角色标记、分隔符等）
+MESSAGE_TOKEN_OVERHEAD = 4
+# 截断消息时加在开头的标记
+TRUNCATION_MARK = "……"
+
+_CJK_PATTERN = re.compile(r"[　-ヿ㐀-䶿一-鿿가-힯＀-￯]")
+
+_encoding = None
+_encoding_loaded = False
+
+
+def _get_encoding():
+    """加载 tiktoken 编码，只尝试一次，失败（如首次使用时无法下载词表）后退回估算"""
+    global _encoding, _encoding_loaded
+    if not _encoding_loaded:
+        _encoding_loaded = True
+        if tiktoken is not None:
+            try:
+                _encoding = tiktoken.get_encoding("cl100k_base")
+            except Exception:
+                _encoding = None
+    return _encoding
+
+
+def count_tokens(text):
+    """计算文本的 token 数"""
+    if not text:
+        return 0
+    encoding = _get_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text, disallowed_special=()))
+    cjk = len(_CJK_PATTERN.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def count_message_tokens(token_count):
+    """单条消息在提示词中实际占用的 token 数"""
+    return token_count + MESSAGE_TOKEN_OVERHEAD
+
+
+def truncate_tokens(text, max_tokens):
+    """只保留文本末尾不超过 max_tokens 个 token 的部分，截断时开头加上省略号
+
+    用于单条消息就超出历史预算的情况：问题通常在消息末尾，保留末尾比保留开头更有用。
+    """
+    if count_tokens(text) <= max_tokens:
+        return text
+    budget = max_tokens - count_tokens(TRUNCATION_MARK)
+    if budget <= 0:
+        return ""
+    encoding = _get_encoding()
+    if encoding is not None:
+        tokens = encoding.encode(text, disallowed_special=())
+        return TRUNCATION_MARK + encoding.decode(tokens[-budget:])
+    # 估算的 token 数随保留长度单调变化，二分查找能保留的最长后缀
+    low, high = 0, len(text)
+    while low < high:
+        mid = (low + high) // 2
+        if count_tokens(text[mid:]) <= budget:
+            high = mid
+        else:
+            low = mid + 1
+    return TRUNCATION_MARK + text[low:]